@@ -0,0 +1,1594 @@
+"""
+一些性能相关改动的简单microbenchmark, 只依赖 torch, 默认在CPU上运行
+python benchmark.py fused_step --node LIFNode IFNode --steps 4 8 16
+python benchmark.py static_input --steps 4 8 --batch-size 16
+python benchmark.py packed_fp --num-samples 744 --batch-size 64 --step 4
+python benchmark.py spike_counter --num-samples 200 --batch-size 64
+python benchmark.py grouped_linear --groups 2 4 8 16 32 --batch-size 16 64 256
+python benchmark.py time_fold --batch-size 64 --step 4
+python benchmark.py cremad --store_path /path/to/store
+python benchmark.py ogm_ge --seed 0
+python benchmark.py scores --batch-size 64 128 256
+python benchmark.py min_norm --trials 100
+python benchmark.py mmpareto --seed 0
+python benchmark.py metrics --iters 2000 --flush-interval 300
+python benchmark.py input_pipeline --num-workers 0 2 --device cpu
+python benchmark.py snr --snr 0 5 10 20 30 --num-samples 744
+python benchmark.py map --num-samples 10000 --num-classes 300
+python benchmark.py checkpoint --epochs 20 --k 3
+python benchmark.py resume --epochs 3 --stop-epoch 1 --stop-batch 4
+python benchmark.py dist --procs 1 2 4
+python benchmark.py accum --micro-batches 2 4 8
+python benchmark.py event_store --steps 4 8 10 16 --num-samples 200
+python benchmark.py event_batch --step 16 --num-workers 4 --batch-size 16
+python benchmark.py batch_mix --batch-size 32 --prob 0.5
+python benchmark.py manifest --num-files 100000 --classes 10
+python benchmark.py warm_cache --workers 4 --num-workers 4
+"""
+import argparse
+import copy
+import math
+import os
+import random
+import tempfile
+import time
+from functools import partial
+
+import numpy as np
+import torch
+from einops import rearrange, repeat
+from timm.utils import NativeScaler
+
+from braincog.base.node.node import BaseNode, IFNode, LIFNode, ReLUNode, PackedSpikeRecorder
+from braincog.datasets.prefetcher import MultiModalPrefetcher
+from braincog.datasets.event_store import EventStore, EventFrameDataset, EventCollate, events_to_frames
+from braincog.datasets.manifest import FileManifest
+from braincog.datasets import cut_mix
+from braincog.datasets.utils import make_resumable_loader
+from braincog.model_zoo.base_module import BaseLinearModule
+from braincog.model_zoo.basic_model import AVClassifier
+from braincog.model_zoo.resnet import resnet18
+from min_norm_solvers import MinNormSolver
+from utils.evaluation import ScoreAccumulator, average_precision
+from utils.utils import get_resume_state, load_resume_state, set_rng_state, pin_threads
+from utils.utils import CheckpointManager, ScalarBuffer, SNRNoise, modality_params, ogm_ge_coeff, modulate_grad_, modality_scores, per_loss_grads
+
+
+def timeit(fn, repeat=50, warmup=5):
+    """
+    :return: 每次调用的平均耗时, 单位 ms
+    """
+    for _ in range(warmup):
+        fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+def layer_by_layer_resnet(model, x):
+    """
+    以 ``layer_by_layer`` 的方式执行 ResNet, 网络结构与逐步计算的分支相同
+    :param x: 所有时间步折叠在batch维度的输入, shape [t*b, c, h, w]
+    """
+    model.reset()
+    x = model.maxpool(model.node1(model.bn1(model.conv1(x))))
+    x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+    x = torch.flatten(model.avgpool(x), 1)
+    return rearrange(model.fc(x), '(t b) c -> t b c', t=model.step).mean(0)
+
+
+def saved_tensor_bytes(model, fn):
+    """
+    统计前向过程中为反向保存的激活 (不含参数), 它们一直保留到反向传播, 即反向时激活占用的峰值
+    :return: (fn的输出, 所有激活的字节数, 其中在神经元内部保存的字节数)
+    """
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    saved, in_node = {}, set()
+    depth = [0]
+
+    def pack(x):
+        storage = x.untyped_storage()
+        if storage.data_ptr() not in params:
+            saved[storage.data_ptr()] = storage.nbytes()
+            if depth[0] > 0:
+                in_node.add(storage.data_ptr())
+        return x
+
+    def enter(module, inputs):
+        depth[0] += 1
+
+    def leave(module, inputs, outputs):
+        depth[0] -= 1
+
+    handles = []
+    for m in model.modules():
+        if isinstance(m, BaseNode):
+            handles += [m.register_forward_pre_hook(enter), m.register_forward_hook(leave)]
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+            out = fn()
+    finally:
+        for h in handles:
+            h.remove()
+    return out, sum(saved.values()), sum(saved[ptr] for ptr in in_node)
+
+
+def bench_fused_step(args):
+    nodes = {'LIFNode': LIFNode, 'IFNode': IFNode}
+    print('{:>8} {:>4} {:>10} {:>12} {:>12} {:>12} {:>12} {:>10} {:>10}'.format(
+        'node', 'T', 'identical', 'act_loop(MB)', 'act_fused', 'node_loop', 'node_fused', 'loop(ms)', 'fused(ms)'))
+    for name in args.node:
+        for step in args.steps:
+            torch.manual_seed(args.seed)
+            loop_model = resnet18(node_type=nodes[name], step=step, layer_by_layer=True,
+                                  dataset='cifar10', num_classes=10)
+            # ResNet 不把 step 传给神经元, 需要单独设置
+            loop_model.set_attr('step', step)
+            fused_model = copy.deepcopy(loop_model)
+            fused_model.set_attr('fused_step', True)
+            assert all(m.use_fused_step() for m in fused_model.modules() if isinstance(m, BaseNode))
+
+            x = torch.randn(step * args.batch_size, 3, args.size, args.size)
+            grad = torch.randn(args.batch_size, 10)
+
+            def run(model):
+                inputs = x.clone().requires_grad_()
+                model.zero_grad()
+                out, total, in_node = saved_tensor_bytes(model, lambda: layer_by_layer_resnet(model, inputs))
+                out.backward(grad)
+                grads = [p.grad for p in model.parameters() if p.grad is not None]
+                return [out.detach(), inputs.grad] + grads, total, in_node
+
+            ref, act_loop, node_loop = run(loop_model)
+            out, act_fused, node_fused = run(fused_model)
+            identical = len(ref) == len(out) and all(torch.equal(a, b) for a, b in zip(ref, out))
+            t_loop = timeit(lambda: run(loop_model), args.repeat, 1)
+            t_fused = timeit(lambda: run(fused_model), args.repeat, 1)
+            print('{:>8} {:>4} {:>10} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>10.1f} {:>10.1f}'.format(
+                name, step, identical, act_loop / 2 ** 20, act_fused / 2 ** 20, node_loop / 2 ** 20,
+                node_fused / 2 ** 20, t_loop, t_fused))
+            print('{:>8} {:>4} activation memory: {:.2f}x lower in total, {:.2f}x lower inside the nodes'.format(
+                '', '', act_loop / act_fused, node_loop / max(node_fused, 1)))
+            assert identical, (name, step)
+
+
+def compare_static(name, model, step, make_inputs, static_inputs, args):
+    """
+    同一个模型在T份拷贝的输入与静态输入上各训练一个iteration, 比较输出, BN的running统计量和梯度
+    :param make_inputs: 原来的实现, 每个iteration在host上repeat并拷贝T份
+    """
+    model.train()
+    ref_model, static_model = copy.deepcopy(model), copy.deepcopy(model)
+
+    def run(m, inputs):
+        m.zero_grad()
+        out = m(inputs)
+        out = out if isinstance(out, tuple) else (out,)
+        sum(o.sum() for o in out).backward()
+        return [o.detach() for o in out]
+
+    ref, out = run(ref_model, make_inputs()), run(static_model, static_inputs)
+    identical = all(torch.equal(a, b) for a, b in zip(ref, out)) and \
+        all(torch.equal(a, b) for a, b in zip(ref_model.buffers(), static_model.buffers()))
+    ref_grad = torch.cat([p.grad.flatten() for p in ref_model.parameters() if p.grad is not None])
+    grad = torch.cat([p.grad.flatten() for p in static_model.parameters() if p.grad is not None])
+    # 梯度全为0时比较没有意义
+    assert ref_grad.norm() > 0, (name, step)
+    err = ((grad - ref_grad).norm() / ref_grad.norm()).item()
+
+    t_ref = timeit(lambda: run(ref_model, make_inputs()), args.repeat, 1)
+    t_static = timeit(lambda: run(static_model, static_inputs), args.repeat, 1)
+    print('{:>13} {:>4} {:>10.1f} {:>10.1f} {:>7.2f}x {:>10} {:>10.2e}'.format(
+        name, step, t_ref, t_static, t_ref / t_static, identical, err))
+    assert identical and err < 1e-4, (name, step, err)
+    assert t_static < t_ref, (name, step, t_ref, t_static)
+
+
+def bench_static_input(args):
+    print('{:>13} {:>4} {:>10} {:>10} {:>8} {:>10} {:>10}'.format(
+        'model', 'T', 'repeat(ms)', 'static(ms)', 'speedup', 'identical', 'grad_err'))
+    for step in args.steps:
+        torch.manual_seed(args.seed)
+        audio = torch.randn(args.batch_size, 1, args.size, args.size)
+        visual = torch.randn(args.batch_size, 3, args.size, args.size)
+        model = AVClassifier(num_classes=6, step=step, node_type=ReLUNode, dataset='CREMAD',
+                             fusion_method='concat', modality='audio-visual')
+        # 原来在host上repeat并拷贝T份; 训练脚本中的 repeat_step 现在得到stride为0的view
+        # 只有 AVClassifier 使用静态输入的路径: ResNet 只能省去conv1/bn1, 实测 (B=16, T=4/8, CPU) 与逐步计算持平
+        compare_static('AVClassifier', model, step,
+                       lambda: [repeat(x, 'b c w h -> b t c w h', t=step).contiguous() for x in (audio, visual)],
+                       [repeat(x, 'b c w h -> b t c w h', t=step) for x in (audio, visual)], args)
+
+
+def recorded_bytes(model):
+    """
+    :return: 所有神经元的 ``feature_map`` 占用的字节数
+    """
+    total = 0
+    for f in model.get_attr('feature_map'):
+        if isinstance(f, PackedSpikeRecorder):
+            total += f.memory()
+        else:
+            total += sum(x.numel() * x.element_size() for x in f)
+    return total
+
+
+def bench_packed_fp(args):
+    torch.manual_seed(args.seed)
+    model = resnet18(node_type=LIFNode, step=args.step, dataset='cifar10', num_classes=10).eval()
+    models = {'none': model, 'list': copy.deepcopy(model), 'packed': copy.deepcopy(model)}
+    models['list'].set_requires_fp(True)
+    models['packed'].set_requires_fp(True)
+    models['packed'].set_fp_packed(True)
+    batches = [torch.randn(min(args.batch_size, args.num_samples - i), 3, args.size, args.size)
+               for i in range(0, args.num_samples, args.batch_size)]
+
+    def validate(m):
+        with torch.no_grad():
+            for x in batches:
+                m(x)
+
+    # 逐batch比较两种记录方式读出的结果, 并统计每个batch记录的字节数
+    identical = True
+    nbytes = {'list': [], 'packed': []}
+    with torch.no_grad():
+        for x in batches:
+            for name in nbytes:
+                models[name](x)
+                nbytes[name].append(recorded_bytes(models[name]))
+            ref, packed = models['list'], models['packed']
+            identical &= all(len(a) == len(b) and all(torch.equal(u, v) for u, v in zip(a, b))
+                             for a, b in zip(ref.get_fp(temporal_info=True), packed.get_fp(temporal_info=True)))
+            identical &= all(torch.equal(a, b) for a, b in zip(ref.get_fp(), packed.get_fp()))
+            identical &= torch.equal(ref.get_fire_rate(), packed.get_fire_rate())
+
+    times = {name: timeit(lambda: validate(m), args.repeat, 1) / len(batches) for name, m in models.items()}
+    print('{} samples, batch size {}, T={}, {}x{}'.format(args.num_samples, args.batch_size, args.step,
+                                                           args.size, args.size))
+    print('{:>8} {:>10} {:>10} {:>14} {:>14}'.format('mode', 'ms/batch', 'overhead', 'MB/batch', 'MB/epoch'))
+    for name in models:
+        record = nbytes.get(name, [0])
+        print('{:>8} {:>10.1f} {:>9.1f}% {:>14.2f} {:>14.1f}'.format(
+            name, times[name], (times[name] / times['none'] - 1) * 100, max(record) / 2 ** 20, sum(record) / 2 ** 20))
+    print('packed / list: {:.3f}x memory, get_fp/get_fire_rate identical: {}'.format(
+        sum(nbytes['packed']) / sum(nbytes['list']), identical))
+    assert identical
+
+
+def bench_spike_counter(args):
+    torch.manual_seed(args.seed)
+    model = resnet18(node_type=LIFNode, step=args.step, dataset='cifar10', num_classes=10).eval()
+    model.set_requires_fp(True)
+    model.set_spike_count(True)
+    model.reset_spike_count()
+
+    # 逐batch用 feature_map 计算, 按batch size (即每层的元素个数) 加权平均
+    fired, numel, tot_spike, samples = 0., 0., 0., 0
+    batch_sizes = []
+    with torch.no_grad():
+        for i in range(0, args.num_samples, args.batch_size):
+            x = torch.randn(min(args.batch_size, args.num_samples - i), 3, args.size, args.size)
+            model(x)
+            sizes = torch.tensor([f[0].numel() for f in model.get_attr('feature_map')], dtype=torch.float64)
+            fired = fired + model.get_fire_rate().double() * sizes
+            numel = numel + sizes
+            tot_spike += model.get_tot_spike().item() * x.shape[0]
+            samples += x.shape[0]
+            batch_sizes.append(x.shape[0])
+    ref_rate, ref_spike = fired / numel, tot_spike / samples
+    rate, spike = model.get_running_fire_rate().double(), model.get_running_tot_spike().item()
+
+    rate_err = (rate - ref_rate).abs().max().item()
+    spike_err = abs(spike - ref_spike) / ref_spike
+    print('batch sizes: {}'.format(batch_sizes))
+    print('fire rate of {} layers: max abs err {:.2e}'.format(len(rate), rate_err))
+    print('tot spike: feature_map {:.4f}, running {:.4f}, rel err {:.2e}'.format(ref_spike, spike, spike_err))
+    assert rate_err < 1e-6 and spike_err < 1e-6, (rate_err, spike_err)
+
+
+def loop_linear(module, x):
+    # 原来的实现: 逐个分组调用 nn.Linear
+    x = rearrange(x, 'b (c t) -> t b c', t=module.groups)
+    outputs = []
+    for i in range(module.groups):
+        outputs.append(module.fc[i](x[i]))
+    outputs = torch.stack(outputs)
+    return rearrange(outputs, 't b c -> b (c t)')
+
+
+def grouped_linear(module, x):
+    x = rearrange(x, 'b (c t) -> t b c', t=module.groups)
+    return rearrange(module.grouped_linear(x), 't b c -> b (c t)')
+
+
+def bench_grouped_linear(args):
+    print('{:>6} {:>6} {:>10} {:>10} {:>8} {:>10}'.format('groups', 'batch', 'loop(ms)', 'bmm(ms)', 'speedup', 'max_err'))
+    for groups in args.groups:
+        module = BaseLinearModule(args.in_features, args.out_features, node=ReLUNode, groups=groups).eval()
+        for batch_size in args.batch_size:
+            x = torch.randn(batch_size, args.in_features * groups)
+            with torch.no_grad():
+                err = (loop_linear(module, x) - grouped_linear(module, x)).abs().max().item()
+                t_loop = timeit(lambda: loop_linear(module, x), args.repeat)
+                t_bmm = timeit(lambda: grouped_linear(module, x), args.repeat)
+            print('{:>6} {:>6} {:>10.3f} {:>10.3f} {:>7.2f}x {:>10.2e}'.format(
+                groups, batch_size, t_loop, t_bmm, t_loop / t_bmm, err))
+            assert err < 1e-5, (groups, batch_size, err)
+
+
+def bench_time_fold(args):
+    model = AVClassifier(num_classes=args.num_classes, step=args.step, node_type=ReLUNode, dataset=args.dataset,
+                         fusion_method='concat', modality='audio-visual')
+    model.train(args.train)
+    loop_model = copy.deepcopy(model)
+    fold_model = copy.deepcopy(model)
+    fold_model.time_fold = True
+
+    audio = torch.randn(args.batch_size, args.step, 1, args.size, args.size)
+    visual = torch.randn(args.batch_size, args.step, 3, args.size, args.size)
+
+    def run(m):
+        if args.train:
+            m.zero_grad()
+            _, _, out = m([audio, visual])
+            out.sum().backward()
+        else:
+            with torch.no_grad():
+                m([audio, visual])
+
+    with torch.no_grad():
+        ref = copy.deepcopy(loop_model)([audio, visual])
+        out = copy.deepcopy(fold_model)([audio, visual])
+        err = max((x - y).abs().max().item() for x, y in zip(ref, out))
+    t_loop = timeit(lambda: run(loop_model), args.repeat, warmup=1)
+    t_fold = timeit(lambda: run(fold_model), args.repeat, warmup=1)
+    print('B={} T={} size={} train={}'.format(args.batch_size, args.step, args.size, args.train))
+    print('loop: {:.1f} ms ({:.1f} samples/s)'.format(t_loop, args.batch_size / t_loop * 1e3))
+    print('fold: {:.1f} ms ({:.1f} samples/s)'.format(t_fold, args.batch_size / t_fold * 1e3))
+    print('speedup: {:.2f}x, max_err: {:.2e}'.format(t_loop / t_fold, err))
+    assert err < 1e-5, err
+
+
+def bench_cremad(args):
+    from dataset.CramedDataset import CramedDataset
+
+    for store_path in [None, args.store_path]:
+        args.store_path = store_path
+        dataset = CramedDataset(args, mode=args.mode)
+        n = min(args.num_samples, len(dataset))
+        start = time.perf_counter()
+        for i in range(n):
+            dataset[i]
+        elapsed = time.perf_counter() - start
+        print('{}: {:.1f} samples/s'.format('store' if store_path else 'decode', n / elapsed))
+
+
+def bench_ogm_ge(args):
+    model = AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual')
+    grads = {name: torch.randn_like(p) for name, p in model.named_parameters()}
+    ratio_v = torch.tensor(args.ratio)
+
+    def reset():
+        for name, p in model.named_parameters():
+            p.grad = grads[name].clone()
+
+    def loop_modulate():
+        # 原来的实现: 逐个参数调用 normal_, std 通过 .item() 同步到host
+        if ratio_v > 1:
+            coeff_v, coeff_a = 1 - torch.tanh(args.alpha * torch.relu(ratio_v)), 1
+        else:
+            coeff_a, coeff_v = 1 - torch.tanh(args.alpha * torch.relu(1 / ratio_v)), 1
+        for name, parms in model.named_parameters():
+            layer = name.split('.')[0]
+            if 'audio' in layer and parms.grad.dim() == 4:
+                parms.grad = parms.grad * coeff_a + \
+                             torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
+            if 'visual' in layer and parms.grad.dim() == 4:
+                parms.grad = parms.grad * coeff_v + \
+                             torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
+
+    audio_params = modality_params(model, 'audio', dim=4)
+    visual_params = modality_params(model, 'visual', dim=4)
+
+    def foreach_modulate():
+        coeff_a, coeff_v = ogm_ge_coeff(ratio_v, args.alpha)
+        modulate_grad_(audio_params, coeff_a)
+        modulate_grad_(visual_params, coeff_v)
+
+    reset()
+    torch.manual_seed(args.seed)
+    loop_modulate()
+    ref = [p.grad.clone() for p in audio_params + visual_params]
+    reset()
+    torch.manual_seed(args.seed)
+    foreach_modulate()
+    err = max((p.grad - r).abs().max().item() for p, r in zip(audio_params + visual_params, ref))
+
+    t_loop = timeit(lambda: (reset(), loop_modulate()), args.repeat)
+    t_foreach = timeit(lambda: (reset(), foreach_modulate()), args.repeat)
+    print('loop: {:.2f} ms, foreach: {:.2f} ms, max_err with seed {}: {:.2e}'.format(
+        t_loop, t_foreach, args.seed, err))
+    assert err < 1e-6, err
+
+
+def bench_scores(args):
+    softmax = torch.nn.Softmax(dim=1)
+    device = torch.device(args.device)
+    print('{:>6} {:>10} {:>12} {:>10}'.format('batch', 'loop(ms)', 'batched(ms)', 'max_err'))
+    for batch_size in args.batch_size:
+        target = torch.randint(args.num_classes, (batch_size,), device=device)
+        logits = [torch.randn(batch_size, args.num_classes, device=device) for _ in range(3)]
+
+        def loop_scores():
+            # 原来的实现: 每个样本重新计算一次softmax
+            return [sum([softmax(o)[i][target[i]] for i in range(o.size(0))]) for o in logits]
+
+        err = max((x - y).abs().item() for x, y in zip(loop_scores(), modality_scores(target, *logits)))
+        t_loop = timeit(loop_scores, args.repeat)
+        t_batched = timeit(lambda: modality_scores(target, *logits), args.repeat)
+        print('{:>6} {:>10.3f} {:>12.3f} {:>10.2e}'.format(batch_size, t_loop, t_batched, err))
+        assert err < 1e-6 * batch_size, (batch_size, err)
+
+
+def bench_min_norm(args):
+    torch.manual_seed(args.seed)
+    print('{:>6} {:>10} {:>12} {:>10} {:>14}'.format('tasks', 'numpy(ms)', 'batched(ms)', 'max_err', 'device max_err'))
+    for n in args.tasks:
+        err, device_err, t_ref, t_batched = 0., 0., 0., 0.
+        for _ in range(args.trials):
+            vecs = [torch.randn(args.dim, dtype=torch.float64) for _ in range(n)]
+            # 随机让一部分任务的梯度相互冲突
+            vecs[-1] = vecs[-1] - vecs[0] * torch.rand(1, dtype=torch.float64) * 2
+
+            start = time.perf_counter()
+            ref, _ = MinNormSolver.find_min_norm_element([[v] for v in vecs])
+            t_ref += time.perf_counter() - start
+            start = time.perf_counter()
+            sol, _ = MinNormSolver.find_min_norm_element_batched(vecs)
+            t_batched += time.perf_counter() - start
+            ref = torch.from_numpy(ref)
+            err = max(err, float(ref.sub(sol).abs().max()))
+            if n > 2:
+                # GPU上使用的设备端迭代, 这里只在CPU上检查结果
+                grad_mat = MinNormSolver._gram_matrix(vecs)
+                sol, nd = MinNormSolver._min_norm_2d_batched(grad_mat)
+                sol, _ = MinNormSolver._min_norm_loop_batched(grad_mat, sol, nd, MinNormSolver.MAX_ITER,
+                                                              MinNormSolver.STOP_CRIT)
+                device_err = max(device_err, float(ref.sub(sol).abs().max()))
+        print('{:>6} {:>10.3f} {:>12.3f} {:>10.2e} {:>14.2e}'.format(
+            n, t_ref / args.trials * 1e3, t_batched / args.trials * 1e3, err, device_err))
+        assert err < 1e-6 and device_err < 1e-6, (n, err, device_err)
+
+
+def bench_mmpareto(args):
+    import train_snn
+
+    torch.manual_seed(args.seed)
+    model = AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual').train()
+    params = [p for name, p in model.named_parameters()
+              if ('audio_net' in name or 'visual_net' in name) and 'threshold' not in name and '_net.fc' not in name]
+    audio = torch.randn(args.batch_size, 1, 1, args.size, args.size)
+    visual = torch.randn(args.batch_size, 1, 3, args.size, args.size)
+    target = torch.randint(6, (args.batch_size,))
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    def losses():
+        output_a, output_v, output = model([audio, visual])
+        return [loss_fn(output, target), loss_fn(model.audio_fc(output_a), target),
+                loss_fn(model.visual_fc(output_v), target)]
+
+    def retain_graph():
+        # 原来的实现: 三次 retain_graph backward, 每次clone所有梯度
+        # 单模态的loss不经过另一个模态的参数, 梯度为 None, 与 per_loss_grads 一样按0处理
+        out = []
+        ls = losses()
+        for loss in ls:
+            loss.backward(retain_graph=True)
+            out.append(torch.cat([(p.grad.clone() if p.grad is not None else torch.zeros_like(p)).flatten()
+                                  for p in params]))
+            model.zero_grad()
+        return torch.stack(out)
+
+    state = copy.deepcopy(model.state_dict())
+    ref = retain_graph()
+    model.load_state_dict(state)
+    flat, _ = per_loss_grads(losses(), params)
+    err = ((flat - ref).norm(dim=1) / ref.norm(dim=1)).max().item()
+
+    model.load_state_dict(state)
+    t_ref = timeit(retain_graph, args.repeat, warmup=1)
+    model.load_state_dict(state)
+    t_batched = timeit(lambda: per_loss_grads(losses(), params), args.repeat, warmup=1)
+    print('per-loss grads: retain_graph {:.1f} ms, batched {:.1f} ms, rel err {:.2e}'.format(t_ref, t_batched, err))
+    assert err < 1e-5, err
+
+    # train_snn.train_epoch 完整的MMpareto调制之后, 两种方式得到的 p.grad 一致
+    model.load_state_dict(state)
+    batch = ([audio[:, 0], visual[:, 0]], target)
+    ref = accumulated_grads(train_snn, model, batch, 'MMpareto', 1, args)
+    model.load_state_dict(state)
+    grads = accumulated_grads(train_snn, model, batch, 'MMpareto', 1, args, extra_argv=['--mmpareto-batched-grad'])
+    step_err = ((grads - ref).norm() / ref.norm()).item()
+    print('modulated grads after the MMpareto step: rel err {:.2e}'.format(step_err))
+    assert step_err < 1e-5, step_err
+
+
+class ScalarRecorder(object):
+    # 记录写入的标量, 用于比较两种写法得到的曲线, 同时转发给真正的 SummaryWriter
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.scalars = []
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        self.scalars.append((tag, float(scalar_value), global_step))
+        if self.writer is not None:
+            self.writer.add_scalar(tag, scalar_value, global_step)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def bench_metrics(args):
+    device = torch.device(args.device)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    def run(writer, buffered):
+        torch.manual_seed(args.seed)
+        model = torch.nn.Linear(args.dim, 10).to(device)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        if buffered:
+            writer = ScalarBuffer(writer, flush_interval=args.flush_interval)
+        start = time.perf_counter()
+        for it in range(args.iters):
+            x = torch.randn(args.batch_size, args.dim, device=device)
+            target = torch.randint(10, (args.batch_size,), device=device)
+            output = model(x)
+            loss = loss_fn(output, target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            acc1 = (output.argmax(1) == target).float().mean() * 100
+            acc5 = (output.topk(5, 1)[1] == target[:, None]).any(1).float().mean() * 100
+            if buffered:
+                writer.add_scalar('batch/train/top1', acc1, it)
+                writer.add_scalar('batch/train/top5', acc5, it)
+                writer.add_scalar('batch/train/loss', loss, it)
+            else:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                writer.add_scalar('batch/train/top1', acc1.item(), it)
+                writer.add_scalar('batch/train/top5', acc5.item(), it)
+                writer.add_scalar('batch/train/loss', loss.item(), it)
+        if buffered:
+            writer.wait()
+        elapsed = (time.perf_counter() - start) / args.iters * 1e3
+        writer.close()
+        return elapsed
+
+    from torch.utils.tensorboard import SummaryWriter
+    with tempfile.TemporaryDirectory() as root:
+        direct = ScalarRecorder(SummaryWriter(os.path.join(root, 'direct')))
+        buffered = ScalarRecorder(SummaryWriter(os.path.join(root, 'buffered')))
+        t_direct = run(direct, False)
+        t_buffered = run(buffered, True)
+    identical = direct.scalars == buffered.scalars
+    print('per iteration: item() {:.3f} ms, buffered {:.3f} ms, identical curves: {}'.format(
+        t_direct, t_buffered, identical))
+    assert identical and len(direct.scalars) == 3 * args.iters
+    assert t_buffered < t_direct
+
+
+class RandomAVDataset(torch.utils.data.Dataset):
+    # 与CREMAD相同形状的随机音频谱图和视频帧, 用float64模拟numpy读出的数据
+    def __init__(self, length, fps=1, size=224):
+        self.length = length
+        self.fps = fps
+        self.size = size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        spectrogram = torch.randn(1, self.size, self.size, dtype=torch.float64)
+        images = torch.randn(3, self.fps, self.size, self.size, dtype=torch.float64)
+        return [spectrogram, images], idx % 6
+
+
+def bench_input_pipeline(args):
+    device = torch.device(args.device)
+    dataset = RandomAVDataset(args.batch_size * args.batches, size=args.size)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3, 2), torch.nn.ReLU(), torch.nn.Conv2d(16, 16, 3, 2)).to(device)
+
+    def compute(inputs):
+        # 模拟训练中的计算
+        for _ in range(args.compute):
+            model(inputs[1][:, :, 0])
+
+    def baseline(loader):
+        for inputs, target in loader:
+            inputs = [item.type(torch.FloatTensor).to(device) for item in inputs]
+            target = target.to(device)
+            compute(inputs)
+
+    def prefetched(loader):
+        for inputs, target in MultiModalPrefetcher(loader, device=device):
+            compute(inputs)
+
+    print('{:>8} {:>14} {:>16}'.format('workers', 'baseline(b/s)', 'prefetcher(b/s)'))
+    for num_workers in args.num_workers:
+        loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=num_workers,
+                                             pin_memory=device.type == 'cuda')
+        rates = []
+        for fn in (baseline, prefetched):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            fn(loader)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            rates.append(len(loader) / (time.perf_counter() - start))
+        print('{:>8} {:>14.2f} {:>16.2f}'.format(num_workers, *rates))
+
+
+def bench_snr(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    # 与CREMAD验证集相同形状的输入, 放在host上模拟DataLoader的输出
+    batches = [torch.randn(min(args.batch_size, args.num_samples - i), 3, 1, args.size, args.size)
+               for i in range(0, args.num_samples, args.batch_size)]
+    levels = torch.tensor(args.snr, dtype=torch.float32)
+
+    def host_sweep():
+        # 原来的实现: 在host上逐batch加噪后再搬运
+        for snr in args.snr:
+            for image in batches:
+                image = image + torch.randn(image.shape) * math.sqrt(
+                    torch.mean(torch.pow(image, 2)) / math.pow(10, snr / 10))
+                image.to(device)
+
+    def device_sweep():
+        snr_noise = SNRNoise(seed=0, reduce='batch')
+        for snr in args.snr:
+            for image in batches:
+                snr_noise(image.to(device), snr)
+
+    def batched_sweep(data=batches):
+        # 每个样本在所有SNR下各加一次噪声, 每个batch一次调用完成整个sweep
+        snr_noise = SNRNoise(seed=0)
+        out = None
+        for image in data:
+            out = snr_noise.sweep(image.to(device), levels.to(device))
+        return out
+
+    # 相同种子得到相同的噪声, sweep 与把输入复制 S 份后逐样本加噪相同, 按样本计算的信噪比与设定值一致
+    a, b = batched_sweep(batches[:1]), batched_sweep(batches[:1])
+    same = torch.equal(a, b)
+    image = batches[0].to(device)
+    repeated = SNRNoise(seed=0)(image.repeat(len(args.snr), 1, 1, 1, 1),
+                                levels.to(device).repeat_interleave(image.size(0)))
+    matches = torch.equal(a.flatten(0, 1), repeated)
+    noise = a - image
+    measured = 10 * torch.log10(image.pow(2).mean(dim=(1, 2, 3, 4)) / noise.pow(2).mean(dim=(2, 3, 4, 5)))
+    measured = measured.mean(1).cpu()
+
+    def run(fn):
+        start = time.perf_counter()
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    t_host, t_device, t_batched = run(host_sweep), run(device_sweep), run(batched_sweep)
+    print('host: {:.3f} s, device: {:.3f} s, batched: {:.3f} s for {} SNR levels over {} samples'.format(
+        t_host, t_device, t_batched, len(args.snr), args.num_samples))
+    print('reproducible: {}, sweep matches per-sample call: {}, measured SNR: {}'.format(
+        same, matches, ', '.join('{:.2f}'.format(x) for x in measured.tolist())))
+    assert same and matches
+    assert (measured - levels).abs().max().item() < 0.05
+    assert t_batched < t_host
+
+
+def loop_map(predictions, labels, n_classes):
+    # 原来 main.py 中的 calculate_map: 逐个类别计算, 插值精度逐个元素更新
+    APs = []
+    for class_id in range(n_classes):
+        class_scores = predictions[:, class_id]
+        true_class = (labels == class_id).float()
+        sorted_indices = torch.argsort(class_scores, descending=True)
+        true_class = true_class[sorted_indices]
+        tp = torch.cumsum(true_class, dim=0)
+        fp = torch.cumsum(1 - true_class, dim=0)
+        precision = tp / (tp + fp)
+        recall = tp / true_class.sum()
+        precision = torch.cat([torch.tensor([1], device=precision.device), precision])
+        recall = torch.cat([torch.tensor([0], device=recall.device), recall])
+        for i in range(precision.size(0) - 1, 0, -1):
+            precision[i - 1] = torch.max(precision[i - 1], precision[i])
+        APs.append(torch.sum((recall[1:] - recall[:-1]) * precision[1:]))
+    return torch.mean(torch.tensor(APs)).item()
+
+
+def bench_map(args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    labels = torch.randint(args.num_classes, (args.num_samples,), device=device)
+    scores = torch.randn(args.num_samples, args.num_classes, device=device)
+    scores[torch.arange(args.num_samples), labels] += 1.
+    # 量化一部分分数, 制造相同分数的情况
+    scores[:, ::2] = (scores[:, ::2] * 4).round() / 4
+
+    def streaming():
+        meter = ScoreAccumulator(args.num_classes)
+        for i in range(0, args.num_samples, args.batch_size):
+            meter.update(scores[i:i + args.batch_size], labels[i:i + args.batch_size])
+        return meter.compute()
+
+    metrics = streaming()
+    err_interp = abs(loop_map(scores, labels, args.num_classes) -
+                     average_precision(scores, labels, interpolated=True).nanmean().item())
+    print('max |interpolated mAP - loop|: {:.2e}'.format(err_interp))
+    assert err_interp < 1e-6, err_interp
+    try:
+        from sklearn.metrics import average_precision_score, roc_auc_score
+        one_hot = torch.nn.functional.one_hot(labels, args.num_classes).cpu().numpy()
+        ap_ref = average_precision_score(one_hot, scores.cpu().numpy(), average=None)
+        auc_ref = roc_auc_score(one_hot, scores.cpu().numpy(), average=None)
+        err_ap = (metrics['ap'].cpu().double() - torch.from_numpy(ap_ref)).abs().max().item()
+        err_auc = (metrics['auc'].cpu().double() - torch.from_numpy(auc_ref)).abs().max().item()
+        print('max |AP - sklearn|: {:.2e}, max |AUC - sklearn|: {:.2e}'.format(err_ap, err_auc))
+        assert err_ap < 1e-9 and err_auc < 1e-9, (err_ap, err_auc)
+
+        def reference():
+            loop_map(scores, labels, args.num_classes)
+            roc_auc_score(one_hot, scores.cpu().numpy(), multi_class='ovr')
+    except ImportError:
+        def reference():
+            loop_map(scores, labels, args.num_classes)
+
+    print('loop mAP + sklearn AUC: {:.1f} ms, streaming: {:.1f} ms'.format(
+        timeit(reference, args.repeat, warmup=1), timeit(streaming, args.repeat, warmup=1)))
+
+
+def bench_checkpoint(args):
+    random.seed(args.seed)
+    model = torch.nn.Sequential(*[torch.nn.Linear(args.dim, args.dim) for _ in range(args.layers)])
+    metrics = [round(random.random(), 2) for _ in range(args.epochs)]  # 保留两位小数, 制造相同的指标
+
+    with tempfile.TemporaryDirectory() as root:
+        saver = CheckpointManager(root, k=args.k)
+        t_async = 0.
+        for epoch, metric in enumerate(metrics):
+            start = time.perf_counter()
+            path = saver.save({'epoch': epoch, 'model': model.state_dict()}, 'epoch_{}.pth'.format(epoch), metric)
+            t_async += time.perf_counter() - start
+            committed = model[0].weight.detach().clone()
+            with torch.no_grad():
+                model[0].weight.add_(1.)  # 模拟训练, 不能影响已经提交的checkpoint
+            time.sleep(args.step_ms / 1e3)  # 两次保存之间的训练, GPU上训练时主线程大多在等待
+        saver.close()
+
+        # 指标相同时先保存的排在前面, 与 sort 的稳定性一致
+        expected = ['epoch_{}.pth'.format(e) for e in
+                    sorted(range(args.epochs), key=lambda e: metrics[e], reverse=True)[:args.k]]
+        files = sorted(f for f in os.listdir(root) if f != 'last.pth')
+        order = [os.path.basename(p) for _, p in saver.checkpoints]
+        last = torch.load(os.path.join(root, 'last.pth'))
+        identical = torch.equal(last['model']['0.weight'], committed)
+        print('kept {}, expected {}, order {}, last epoch {}, snapshot taken at save time: {}'.format(
+            files, sorted(expected), order == expected, last['epoch'], identical))
+        assert files == sorted(expected) and order == expected and identical
+        # 最后一次保存进入 top-k 时, last 与它是同一个文件
+        if path is not None:
+            assert os.path.samefile(path, os.path.join(root, 'last.pth'))
+
+        t_sync = 0.
+        for epoch in range(args.epochs):
+            start = time.perf_counter()
+            torch.save({'epoch': epoch, 'model': model.state_dict()}, os.path.join(root, 'sync.pth'))
+            t_sync += time.perf_counter() - start
+            time.sleep(args.step_ms / 1e3)
+    t_sync, t_async = t_sync / args.epochs * 1e3, t_async / args.epochs * 1e3
+    print('blocking time per save: torch.save {:.1f} ms, CheckpointManager {:.1f} ms'.format(t_sync, t_async))
+    assert t_async < 0.5 * t_sync
+
+
+class NoisyDataset(torch.utils.data.Dataset):
+    # __getitem__ 中使用全局随机数, 模拟数据增强
+    def __init__(self, length, dim):
+        self.data = torch.randn(length, dim)
+        self.target = torch.randint(10, (length,))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return self.data[idx] + 0.1 * torch.randn(self.data.size(1)), self.target[idx]
+
+
+def bench_resume(args):
+    def train(root, stop=None, resume=None):
+        torch.manual_seed(args.seed)
+        dataset = NoisyDataset(args.num_samples, args.dim)
+        loader = make_resumable_loader(torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True),
+                                       seed=args.seed)
+        model = torch.nn.Sequential(torch.nn.Linear(args.dim, 64), torch.nn.ReLU(), torch.nn.Dropout(0.2),
+                                    torch.nn.Linear(64, 10))
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+        lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5)
+        saver = CheckpointManager(root, k=0, last_name='last_step.pth.tar')
+        loss_fn = torch.nn.CrossEntropyLoss()
+
+        start_epoch, start_batch, state = 0, 0, None
+        if resume is not None:
+            state = torch.load(resume)
+            start_epoch, start_batch = load_resume_state(state, model=model, optimizer=optimizer,
+                                                         lr_scheduler=lr_scheduler)
+        for epoch in range(start_epoch, args.epochs):
+            loader.sampler.set_epoch(epoch)
+            loader.sampler.set_start(start_batch * args.batch_size)
+            if state is not None:
+                set_rng_state(state['rng'])
+                state = None
+            for batch_idx, (x, y) in enumerate(loader, start_batch):
+                loss = loss_fn(model(x), y)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+                if (batch_idx + 1) % args.interval == 0:
+                    saver.save(get_resume_state(epoch, batch_idx, model=model, optimizer=optimizer,
+                                                lr_scheduler=lr_scheduler), None, None)
+                if stop is not None and (epoch, batch_idx) == stop:
+                    # 模拟中断, 只留下最近的step checkpoint
+                    saver.close()
+                    return None
+            start_batch = 0
+            lr_scheduler.step()
+        saver.close()
+        return model.state_dict()
+
+    with tempfile.TemporaryDirectory() as root:
+        reference = train(root)
+    with tempfile.TemporaryDirectory() as root:
+        train(root, stop=(args.stop_epoch, args.stop_batch))
+        resumed = train(root, resume=os.path.join(root, 'last_step.pth.tar'))
+    same = all(torch.equal(reference[k], resumed[k]) for k in reference)
+    print('interrupted at epoch {} batch {}, resumed weights identical: {}'.format(args.stop_epoch, args.stop_batch, same))
+    assert same
+
+
+def _dist_worker(rank, world_size, args, port, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    pin_threads(rank, world_size, args.threads)
+    torch.manual_seed(args.seed)
+
+    dataset = torch.utils.data.TensorDataset(torch.randn(args.num_samples, 3, args.size, args.size),
+                                             torch.randint(10, (args.num_samples,)))
+    loader = make_resumable_loader(torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True),
+                                   seed=args.seed, num_replicas=world_size, rank=rank)
+    model = torch.nn.Sequential(
+        torch.nn.Conv2d(3, 32, 3, padding=1), torch.nn.ReLU(), torch.nn.MaxPool2d(2),
+        torch.nn.Conv2d(32, 64, 3, padding=1), torch.nn.ReLU(), torch.nn.AdaptiveAvgPool2d(1),
+        torch.nn.Flatten(), torch.nn.Linear(64, 10))
+    model = torch.nn.parallel.DistributedDataParallel(model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    def epoch():
+        for x, y in loader:
+            loss = loss_fn(model(x), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        # 与训练中的 reduce_tensor 相同, 在CPU上用gloo归约指标
+        torch.distributed.all_reduce(loss.detach().clone())
+
+    loader.sampler.set_epoch(0)
+    epoch()  # warmup
+    torch.distributed.barrier()
+    start = time.perf_counter()
+    for e in range(args.epochs):
+        loader.sampler.set_epoch(e + 1)
+        epoch()
+    elapsed = torch.tensor(time.perf_counter() - start)
+    torch.distributed.all_reduce(elapsed, op=torch.distributed.ReduceOp.MAX)
+    if rank == 0:
+        results.put(len(loader.sampler) * world_size * args.epochs / elapsed.item())
+    torch.distributed.destroy_process_group()
+
+
+def bench_dist(args):
+    import torch.multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    print('{:>6} {:>12} {:>8}'.format('procs', 'samples/s', 'speedup'))
+    base = None
+    for k, procs in enumerate(args.procs):
+        results = ctx.SimpleQueue()
+        mp.spawn(_dist_worker, args=(procs, args, args.port + k, results), nprocs=procs, join=True)
+        rate = results.get()
+        base = base or rate
+        print('{:>6} {:>12.1f} {:>8.2f}'.format(procs, rate, rate / base))
+
+
+class GradRecorder(torch.optim.SGD):
+    # 记录 step 时 (调制之后) 的梯度, 不更新参数, 同一个模型可以重复运行
+    def step(self, closure=None):
+        self.grads = torch.cat([p.grad.flatten() for group in self.param_groups for p in group['params']
+                                if p.grad is not None])
+
+
+class NullWriter(object):
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+def accumulated_grads(train_snn, model, batch, modulation, n, args, amp=False, extra_argv=()):
+    """
+    在只有一个batch的loader上运行 train_snn.train_epoch, 与训练时的前向, 累积和调制是同一份代码
+    :param amp: 使用原生AMP, 与训练脚本的 ``--native-amp`` 相同地传入 ``amp_autocast`` 和 ``NativeScaler``
+    :param extra_argv: 额外的训练脚本参数
+    :return: 调制之后所有参数的梯度, 拼接成一个向量
+    """
+    argv = ['--alpha', str(args.alpha), '--dataset', 'CREMAD', '--modality', 'audio-visual', '--step', '1',
+            '--micro-batches', str(n), '--seed', str(args.seed), '--log-interval', '1000000']
+    if modulation == 'inverse':
+        argv += ['--inverse']
+    else:
+        argv += ['--modulation', modulation]
+    train_args = train_snn.parser.parse_args(argv + list(extra_argv))
+    train_args.device = torch.device(args.device)
+    train_args.prefetcher = False
+    train_args.distributed = False
+    train_args.world_size = 1
+    train_args.tensorboard_prefix = ''
+
+    kwargs = {}
+    if amp:
+        # CPU上用bfloat16的autocast, GradScaler在没有CUDA时不缩放, 但仍然走 unscale -> 调制 -> step 的路径
+        dtype = torch.float16 if train_args.device.type == 'cuda' else torch.bfloat16
+        kwargs = dict(amp_autocast=partial(torch.autocast, train_args.device.type, dtype=dtype),
+                      loss_scaler=NativeScaler())
+    optimizer = GradRecorder(model.parameters(), lr=0.)
+    # 调制中的高斯噪声在相同的随机数状态下采样
+    torch.manual_seed(args.seed)
+    train_snn.train_epoch(0, model, [batch], optimizer, torch.nn.CrossEntropyLoss(), train_args,
+                          summary_writer=NullWriter(), audio_lr_ratio=1., visual_lr_ratio=1., **kwargs)
+    return optimizer.grads
+
+
+def bench_accum(args):
+    import train_snn
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    # eval 模式下 BN 使用running统计量, 每个样本的输出与batch的切分无关, train_epoch 中的 model.train() 不改变它
+    model = AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual').to(device).eval()
+    model.train = lambda mode=True: torch.nn.Module.train(model, False)
+    audio = torch.randn(args.batch_size, 1, args.size, args.size)
+    visual = torch.randn(args.batch_size, 3, args.size, args.size)
+    target = torch.randint(6, (args.batch_size,))
+    batch = ([audio, visual], target)
+
+    print('{:>9} {:>5} {:>6} {:>10} {:>10}'.format('mode', 'amp', 'micro', 'time(ms)', 'rel_err'))
+    for amp in [False, True]:
+        # 半精度下切分batch改变了累加的顺序和舍入, 误差放宽
+        tol = 1e-4 if device.type == 'cpu' and not amp else 2e-2
+        for modulation in args.modulation:
+            ref = accumulated_grads(train_snn, model, batch, modulation, 1, args, amp)
+            t_ref = timeit(lambda: accumulated_grads(train_snn, model, batch, modulation, 1, args, amp),
+                           args.repeat, 1)
+            print('{:>9} {:>5} {:>6} {:>10.1f} {:>10}'.format(modulation, str(amp), 1, t_ref, '-'))
+            for n in args.micro_batches:
+                grads = accumulated_grads(train_snn, model, batch, modulation, n, args, amp)
+                err = ((grads - ref).norm() / ref.norm()).item()
+                t = timeit(lambda: accumulated_grads(train_snn, model, batch, modulation, n, args, amp),
+                           args.repeat, 1)
+                print('{:>9} {:>5} {:>6} {:>10.1f} {:>10.2e}'.format(modulation, str(amp), n, t, err))
+                assert err < tol, (modulation, amp, n, err)
+
+
+class SyntheticEventDataset(torch.utils.data.Dataset):
+    # tonic 格式的合成事件流, 每个样本的事件数和时长都不同, 由 seed 和 idx 确定
+    dtype = np.dtype([('x', '<i8'), ('y', '<i8'), ('t', '<i8'), ('p', '<i8')])
+
+    def __init__(self, length, sensor_size, max_events, seed=0, transform=None):
+        self.length = length
+        self.sensor_size = sensor_size
+        self.max_events = max_events
+        self.seed = seed
+        self.transform = transform
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        rng = np.random.RandomState(self.seed + idx)
+        n = rng.randint(self.max_events // 10, self.max_events)
+        events = np.zeros(n, dtype=self.dtype)
+        events['x'] = rng.randint(self.sensor_size[0], size=n)
+        events['y'] = rng.randint(self.sensor_size[1], size=n)
+        events['p'] = rng.randint(self.sensor_size[2], size=n)
+        events['t'] = np.sort(rng.randint(rng.randint(1, 6000000), size=n))
+        if self.transform is not None:
+            events = self.transform(events)
+        return events, idx % 10
+
+
+def bench_event_store(args):
+    import tonic
+    from tonic import DiskCachedDataset
+
+    sensor_size = (args.size, args.size, 2)
+    dataset = SyntheticEventDataset(args.num_samples, sensor_size, args.max_events, seed=args.seed)
+
+    def read_all(frames):
+        start = time.perf_counter()
+        for i in range(len(frames)):
+            frames[i]
+        return len(frames) / (time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        store = EventStore.build(dataset, os.path.join(root, 'events'), num_workers=args.num_workers)
+        t_store = time.perf_counter() - start
+
+        print('{:>5} {:>10} {:>10} {:>12} {:>12} {:>12} {:>10}'.format(
+            'step', 'warmup(s)', 'bin(s)', 'cache(/s)', 'store(/s)', 'binned(/s)', 'identical'))
+        t_warmup, t_bin = 0., 0.
+        for step in args.steps:
+            to_frame = tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step)
+            identical = all(
+                np.array_equal(to_frame(dataset[i][0]), events_to_frames(store[i][0], sensor_size, step))
+                for i in range(len(dataset)))
+
+            # 原来的实现: 每个step各自缓存一份 ToFrame 的输出
+            cached = DiskCachedDataset(SyntheticEventDataset(args.num_samples, sensor_size, args.max_events,
+                                                             seed=args.seed, transform=to_frame),
+                                       cache_path=os.path.join(root, 'cache_{}'.format(step)))
+            start = time.perf_counter()
+            for i in range(len(cached)):
+                cached[i]
+            t_step = time.perf_counter() - start
+            t_warmup += t_step
+            rate_cache = read_all(cached)
+            rate_store = read_all(EventFrameDataset(store, sensor_size, step))
+            # frame_dataset 使用的方式: 每个step第一次使用时从存储中分帧并缓存
+            start = time.perf_counter()
+            binned = EventFrameDataset(store, sensor_size, step, cache=True)
+            t_step_bin = time.perf_counter() - start
+            t_bin += t_step_bin
+            identical = identical and all(np.array_equal(binned[i][0], events_to_frames(store[i][0], sensor_size, step))
+                                          for i in range(len(binned)))
+            binned = EventFrameDataset(store, sensor_size, step, cache=True)
+            rate_binned = read_all(binned)
+            print('{:>5} {:>10.1f} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f} {:>10}'.format(
+                step, t_step, t_step_bin, rate_cache, rate_store, rate_binned, str(identical)))
+            assert identical
+            assert rate_binned > rate_cache, (step, rate_binned, rate_cache)
+        print('warm-up for {} steps: per-step caches {:.1f} s, event store {:.1f} s (once) + binning {:.1f} s'.format(
+            len(args.steps), t_warmup, t_store, t_bin))
+
+
+class FrameTransform(object):
+    # 与 get_dvsg_data 的 test_transform 相同: 转为float并缩放到 size x size
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, x):
+        x = torch.tensor(x, dtype=torch.float)
+        return torch.nn.functional.interpolate(x, size=[self.size, self.size], mode='bilinear', align_corners=True)
+
+
+def bench_event_batch(args):
+    sensor_size = (args.size, args.size, 2)
+    dataset = SyntheticEventDataset(args.num_samples, sensor_size, args.max_events, seed=args.seed)
+    transform = FrameTransform(args.resize) if args.resize > 0 else None
+
+    def run(loader, batch_transform=None):
+        # 返回 (每个样本经过worker传给主进程的字节数, samples/s, 第一个batch)
+        volume = [0]
+
+        def count(inputs):
+            tensors = inputs.values() if isinstance(inputs, dict) else [inputs]
+            volume[0] += sum(x.numel() * x.element_size() for x in tensors)
+            return inputs if batch_transform is None else batch_transform(inputs)
+
+        first = None
+        start = time.perf_counter()
+        for inputs, _ in MultiModalPrefetcher(loader, device='cpu', batch_transform=count):
+            first = inputs if first is None else first
+        elapsed = time.perf_counter() - start
+        return volume[0] / len(loader.dataset), len(loader.dataset) / elapsed, first
+
+    with tempfile.TemporaryDirectory() as root:
+        store = EventStore.build(dataset, os.path.join(root, 'events'))
+        # 原来的实现: worker 中分帧并 transform, 稠密的帧经过进程间通信传给主进程
+        frames = torch.utils.data.DataLoader(EventFrameDataset(store, sensor_size, args.step, transform=transform),
+                                             batch_size=args.batch_size, num_workers=args.num_workers)
+        collate = EventCollate(sensor_size, args.step, transform=transform)
+        events = torch.utils.data.DataLoader(EventFrameDataset(store, sensor_size, None),
+                                             batch_size=args.batch_size, num_workers=args.num_workers,
+                                             collate_fn=collate)
+        bytes_frames, rate_frames, ref = run(frames)
+        bytes_events, rate_events, out = run(events, collate.to_frames)
+
+    print('T={} {}x{} -> {}, batch {}, {} workers'.format(
+        args.step, args.size, args.size, args.resize or args.size, args.batch_size, args.num_workers))
+    print('frames in workers: {:>8.1f} KB/sample IPC, {:>8.1f} samples/s'.format(bytes_frames / 1024, rate_frames))
+    print('events in workers: {:>8.1f} KB/sample IPC, {:>8.1f} samples/s'.format(bytes_events / 1024, rate_events))
+    identical = torch.equal(ref.float(), out.float())
+    print('identical first batch: {}'.format(identical))
+    assert identical
+    # 每个事件只传2或4字节的帧内位置, 主进程每个样本一次 bincount, 吞吐量不低于在worker中分帧
+    assert bytes_events < bytes_frames, (bytes_events, bytes_frames)
+    assert rate_events > 0.8 * rate_frames, (rate_events, rate_frames)
+
+    # 浮点时间戳 (0.1毫秒, 毫秒) 与逐样本的 events_to_frames 相同
+    collate = EventCollate(sensor_size, args.step)
+    for scale in (1e2, 1e3):
+        batch = []
+        for idx in range(args.batch_size):
+            events, target = dataset[idx]
+            events = {name: events[name] for name in events.dtype.names}
+            events['t'] = events['t'] / scale
+            batch.append((events, target))
+        out = collate.to_frames(collate(batch)[0])
+        ref = torch.stack([torch.from_numpy(events_to_frames(events, sensor_size, args.step)) for events, _ in batch])
+        non_empty = (ref.flatten(1).sum(1) > 0).sum().item()
+        print('float timestamps / {:.0e}: identical {}, {} non-empty samples'.format(
+            scale, torch.equal(out, ref), non_empty))
+        assert torch.equal(out, ref) and non_empty == args.batch_size, (scale, non_empty)
+
+
+def per_sample_mix(mode, x, target, num_class, beta, prob, gaussian_n):
+    # 按 BatchMix 抽取随机数的顺序, 用原来逐样本的函数 (rand_bbox, GMM_mask, st_mask, calc_masked_lam ...) 混合
+    batch = len(x)
+    active = np.random.rand(batch) <= prob
+    lam = np.random.beta(beta, beta, size=batch)
+    index = np.random.randint(batch, size=batch)
+    out, lbs = x.clone(), []
+    for i in range(batch):
+        img, img2, lm = x[i].clone(), x[index[i]], lam[i]
+        if mode == 'mix_up':
+            img = img * lm + img2 * (1. - lm)
+        elif mode == 'cut_mix':
+            bbx1, bby1, bbx2, bby2 = cut_mix.rand_bbox(img.shape, 1. - lm)
+            lm = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (img.shape[-1] * img.shape[-2]))
+            img[:, :, bbx1:bbx2, bby1:bby2] = img2[:, :, bbx1:bbx2, bby1:bby2]
+        else:
+            if mode == 'st':
+                mask = cut_mix.st_mask(img.shape, 1. - lm)
+            else:
+                mask = cut_mix.GMM_mask(img.shape, 1. - lm, gaussian_n)
+            mix = img.clone()
+            mix[mask] = img2[mask]
+            if mode == 'difference':
+                lm = cut_mix.calc_masked_lam_with_difference(img, img2, mix, kernel_size=3)
+            else:
+                lm = cut_mix.calc_masked_lam(img, img2, mask)
+            img = mix
+        lb = cut_mix.onehot(num_class, target[i])
+        if active[i]:
+            out[i] = img
+            lb = lb * float(lm) + cut_mix.onehot(num_class, target[index[i]]) * (1. - float(lm))
+        lbs.append(lb)
+    return out, torch.stack(lbs)
+
+
+class CountingFrames(torch.utils.data.Dataset):
+    # 合成的 [T, 2, H, W] 事件帧, 记录读取的次数
+    def __init__(self, length, step, size, num_classes):
+        self.length = length
+        self.shape = (step, 2, size, size)
+        self.num_classes = num_classes
+        self.reads = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        self.reads += 1
+        g = torch.Generator().manual_seed(idx)
+        return torch.poisson(torch.rand(self.shape, generator=g) * 2, generator=g), idx % self.num_classes
+
+
+def bench_batch_mix(args):
+    modes = {
+        'mix_up': lambda seed: cut_mix.BatchMixUp(args.num_classes, beta=args.beta, prob=args.prob, seed=seed),
+        'cut_mix': lambda seed: cut_mix.BatchCutMix(args.num_classes, beta=args.beta, prob=args.prob, seed=seed),
+        'event_mix': lambda seed: cut_mix.BatchEventMix(args.num_classes, beta=args.beta, prob=args.prob, noise=0.,
+                                                        gaussian_n=args.gaussian_n, seed=seed),
+        'st': lambda seed: cut_mix.BatchEventMix(args.num_classes, beta=args.beta, prob=args.prob, noise=0.,
+                                                 mask_type='st', seed=seed),
+        'difference': lambda seed: cut_mix.BatchEventMix(args.num_classes, beta=args.beta, prob=args.prob, noise=0.,
+                                                         gaussian_n=args.gaussian_n, lam_mode='difference', seed=seed),
+    }
+    dataset = CountingFrames(args.batch_size, args.step, args.size, args.num_classes)
+    x, target = torch.utils.data.dataloader.default_collate([dataset[i] for i in range(len(dataset))])
+
+    # 与逐样本的原函数在相同的随机数下对比, 以及同一个seed的结果是否可以复现
+    print('{:>11} {:>10} {:>10} {:>12} {:>13}'.format('mode', 'max diff', 'mismatch', 'label err', 'reproducible'))
+    for mode, build in modes.items():
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        out, lb = build(None)(x, target)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        ref, ref_lb = per_sample_mix(mode, x, target, args.num_classes, args.beta, args.prob, args.gaussian_n)
+        diff = ((out - ref).abs() > 1e-4).float().mean().item()
+        err = (lb - ref_lb).abs().max().item()
+
+        torch.manual_seed(args.seed)
+        out1, lb1 = build(args.seed)(x, target)
+        torch.manual_seed(args.seed)
+        out2, lb2 = build(args.seed)(x, target)
+        reproducible = torch.equal(out1, out2) and torch.equal(lb1, lb2)
+        sums = (lb.sum(1) - 1).abs().max().item()
+        print('{:>11} {:>10.2e} {:>10} {:>12.2e} {:>13}'.format(
+            mode, (out - ref).abs().max().item(), '{:.2%}'.format(diff), err, reproducible))
+        # GMM mask 的混合高斯按维度分开计算, 阈值附近的个别位置可能因为舍入不同
+        assert diff < 1e-3 and err < 1e-3 and sums < 1e-5 and reproducible, mode
+
+    # 读取次数与吞吐量: 包装在数据集外的 EventMix 与batch级别的 BatchEventMix
+    num = args.batches * args.batch_size
+    print('{:>10} {:>13} {:>12}'.format('', 'reads/sample', 'samples/s'))
+    for name in ('dataset', 'batch'):
+        frames = CountingFrames(num, args.step, args.size, args.num_classes)
+        if name == 'dataset':
+            loader_set, mix = cut_mix.EventMix(frames, args.num_classes, beta=args.beta, prob=args.prob, noise=0.,
+                                               gaussian_n=args.gaussian_n), None
+        else:
+            loader_set, mix = frames, modes['event_mix'](args.seed)
+        loader = torch.utils.data.DataLoader(loader_set, batch_size=args.batch_size, num_workers=0)
+        start = time.perf_counter()
+        for inputs, target in loader:
+            if mix is not None:
+                inputs, target = mix(inputs, target)
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>13.2f} {:>12.1f}'.format(name, frames.reads / num, num / elapsed))
+
+
+def bench_manifest(args):
+    from braincog.datasets.datasets import walk_manifest
+
+    class_names = {'class_{:02d}'.format(c): c for c in range(args.classes)}
+
+    def walk(root):
+        # 原来 CREMADDataset/UrbanSound8KDataset 构建时的扫描
+        data, targets = [], []
+        for path, dirs, files in os.walk(root):
+            dirs.sort()
+            for file in files:
+                if file.endswith("jpg"):
+                    data.append(path + "/" + file)
+                    targets.append(class_names[os.path.basename(path)])
+        return data, targets
+
+    def timed(fn, *fn_args, **fn_kwargs):
+        start = time.perf_counter()
+        out = fn(*fn_args, **fn_kwargs)
+        return out, time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as root:
+        data_root = os.path.join(root, 'visual')
+        for i in range(args.num_files):
+            name = 'class_{:02d}'.format(i % args.classes)
+            if i < args.classes:
+                os.makedirs(os.path.join(data_root, name))
+            open(os.path.join(data_root, name, '{:07d}.jpg'.format(i)), 'wb').close()
+        file = os.path.join(root, 'manifests', 'visual.pkl')
+
+        (data, targets), t_walk = timed(walk, data_root)
+        built, t_build = timed(walk_manifest, data_root, class_names, file)
+        loaded, t_load = timed(walk_manifest, data_root, class_names, file)
+        _, t_full = timed(FileManifest.load(file).is_valid, 'full')
+        identical = built.paths == loaded.paths == data and built.labels == loaded.labels == targets
+
+        # 增加一个文件之后目录的mtime改变, 清单重新扫描
+        time.sleep(0.01)
+        open(os.path.join(data_root, 'class_00', 'new.jpg'), 'wb').close()
+        rebuilt, t_rebuild = timed(walk_manifest, data_root, class_names, file)
+        refreshed = rebuilt.paths == walk(data_root)[0]
+
+    print('{} files in {} classes'.format(args.num_files, args.classes))
+    print('os.walk scan:            {:>8.1f} ms'.format(t_walk * 1000))
+    print('manifest build + save:   {:>8.1f} ms'.format(t_build * 1000))
+    print('manifest load (watch):   {:>8.1f} ms'.format(t_load * 1000))
+    print('full stat validation:    {:>8.1f} ms'.format(t_full * 1000))
+    print('rescan after a new file: {:>8.1f} ms'.format(t_rebuild * 1000))
+    print('identical: {}, refreshed: {}'.format(identical, refreshed))
+    assert identical and refreshed
+
+
+def bench_warm_cache(args):
+    import tonic
+    from tonic import DiskCachedDataset
+    from tonic.cached_dataset import load_from_disk_cache
+    from braincog.datasets.disk_cache import find_disk_caches, warm_caches
+
+    sensor_size = (args.size, args.size, 2)
+    to_frame = tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=args.step)
+    dataset = SyntheticEventDataset(args.num_samples, sensor_size, args.max_events, seed=args.seed, transform=to_frame)
+    total = args.num_samples * args.num_copies
+
+    with tempfile.TemporaryDirectory() as root:
+        # 原来的实现: 第一个epoch中 DataLoader 的 worker 边读边写
+        lazy = DiskCachedDataset(dataset, cache_path=os.path.join(root, 'lazy'), num_copies=args.num_copies)
+        loader = torch.utils.data.DataLoader(lazy, batch_size=args.batch_size, num_workers=args.num_workers)
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        t_lazy = time.perf_counter() - start
+        lazy_files = len(os.listdir(lazy.cache_path))
+
+        # 与 get_*_data 一样包装在 loader 中, 由 find_disk_caches 找到
+        cached = DiskCachedDataset(dataset, cache_path=os.path.join(root, 'warm'), num_copies=args.num_copies)
+        loader = torch.utils.data.DataLoader(torch.utils.data.Subset(cached, range(len(cached))),
+                                             batch_size=args.batch_size)
+        caches = find_disk_caches((loader, loader, False, None))
+        start = time.perf_counter()
+        stats = warm_caches(caches, workers=args.workers, seed=args.seed)
+        t_warm = time.perf_counter() - start
+
+        identical = all(np.array_equal(load_from_disk_cache(os.path.join(cached.cache_path, '{}_0.hdf5'.format(i)))[0],
+                                       dataset[i][0]) for i in range(args.num_samples))
+
+        # 模拟中断: 删掉一部分文件并留下一个很久以前未写完的临时文件, 再次运行只补上缺少的文件
+        # 另一个进程正在写的临时文件不能被删除
+        removed = sorted(os.listdir(cached.cache_path))[::5]
+        for name in removed:
+            os.remove(os.path.join(cached.cache_path, name))
+        stale = os.path.join(cached.cache_path, '0_0.hdf5.tmp12345')
+        open(stale, 'wb').close()
+        os.utime(stale, (time.time() - 7200, time.time() - 7200))
+        in_progress = '1_0.hdf5.tmp12346'
+        open(os.path.join(cached.cache_path, in_progress), 'wb').close()
+        resumed = warm_caches(caches, workers=args.workers, seed=args.seed)[0]
+        again = warm_caches(caches, workers=args.workers, seed=args.seed)[0]
+        leftover = [name for name in os.listdir(cached.cache_path) if '.tmp' in name]
+
+    print('{} samples x {} copies, T={}, {}x{}'.format(args.num_samples, args.num_copies, args.step, args.size, args.size))
+    print('lazy fill ({} loader workers): {:>8.1f} files/s, {} files'.format(args.num_workers, lazy_files / t_lazy,
+                                                                              lazy_files))
+    print('warm-up   ({} processes):      {:>8.1f} files/s, {} files, {:.1f} MB'.format(
+        args.workers, stats[0]['written'] / t_warm, stats[0]['written'], stats[0]['bytes'] / 2 ** 20))
+    print('identical to ToFrame: {}, caches found: {}'.format(identical, len(caches)))
+    print('resume: {} removed, {} rewritten, {} skipped; second run wrote {}; leftover tmp files: {}'.format(
+        len(removed), resumed['written'], resumed['skipped'], again['written'], leftover))
+    assert len(caches) == 1 and stats[0]['written'] == total and identical
+    assert resumed['written'] == len(removed) and again['written'] == 0 and leftover == [in_progress]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='microbenchmark')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    p = subparsers.add_parser('fused_step', help='layer_by_layer 模式下融合的多步神经元, 与逐步计算的输出, 梯度和激活内存对比')
+    p.add_argument('--node', type=str, nargs='+', default=['LIFNode', 'IFNode'])
+    p.add_argument('--steps', type=int, nargs='+', default=[4, 8, 16])
+    p.add_argument('--batch-size', type=int, default=4)
+    p.add_argument('--size', type=int, default=32)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_fused_step)
+
+    p = subparsers.add_parser('static_input', help='direct编码的静态输入只计算一次不变的部分, 与T份拷贝的输入对比')
+    p.add_argument('--steps', type=int, nargs='+', default=[4, 8])
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--size', type=int, default=128)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_static_input)
+
+    p = subparsers.add_parser('packed_fp', help='requires_fp 时按位压缩记录脉冲, 与记录float的list对比耗时和内存')
+    p.add_argument('--num-samples', type=int, default=744, help='CREMAD验证集的样本数')
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--step', type=int, default=4)
+    p.add_argument('--size', type=int, default=32)
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_packed_fp)
+
+    p = subparsers.add_parser('spike_counter', help='流式统计的fire-rate和脉冲数, 与逐batch用feature_map计算的结果对比')
+    p.add_argument('--num-samples', type=int, default=200, help='不是batch size的整数倍, 最后一个batch较小')
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--step', type=int, default=4)
+    p.add_argument('--size', type=int, default=32)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_spike_counter)
+
+    p = subparsers.add_parser('grouped_linear', help='BaseLinearModule 分组执行')
+    p.add_argument('--groups', type=int, nargs='+', default=[2, 4, 8, 16, 32])
+    p.add_argument('--batch-size', type=int, nargs='+', default=[16, 64, 256])
+    p.add_argument('--in-features', type=int, default=256)
+    p.add_argument('--out-features', type=int, default=128)
+    p.add_argument('--repeat', type=int, default=50)
+    p.set_defaults(func=bench_grouped_linear)
+
+    p = subparsers.add_parser('time_fold', help='AVClassifier 时间步折叠到batch维度')
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--step', type=int, default=4)
+    p.add_argument('--size', type=int, default=128)
+    p.add_argument('--dataset', type=str, default='CREMAD')
+    p.add_argument('--num-classes', type=int, default=6)
+    p.add_argument('--train', action='store_true', help='测试训练模式下的前向+反向')
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_time_fold)
+
+    p = subparsers.add_parser('cremad', help='CramedDataset 预处理存储与逐个解码的读取速度')
+    p.add_argument('--dataset', default='CREMAD', type=str)
+    p.add_argument('--fps', default=1, type=int)
+    p.add_argument('--audio_path', default='/mnt/home/hexiang/datasets/CREMA-D/AudioWAV/', type=str)
+    p.add_argument('--visual_path', default='/mnt/home/hexiang/datasets/CREMA-D/', type=str)
+    p.add_argument('--store_path', required=True, type=str)
+    p.add_argument('--mode', default='train', type=str)
+    p.add_argument('--num-samples', type=int, default=500)
+    p.set_defaults(func=bench_cremad)
+
+    p = subparsers.add_parser('ogm_ge', help='OGM-GE 梯度调制, 与逐个参数的实现对比')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--alpha', type=float, default=1.)
+    p.add_argument('--ratio', type=float, default=1.5, help='score_v / score_a')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_ogm_ge)
+
+    p = subparsers.add_parser('scores', help='各模态置信度的计算, 与逐样本的实现对比')
+    p.add_argument('--batch-size', type=int, nargs='+', default=[64, 128, 256])
+    p.add_argument('--num-classes', type=int, default=6)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_scores)
+
+    p = subparsers.add_parser('min_norm', help='MinNormSolver 与numpy实现的结果和耗时对比')
+    p.add_argument('--tasks', type=int, nargs='+', default=[2, 3, 4, 6])
+    p.add_argument('--dim', type=int, default=1000)
+    p.add_argument('--trials', type=int, default=100)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_min_norm)
+
+    p = subparsers.add_parser('mmpareto', help='MMpareto 各个loss的梯度, batched backward 与三次 retain_graph 对比')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--batch-size', type=int, default=8)
+    p.add_argument('--size', type=int, default=64)
+    p.add_argument('--alpha', type=float, default=0.8)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_mmpareto)
+
+    p = subparsers.add_parser('metrics', help='训练时逐batch写tensorboard, 缓冲后台写入与逐个 .item() 对比')
+    p.add_argument('--iters', type=int, default=2000)
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--dim', type=int, default=64)
+    p.add_argument('--flush-interval', type=int, default=300)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_metrics)
+
+    p = subparsers.add_parser('input_pipeline', help='多模态batch的搬运, MultiModalPrefetcher 与逐个batch .type().cuda() 对比')
+    p.add_argument('--num-workers', type=int, nargs='+', default=[0, 2])
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--batches', type=int, default=50)
+    p.add_argument('--size', type=int, default=224)
+    p.add_argument('--compute', type=int, default=2, help='每个batch模拟计算的次数')
+    p.add_argument('--device', type=str, default='cpu')
+    p.set_defaults(func=bench_input_pipeline)
+
+    p = subparsers.add_parser('snr', help='在验证集上扫描多个SNR, host上逐batch加噪与设备上batched加噪对比')
+    p.add_argument('--snr', type=float, nargs='+', default=[0., 5., 10., 20., 30.])
+    p.add_argument('--num-samples', type=int, default=744, help='CREMAD验证集的样本数')
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--size', type=int, default=224)
+    p.add_argument('--device', type=str, default='cpu')
+    p.set_defaults(func=bench_snr)
+
+    p = subparsers.add_parser('map', help='AP/mAP/AUC, 与逐类别循环和sklearn对比')
+    p.add_argument('--num-samples', type=int, default=10000)
+    p.add_argument('--num-classes', type=int, default=300)
+    p.add_argument('--batch-size', type=int, default=64)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_map)
+
+    p = subparsers.add_parser('checkpoint', help='CheckpointManager 保留 top-k 的正确性和保存时阻塞的时间')
+    p.add_argument('--epochs', type=int, default=20)
+    p.add_argument('--k', type=int, default=3)
+    p.add_argument('--dim', type=int, default=1024)
+    p.add_argument('--layers', type=int, default=8)
+    p.add_argument('--step-ms', type=float, default=200., help='两次保存之间模拟训练的时间')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_checkpoint)
+
+    p = subparsers.add_parser('resume', help='在epoch中间中断并继续训练, 与不中断的结果对比')
+    p.add_argument('--epochs', type=int, default=3)
+    p.add_argument('--num-samples', type=int, default=320)
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--dim', type=int, default=32)
+    p.add_argument('--interval', type=int, default=3, help='每多少个batch保存一次step checkpoint')
+    p.add_argument('--stop-epoch', type=int, default=1)
+    p.add_argument('--stop-batch', type=int, default=4, help='在这个batch之后中断, 之后的batch需要重新训练')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_resume)
+
+    p = subparsers.add_parser('dist', help='单机多进程 gloo 数据并行的吞吐量')
+    p.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--threads', type=int, default=0, help='每个进程的线程数, 0 为平分所有的核')
+    p.add_argument('--num-samples', type=int, default=2048)
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--size', type=int, default=32)
+    p.add_argument('--epochs', type=int, default=2)
+    p.add_argument('--port', type=int, default=29531)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_dist)
+
+    p = subparsers.add_parser('accum', help='用 train_snn.train_epoch 做micro-batch梯度累积, 各种调制方式下与整个batch一次反向的梯度对比')
+    p.add_argument('--micro-batches', type=int, nargs='+', default=[2, 4, 8])
+    p.add_argument('--modulation', type=str, nargs='+', default=['Normal', 'OGM_GE', 'inverse', 'MMpareto', 'LFM', 'MSLR'])
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--size', type=int, default=64)
+    p.add_argument('--alpha', type=float, default=0.8)
+    p.add_argument('--device', type=str, default='cpu')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_accum)
+
+    p = subparsers.add_parser('event_store', help='与step无关的事件存储, 与 ToFrame 的结果和每个step各自的 DiskCachedDataset 对比')
+    p.add_argument('--steps', type=int, nargs='+', default=[4, 8, 10, 16])
+    p.add_argument('--num-samples', type=int, default=200)
+    p.add_argument('--max-events', type=int, default=300000)
+    p.add_argument('--size', type=int, default=128)
+    p.add_argument('--num-workers', type=int, default=0)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_event_store)
+
+    p = subparsers.add_parser('event_batch', help='worker只传事件并在主进程中对整个batch分帧, 与worker中分帧对比')
+    p.add_argument('--step', type=int, default=16)
+    p.add_argument('--num-samples', type=int, default=256)
+    p.add_argument('--max-events', type=int, default=300000)
+    p.add_argument('--size', type=int, default=128)
+    p.add_argument('--resize', type=int, default=0, help='分帧之后缩放到的大小, 0 为不做transform')
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--num-workers', type=int, default=4)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_event_batch)
+
+    p = subparsers.add_parser('batch_mix', help='batch内部的 MixUp/CutMix/EventMix, 与逐样本混合的结果和额外读取的次数对比')
+    p.add_argument('--batch-size', type=int, default=32)
+    p.add_argument('--batches', type=int, default=8)
+    p.add_argument('--step', type=int, default=10)
+    p.add_argument('--size', type=int, default=48)
+    p.add_argument('--num-classes', type=int, default=10)
+    p.add_argument('--beta', type=float, default=1.)
+    p.add_argument('--prob', type=float, default=0.5)
+    p.add_argument('--gaussian-n', type=int, default=3)
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_batch_mix)
+
+    p = subparsers.add_parser('manifest', help='文件清单, 与每次 os.walk 扫描整个目录的构建时间对比')
+    p.add_argument('--num-files', type=int, default=100000)
+    p.add_argument('--classes', type=int, default=10)
+    p.set_defaults(func=bench_manifest)
+
+    p = subparsers.add_parser('warm_cache', help='用进程池预先填满 DiskCachedDataset, 与第一个epoch中边读边写对比')
+    p.add_argument('--step', type=int, default=10)
+    p.add_argument('--num-samples', type=int, default=200)
+    p.add_argument('--num-copies', type=int, default=2)
+    p.add_argument('--max-events', type=int, default=100000)
+    p.add_argument('--size', type=int, default=128)
+    p.add_argument('--batch-size', type=int, default=16)
+    p.add_argument('--num-workers', type=int, default=4, help='lazy fill 时 DataLoader 的worker数')
+    p.add_argument('--workers', type=int, default=4, help='warm-up 的进程数')
+    p.add_argument('--seed', type=int, default=0)
+    p.set_defaults(func=bench_warm_cache)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.print_help()
+    else:
+        args.func(args)
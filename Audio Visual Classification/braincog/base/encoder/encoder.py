@@ -67,7 +67,9 @@ class Encoder(nn.Module):
 
     def forward(self, inputs, deletion_prob=None, shift_var=None):
         if len(inputs.shape) == 5:  # DVS data
-            outputs = inputs.permute(1, 0, 2, 3, 4).contiguous()  # t, b, c, w, h
+            outputs = inputs.permute(1, 0, 2, 3, 4)  # t, b, c, w, h
+            if inputs.stride(1) != 0:  # 由expand得到的时间维度保持为view, 不复制T份
+                outputs = outputs.contiguous()
         elif len(inputs.shape) == 3:  # DAS data
             outputs = inputs.permute(1, 0, 2).contiguous()  # t, b, c
         else:
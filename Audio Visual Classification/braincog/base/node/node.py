@@ -16,12 +16,189 @@ import torch
 from torch import nn
 from torch.nn import Parameter
 import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
 from einops import rearrange, repeat
 
 from braincog.base.connection.layer import CustomLinear
 from braincog.base.strategy.surrogate import *
 
 
+class MultiStepNodeFunction(torch.autograd.Function):
+    """
+    多步神经元的融合计算, 一次处理形状为 ``[T, B, ...]`` 的全部输入
+    前向过程逐步调用神经元的 ``integral`` 和 ``calc_spike``, 结果与逐步计算完全一致;
+    反向只保存每一步发放前的膜电位, 代理梯度在反向传播时按步重新计算,
+    避免计算图中保留T份膜电位以及代理函数的中间变量
+    """
+
+    @staticmethod
+    def forward(ctx, inputs, node):
+        mems, spikes = [], []
+        for t in range(inputs.shape[0]):
+            node.integral(inputs[t])
+            mems.append(node.mem)
+            node.calc_spike()
+            spikes.append(node.spike)
+        ctx.node = node
+        ctx.save_for_backward(torch.stack(mems))
+        return torch.stack(spikes)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_spikes):
+        mems, = ctx.saved_tensors
+        node = ctx.node
+        thres = node.get_thres().detach()
+        grad_inputs = torch.empty_like(mems)
+        grad_mem = None
+        for t in reversed(range(mems.shape[0])):
+            with torch.enable_grad():
+                mem = mems[t].detach().requires_grad_()
+                spike = node.act_fun(mem - thres)
+            grad_h, = torch.autograd.grad(spike, mem, grad_spikes[t])
+            if grad_mem is not None:
+                grad_h = grad_h + grad_mem * (1 - spike.detach())
+            grad_inputs[t], grad_mem = node.integral_grad(grad_h)
+            if node.mem_detach:
+                grad_mem = None
+        return grad_inputs, None
+
+
+class PackedSpikeRecorder(object):
+    """
+    以按位压缩的形式记录每个时间步的脉冲, 可以代替 ``feature_map`` 中的 list 使用
+    脉冲被压缩为 uint8 写入预分配的缓冲区, 只在读取时解压, 占用的内存约为 float 的 1/32
+    只适用于输出为 {0, 1} 的神经元, 记录的脉冲不保留梯度
+    :param capacity: 预分配的时间步数量, 不足时自动扩容
+    """
+
+    def __init__(self, capacity=8):
+        self.capacity = max(int(capacity), 1)
+        self.buffer = None
+        self.length = 0
+        self.shape = None
+        self.dtype = None
+        self.nbytes = 0
+        self.nonbinary = None
+
+    def _allocate(self, spike):
+        self.shape = spike.shape
+        self.dtype = spike.dtype
+        self.nbytes = (spike.numel() + 7) // 8
+        if self.buffer is None or self.buffer.shape[1] < self.nbytes or self.buffer.device != spike.device:
+            self.buffer = torch.empty(self.capacity, self.nbytes, dtype=torch.uint8, device=spike.device)
+
+    def append(self, spike):
+        spike = spike.detach()
+        if self.length == 0:
+            self._allocate(spike)
+        elif spike.shape != self.shape:
+            raise ValueError('spike shape {} does not match recorded shape {}'.format(spike.shape, self.shape))
+        if self.length == self.buffer.shape[0]:
+            buffer = torch.empty(2 * self.buffer.shape[0], self.buffer.shape[1],
+                                 dtype=torch.uint8, device=self.buffer.device)
+            buffer[:self.length] = self.buffer
+            self.buffer = buffer
+        self.buffer[self.length, :self.nbytes] = pack_mask(spike != 0)
+        # 在设备上累积是否出现非二值的输出, 只在读取时同步一次
+        nonbinary = ((spike != 0) & (spike != 1)).any()
+        self.nonbinary = nonbinary if self.nonbinary is None else self.nonbinary | nonbinary
+        self.length += 1
+
+    def extend(self, spikes):
+        for spike in spikes:
+            self.append(spike)
+
+    def clear(self):
+        """
+        清空记录, 保留已分配的缓冲区以便复用
+        """
+        self.length = 0
+        self.nonbinary = None
+
+    def _check(self):
+        if self.nonbinary is not None and bool(self.nonbinary):
+            raise ValueError('PackedSpikeRecorder can only record binary spikes')
+
+    def _unpack(self, idx):
+        return unpack_mask(self.buffer[idx, :self.nbytes], self.shape).to(self.dtype)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError('PackedSpikeRecorder index out of range')
+        self._check()
+        return self._unpack(idx)
+
+    def __iter__(self):
+        self._check()
+        for i in range(self.length):
+            yield self._unpack(i)
+
+    def memory(self):
+        """
+        :return: 当前缓冲区占用的字节数
+        """
+        return 0 if self.buffer is None else self.buffer.numel()
+
+
+class SpikeCounter(object):
+    """
+    在设备上流式地统计神经元的脉冲, 用于代替记录完整的 ``feature_map`` 再计算 fire-rate 和脉冲数量
+    两次 ``n_reset`` 之间为一个窗口, 窗口内只保留逐元素的脉冲计数, 窗口结束时折叠到累计量中
+    所有的累计量都是设备上的 tensor, 只在读取时同步
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        清空所有的累计量
+        """
+        self.count = None
+        self.windows = 0
+        self.samples = 0
+        self.numel = 0
+        self.fired = None
+        self.total = None
+
+    def update(self, spike):
+        """
+        记录一个时间步的脉冲
+        :param spike: 当前时间步的输出
+        """
+        spike = spike.detach()
+        self.count = spike.clone() if self.count is None else self.count + spike
+
+    def commit(self):
+        """
+        结束当前窗口, 将其统计量折叠到累计量中
+        """
+        if self.count is None:
+            return
+        count = self.count.float()
+        # 发放过脉冲的元素个数, 读取时除以元素总数, 即按元素个数加权平均每个窗口的fire-rate
+        fired = (count > 0.).float().sum()
+        total = count.sum()
+        if self.windows == 0:
+            self.fired, self.total = fired, total
+        else:
+            self.fired = self.fired + fired
+            self.total = self.total + total
+
+        self.windows += 1
+        self.samples += count.shape[0] if count.dim() > 0 else 1
+        self.numel += count.numel()
+        self.count = None
+
+
 class BaseNode(nn.Module, abc.ABC):
     """
     神经元模型的基类
@@ -35,6 +212,9 @@ class BaseNode(nn.Module, abc.ABC):
     :param layer_by_layer: 是否以一次性计算所有step的输出, 在网络模型较大的情况下, 一般会缩短单次推理的时间, 默认为 ``False``
     :param n_groups: 在不同的时间步, 是否使用不同的权重, 默认为 ``1``, 即不分组
     :param mem_detach: 是否将上一时刻的膜电位在计算图中截断
+    :param fp_packed: 是否以按位压缩的形式记录 ``feature_map``, 见 ``PackedSpikeRecorder``, 默认为 ``False``
+    :param fused_step: 在 ``layer_by_layer`` 模式下是否使用融合的多步计算, 反向只保存每步的膜电位, 仅对支持的神经元生效, 默认为 ``False``
+    :param requires_spike_count: 是否在推理过程中流式地统计脉冲数量, 见 ``SpikeCounter``, 不需要保存feature map, 默认为 ``False``
     :param args: 其他的参数
     :param kwargs: 其他的参数
     """
@@ -58,7 +238,8 @@ class BaseNode(nn.Module, abc.ABC):
         self.mem = 0.
         self.spike = 0.
         self.dt = dt
-        self.feature_map = []
+        self.fp_packed = kwargs['fp_packed'] if 'fp_packed' in kwargs else False
+        self.feature_map = PackedSpikeRecorder(step) if self.fp_packed else []
         self.mem_collect = []
         self.requires_fp = requires_fp
         self.v_reset = v_reset
@@ -67,6 +248,9 @@ class BaseNode(nn.Module, abc.ABC):
         self.groups = n_groups
         self.mem_detach = kwargs['mem_detach'] if 'mem_detach' in kwargs else False
         self.requires_mem = kwargs['requires_mem'] if 'requires_mem' in kwargs else False
+        self.fused_step = kwargs['fused_step'] if 'fused_step' in kwargs else False
+        self.requires_spike_count = kwargs['requires_spike_count'] if 'requires_spike_count' in kwargs else False
+        self.spike_counter = SpikeCounter()
 
     @abc.abstractmethod
     def calc_spike(self):
@@ -90,6 +274,30 @@ class BaseNode(nn.Module, abc.ABC):
     def get_thres(self):
         return self.threshold if not self.sigmoid_thres else self.threshold.sigmoid()
 
+    def supports_fused_step(self):
+        """
+        是否支持 ``MultiStepNodeFunction`` 的融合多步计算, 需要子类实现 ``integral_grad``
+        :return: bool
+        """
+        return False
+
+    def integral_grad(self, grad_mem):
+        """
+        ``integral`` 的反向过程
+        :param grad_mem: 对当前时刻发放前膜电位的梯度
+        :return: (对输入的梯度, 对上一时刻膜电位的梯度)
+        """
+        raise NotImplementedError
+
+    def use_fused_step(self):
+        if not self.fused_step or not self.supports_fused_step():
+            return False
+        if self.requires_mem or self.threshold.requires_grad:
+            return False
+        if any(p.requires_grad for p in self.act_fun.parameters()):
+            return False
+        return not (isinstance(self.mem, torch.Tensor) and self.mem.requires_grad)
+
     def rearrange2node(self, inputs):
         if self.groups != 1:
             if len(inputs.shape) == 4:
@@ -157,11 +365,26 @@ class BaseNode(nn.Module, abc.ABC):
 
             if self.requires_fp is True:
                 self.feature_map.append(self.spike)
+            if self.requires_spike_count is True:
+                self.spike_counter.update(self.spike)
             if self.requires_mem is True:
                 self.mem_collect.append(self.mem)
 
             return self.rearrange2op(self.spike)
 
+        elif (self.layer_by_layer or self.groups != 1) and self.use_fused_step():
+            inputs = self.rearrange2node(inputs)
+
+            outputs = MultiStepNodeFunction.apply(inputs, self)
+            self.spike = outputs[-1]
+            if self.requires_fp is True:
+                self.feature_map.extend(outputs.unbind(0))
+            if self.requires_spike_count is True:
+                for spike in outputs.unbind(0):
+                    self.spike_counter.update(spike)
+
+            return self.rearrange2op(outputs)
+
         elif self.layer_by_layer or self.groups != 1:
             inputs = self.rearrange2node(inputs)
 
@@ -177,6 +400,8 @@ class BaseNode(nn.Module, abc.ABC):
                 
                 if self.requires_fp is True:
                     self.feature_map.append(self.spike)
+                if self.requires_spike_count is True:
+                    self.spike_counter.update(self.spike)
                 if self.requires_mem is True:
                     self.mem_collect.append(self.mem)
                 outputs.append(self.spike)
@@ -192,6 +417,8 @@ class BaseNode(nn.Module, abc.ABC):
             self.calc_spike()
             if self.requires_fp is True:
                 self.feature_map.append(self.spike)
+            if self.requires_spike_count is True:
+                self.spike_counter.update(self.spike)
             if self.requires_mem is True:
                 self.mem_collect.append(self.mem)   
             return self.spike
@@ -203,8 +430,33 @@ class BaseNode(nn.Module, abc.ABC):
         """
         self.mem = self.v_reset
         self.spike = 0.
-        self.feature_map = []
+        self.reset_feature_map()
+        self.spike_counter.commit()
         self.mem_collect = []
+
+    def reset_feature_map(self):
+        if self.fp_packed:
+            self.feature_map.clear()
+        else:
+            self.feature_map = []
+
+    def set_n_spike_count(self, flag):
+        """
+        设置是否流式地统计脉冲数量
+        :param flag: True: 每个时间步更新 ``self.spike_counter``
+        :return: None
+        """
+        self.requires_spike_count = flag
+
+    def set_n_fp_packed(self, flag):
+        """
+        设置是否以按位压缩的形式记录 ``feature_map``
+        :param flag: True: 使用 ``PackedSpikeRecorder``, False: 使用 list
+        :return: None
+        """
+        self.fp_packed = flag
+        self.feature_map = PackedSpikeRecorder(self.step) if flag else []
+
     def get_n_attr(self, attr):
 
         if hasattr(self, attr):
@@ -368,6 +620,8 @@ class ReLUNode(BaseNode):
         self.spike = self.act_fun(x)
         if self.requires_fp is True:
             self.feature_map.append(self.spike)
+        if self.requires_spike_count is True:
+            self.spike_counter.update(self.spike)
         if self.requires_mem is True:
             self.mem_collect.append(self.mem)
         return self.spike
@@ -435,6 +689,12 @@ class IFNode(BaseNode):
         self.spike = self.act_fun(self.mem - self.get_thres())
         self.mem = self.mem * (1 - self.spike.detach())
 
+    def supports_fused_step(self):
+        return type(self).integral is IFNode.integral and type(self).calc_spike is IFNode.calc_spike
+
+    def integral_grad(self, grad_mem):
+        return grad_mem * self.dt, grad_mem
+
 
 class LIFNode(BaseNode):
     """
@@ -471,6 +731,13 @@ class LIFNode(BaseNode):
         self.spike = self.act_fun(self.mem - self.threshold)
         self.mem = self.mem * (1 - self.spike.detach())
 
+    def supports_fused_step(self):
+        return type(self).integral is LIFNode.integral and type(self).calc_spike is LIFNode.calc_spike \
+               and not self.sigmoid_thres
+
+    def integral_grad(self, grad_mem):
+        return grad_mem / self.tau, grad_mem - grad_mem / self.tau
+
 
 class BurstLIFNode(LIFNode):
     def __init__(self, threshold=.5, tau=2., act_fun=RoundGrad, *args, **kwargs):
@@ -535,7 +802,8 @@ class BackEINode(BaseNode):
     def n_reset(self):
         self.mem = None
         self.spike = None
-        self.feature_map = []
+        self.reset_feature_map()
+        self.spike_counter.commit()
         self.mem_collect = []
 
 
@@ -1,7 +1,11 @@
 from .datasets import build_transform, build_dataset, get_mnist_data, get_fashion_data, \
     get_cifar10_data, get_cifar100_data, get_imnet_data, get_dvsg_data, get_dvsc10_data, \
     get_NCALTECH101_data, get_NCARS_data, get_nomni_data, get_bullyingdvs_data
-from .utils import rescale, dvs_channel_check_expend
+from .utils import rescale, dvs_channel_check_expend, ResumableSampler, make_resumable_loader
+from .prefetcher import MultiModalPrefetcher
+from .event_store import EventStore, EventFrameDataset, events_to_frames
+from .cut_mix import BatchMix, BatchMixUp, BatchCutMix, BatchEventMix, BatchMixCompose
+from .manifest import FileManifest, load_manifest
 
 from .hmdb_dvs import HMDBDVS
 from .ucf101_dvs import ucf101_dvs
@@ -12,7 +16,9 @@ __all__ = [
     'build_transform', 'build_dataset',
     'get_mnist_data', 'get_fashion_data', 'get_cifar10_data', 'get_cifar100_data', 'get_imnet_data',
     'get_dvsg_data', 'get_dvsc10_data', 'get_NCALTECH101_data', 'get_NCARS_data', 'get_nomni_data',
-    'rescale', 'dvs_channel_check_expend', 'get_bullyingdvs_data'
+    'rescale', 'dvs_channel_check_expend', 'get_bullyingdvs_data', 'MultiModalPrefetcher',
+    'ResumableSampler', 'make_resumable_loader', 'EventStore', 'EventFrameDataset', 'events_to_frames',
+    'BatchMix', 'BatchMixUp', 'BatchCutMix', 'BatchEventMix', 'BatchMixCompose', 'FileManifest', 'load_manifest'
 ]
 
 
@@ -27,7 +27,7 @@ def rand_bbox_time(size, rat):
     else:
         raise Exception
 
-    cut_t = np.int(step * rat)
+    cut_t = int(step * rat)
     ct = np.random.randint(step)
     bbt1 = np.clip(ct - cut_t // 2, 0, step)
     bbt2 = np.clip(ct + cut_t // 2, 0, step)
@@ -43,8 +43,8 @@ def rand_bbox(size, rat):
         raise Exception
 
     cut_rat = np.sqrt(rat)
-    cut_w = np.int(W * cut_rat)
-    cut_h = np.int(H * cut_rat)
+    cut_w = int(W * cut_rat)
+    cut_h = int(H * cut_rat)
 
     # uniform
     cx = np.random.randint(W)
@@ -203,6 +203,154 @@ def calc_masked_lam_with_difference(x1, x2, mix, kernel_size=3):
     return (s2 * s2) / (s1 * s1 + s2 * s2)
 
 
+# batch版本: 第0维为batch, 每个样本为 [T, C, H, W], 随机数按样本依次抽取, 顺序与逐样本调用原函数相同
+def _expand(v, x):
+    return v.view(-1, *([1] * (x.dim() - 1)))
+
+
+def batch_rand_bbox(size, rat, rng=np.random):
+    """
+    :param size: [B, T, C, H, W]
+    :param rat: [B], 每个样本被替换的面积比例
+    :param rng: ``np.random`` 或 ``np.random.RandomState``
+    :return: 每个样本 ``rand_bbox`` 的 bbx1, bby1, bbx2, bby2, 均为 [B]
+    """
+    W, H = size[-2], size[-1]
+    center = np.array([(rng.randint(W), rng.randint(H)) for _ in range(size[0])], dtype=np.int64).reshape(-1, 2)
+    cut_rat = np.sqrt(rat)
+    cut_w = (W * cut_rat).astype(np.int64)
+    cut_h = (H * cut_rat).astype(np.int64)
+
+    bbx1 = np.clip(center[:, 0] - cut_w // 2, 0, W)
+    bby1 = np.clip(center[:, 1] - cut_h // 2, 0, H)
+    bbx2 = np.clip(center[:, 0] + cut_w // 2, 0, W)
+    bby2 = np.clip(center[:, 1] + cut_h // 2, 0, H)
+    return bbx1, bby1, bbx2, bby2
+
+
+def batch_box_mask(size, bbx1, bby1, bbx2, bby2, device=None):
+    """
+    :return: [B, 1, 1, H, W] 的bool mask, 与 ``img[:, :, bbx1:bbx2, bby1:bby2]`` 的区域相同
+    """
+    x = torch.arange(size[-2], device=device)
+    y = torch.arange(size[-1], device=device)
+    col = lambda v: torch.as_tensor(v, device=device).view(-1, 1)
+    in_x = (x >= col(bbx1)) & (x < col(bbx2))
+    in_y = (y >= col(bby1)) & (y < col(bby2))
+    mask = in_x.unsqueeze(2) & in_y.unsqueeze(1)
+    return mask.view(size[0], *([1] * (len(size) - 3)), size[-2], size[-1])
+
+
+def batch_GMM_mask(size, rat, n=None, rng=np.random, device=None):
+    """
+    每个样本的高斯混合 mask, 与 ``GMM_mask`` 相同
+    每个高斯在 t, x, y 上可分离, 所有样本的所有高斯用一次 einsum 求和
+    :param size: [B, T, C, H, W]
+    :param rat: [B], 每个样本被替换的比例
+    :param n: 高斯的个数, 为 None 时每个样本随机取 2~4 个
+    :return: [B, T, 1, H, W] 的bool mask
+    """
+    batch, step, height, width = size[0], size[1], size[-2], size[-1]
+    params = []
+    for _ in range(batch):
+        num = rng.randint(2, 5) if n is None else n
+        comps = []
+        for p in rng.rand(num):
+            mt, mx, my = rng.randint(0, step), rng.randint(0, height), rng.randint(0, width)
+            st = max(rng.rand(), 0.1) * step * 0.5
+            sx = max(rng.rand(), 0.1) * height * .5
+            sy = max(rng.rand(), 0.1) * width * .5
+            comps.append((p, mt, mx, my, st, sx, sy))
+        params.append(comps)
+
+    # 高斯个数不同的样本用权重为0的高斯补齐
+    table = np.ones((batch, max(len(c) for c in params), 7))
+    table[:, :, 0] = 0.
+    for i, comps in enumerate(params):
+        table[i, :len(comps)] = comps
+    pi, mt, mx, my, st, sx, sy = torch.tensor(table, dtype=torch.float32, device=device).unbind(-1)
+
+    def gauss(mean, scale, length):
+        grid = torch.arange(length, dtype=torch.float32, device=device)
+        return torch.exp(-((grid - mean.unsqueeze(-1)) ** 2) / (scale.unsqueeze(-1) ** 2) / 2)
+
+    mask = torch.einsum('bn,bnt,bnx,bny->btxy', pi, gauss(mt, st, step), gauss(mx, sx, height), gauss(my, sy, width))
+
+    flat = mask.flatten(1)
+    idx = (flat.shape[1] * np.asarray(rat)).astype(np.int64)
+    idx = torch.as_tensor((idx - 1) % flat.shape[1], device=flat.device).view(-1, 1)
+    val = flat.sort(dim=1)[0].gather(1, idx)
+    mask = flat > val
+    return mask.view(batch, step, *([1] * (len(size) - 4)), height, width)
+
+
+def batch_st_mask(size, rat, rng=np.random, device=None):
+    """
+    每个样本的时空 mask, 与 ``st_mask`` 相同, 空间部分的频谱与原函数一样由 ``torch.rand`` 生成
+    :param size: [B, T, C, H, W]
+    :param rat: [B], 每个样本被替换的比例
+    :return: [B, T, 1, H, W] 的bool mask
+    """
+    batch, step, height, width = size[0], size[1], size[-2], size[-1]
+    spectrum, wh_rat, bbt1, bbt2 = [], [], [], []
+    for r in rat:
+        temporal_rat = rng.uniform(r, 1.)
+        wh_rat.append(r / temporal_rat)
+        cut_t = int(step * temporal_rat)
+        ct = rng.randint(step)
+        bbt1.append(np.clip(ct - cut_t // 2, 0, step))
+        bbt2.append(np.clip(ct + cut_t // 2, 0, step))
+        x = torch.rand(2, 2)
+        y = torch.rand(2, 2)
+        f = torch.zeros(height, width, dtype=torch.complex64)
+        f[[[0, -1], [-1, -1]], [[0, -1], [0, -1]]] = x + y * 1.j
+        spectrum.append(f)
+
+    mask = torch.fft.ifftn(torch.stack(spectrum).to(device), dim=(-2, -1)).real.flatten(1)
+    idx = np.minimum((height * width * np.asarray(wh_rat)).astype(np.int64), height * width - 1)
+    val = mask.sort(dim=1)[0].gather(1, torch.as_tensor(idx, device=mask.device).view(-1, 1))
+    mask = (mask < val).view(batch, 1, height, width)
+
+    t = torch.arange(step, device=mask.device)
+    in_t = (t >= torch.as_tensor(np.array(bbt1), device=mask.device).view(-1, 1)) & \
+           (t < torch.as_tensor(np.array(bbt2), device=mask.device).view(-1, 1))
+    mask = mask & in_t.view(batch, step, 1, 1)
+    return mask.view(batch, step, *([1] * (len(size) - 4)), height, width)
+
+
+def batch_masked_lam(x1, x2, mask):
+    """
+    每个样本的 ``calc_masked_lam``, 按事件数计算 lam
+    :return: [B]
+    """
+    dims = tuple(range(1, x1.dim()))
+    mask = mask.to(x1.dtype)
+    x1_rat = (x1 * mask).sum(dims) / x1.sum(dims)
+    x2_rat = (x2 * mask).sum(dims) / x2.sum(dims)
+    return 1. - (x2_rat / (1. - x1_rat + x2_rat))
+
+
+def batch_event_difference(x1, x2, kernel_size=3):
+    """
+    每个样本的 ``event_difference``
+    :return: [B]
+    """
+    batch, padding = x1.shape[0], kernel_size // 2
+    x1 = F.avg_pool2d(x1.reshape(-1, *x1.shape[-3:]), kernel_size=kernel_size, stride=1, padding=padding)
+    x2 = F.avg_pool2d(x2.reshape(-1, *x2.shape[-3:]), kernel_size=kernel_size, stride=1, padding=padding)
+    return (x1 - x2).pow(2).view(batch, -1).mean(1)
+
+
+def batch_masked_lam_with_difference(x1, x2, mix, kernel_size=3):
+    """
+    每个样本的 ``calc_masked_lam_with_difference``, 按混合前后事件分布的差异计算 lam
+    :return: [B]
+    """
+    s1 = batch_event_difference(x1, mix, kernel_size=kernel_size)
+    s2 = batch_event_difference(x2, mix, kernel_size=kernel_size)
+    return (s2 * s2) / (s1 * s1 + s2 * s2)
+
+
 class MixUp(Dataset):
     def __init__(self, dataset, num_class, num_mix=1, beta=1., prob=1.0, indices=None, noise=0.0, vis=False, **kwargs):
         self.dataset = dataset
@@ -421,6 +569,147 @@ class EventMix(Dataset):
         return len(self.dataset)
 
 
+class BatchMix(object):
+    """
+    batch级别的混合, 代替 ``MixUp``, ``CutMix``, ``EventMix`` 等在 ``__getitem__`` 中额外读取 num_mix 个样本的包装
+    混合的样本在collate之后的同一个batch中随机选取, 不产生额外的读取, 可以在主进程或GPU上对整个batch进行
+    每个样本以 prob 的概率混合 num_mix 次, 每次的 lam 取自 Beta(beta, beta), 标签与原来一样混合为
+    ``lb * lam + lb2 * (1 - lam)``, 混合的样本 (及其标签) 取自混合之前的batch
+    :param num_class: 类别数
+    :param num_mix: 每个样本混合的次数
+    :param beta: Beta分布的参数, <= 0 时不混合
+    :param prob: 每次混合的概率
+    :param noise: 混合之后的椒盐噪声, 与 ``SaltAndPepperNoise`` 相同
+    :param seed: 随机数种子, 为 None 时使用 ``np.random`` 的全局状态
+    """
+
+    def __init__(self, num_class, num_mix=1, beta=1., prob=1.0, noise=0.0, seed=None, **kwargs):
+        assert 0 <= noise <= 0.3
+        self.num_class = num_class
+        self.num_mix = num_mix
+        self.beta = beta
+        self.prob = prob
+        self.noise = noise
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+        self.mixup_enabled = True
+
+    def onehot(self, target):
+        if target.dim() == 1:
+            return F.one_hot(target.long(), self.num_class).float()
+        return target.float()
+
+    def mix(self, x, x2, lam):
+        """
+        :param x: [B, T, C, H, W], 当前的batch
+        :param x2: 与 x 逐样本混合的样本
+        :param lam: [B] 的 numpy 数组, 从 Beta 分布中抽取的 lam
+        :return: 混合之后的batch和实际的 lam ([B] 的tensor)
+        """
+        raise NotImplementedError
+
+    def __call__(self, inputs, target):
+        """
+        :param inputs: [B, T, C, H, W]
+        :param target: [B] 的类别或 [B, num_class] 的软标签
+        :return: 混合之后的 inputs 和 [B, num_class] 的软标签
+        """
+        assert torch.is_tensor(inputs), 'batch level mixing needs a single tensor input'
+        lb = self.onehot(target)
+        if not self.mixup_enabled or self.beta <= 0:
+            return inputs, lb
+
+        batch = len(lb)
+        origin, origin_lb = inputs, lb
+        for _ in range(self.num_mix):
+            active = torch.as_tensor(self.rng.rand(batch) <= self.prob, device=inputs.device)
+            lam = self.rng.beta(self.beta, self.beta, size=batch)
+            index = torch.as_tensor(self.rng.randint(batch, size=batch), device=inputs.device)
+
+            mixed, lam = self.mix(inputs, origin[index], lam)
+            if self.noise != 0.:
+                v = torch.as_tensor(self.rng.uniform(0, self.noise, size=batch), dtype=mixed.dtype, device=mixed.device)
+                mixed = mixed + (torch.rand_like(mixed) <= _expand(v, mixed)).to(mixed.dtype)
+            lam = lam.to(lb).view(-1, 1)
+
+            inputs = torch.where(_expand(active, mixed), mixed, inputs.to(mixed.dtype))
+            lb = torch.where(active.view(-1, 1), lb * lam + origin_lb[index] * (1. - lam), lb)
+        return inputs, lb
+
+
+class BatchMixUp(BatchMix):
+    """
+    batch级别的 ``MixUp``
+    """
+
+    def mix(self, x, x2, lam):
+        lam = torch.as_tensor(lam, dtype=torch.float32, device=x.device)
+        return x * _expand(lam, x) + x2 * (1. - _expand(lam, x)), lam
+
+
+class BatchCutMix(BatchMix):
+    """
+    batch级别的 ``CutMix``, 每个样本各自的矩形框, lam 按面积计算
+    """
+
+    def mix(self, x, x2, lam):
+        bbx1, bby1, bbx2, bby2 = batch_rand_bbox(x.shape, 1. - lam, self.rng)
+        lam = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (x.shape[-1] * x.shape[-2]))  # area
+        mask = batch_box_mask(x.shape, bbx1, bby1, bbx2, bby2, device=x.device)
+        return torch.where(mask, x2, x), torch.as_tensor(lam, dtype=torch.float32, device=x.device)
+
+
+class BatchEventMix(BatchMix):
+    """
+    batch级别的 ``EventMix``
+    :param gaussian_n: 高斯混合 mask 中高斯的个数
+    :param mask_type: ``gmm`` 为 ``GMM_mask``, ``st`` 为 ``st_mask``
+    :param lam_mode: ``count`` 按 mask 中的事件数 (``calc_masked_lam``), ``area`` 按 mask 的体积,
+        ``difference`` 按混合前后事件分布的差异 (``calc_masked_lam_with_difference``)
+    :param kernel_size: ``difference`` 时的平均池化大小
+    """
+
+    def __init__(self, num_class, num_mix=1, beta=1., prob=1.0, noise=0.1, seed=None,
+                 gaussian_n=None, mask_type='gmm', lam_mode='count', kernel_size=3, **kwargs):
+        super(BatchEventMix, self).__init__(num_class, num_mix=num_mix, beta=beta, prob=prob, noise=noise, seed=seed)
+        assert mask_type in ('gmm', 'st') and lam_mode in ('count', 'area', 'difference')
+        self.gaussian_n = gaussian_n
+        self.mask_type = mask_type
+        self.lam_mode = lam_mode
+        self.kernel_size = kernel_size
+
+    def mix(self, x, x2, lam):
+        if self.mask_type == 'gmm':
+            mask = batch_GMM_mask(x.shape, 1. - lam, self.gaussian_n, self.rng, device=x.device)
+        else:
+            mask = batch_st_mask(x.shape, 1. - lam, self.rng, device=x.device)
+        mixed = torch.where(mask, x2, x)
+
+        if self.lam_mode == 'count':
+            lam = batch_masked_lam(x, x2, mask)
+        elif self.lam_mode == 'area':
+            lam = 1. - mask.expand_as(x).flatten(1).float().mean(1)
+        else:
+            lam = batch_masked_lam_with_difference(x.float(), x2.float(), mixed.float(), kernel_size=self.kernel_size)
+        return mixed, lam
+
+
+class BatchMixCompose(object):
+    """
+    依次进行多种batch级别的混合, 顺序与 datasets 中包装 ``CutMix``, ``EventMix``, ``MixUp`` 的顺序相同
+    """
+
+    def __init__(self, mixes):
+        self.mixes = mixes
+        self.mixup_enabled = True
+
+    def __call__(self, inputs, target):
+        if not self.mixup_enabled:
+            return inputs, self.mixes[0].onehot(target)
+        for mix in self.mixes:
+            inputs, target = mix(inputs, target)
+        return inputs, target
+
+
 if __name__ == '__main__':
     import matplotlib.pyplot as plt
     from mpl_toolkits.mplot3d import Axes3D
@@ -34,11 +34,13 @@ from braincog.datasets.StanfordDogs import StanfordDogs
 from braincog.datasets.bullying10k import BULLYINGDVS
 from braincog.datasets.time_conut import TimeCounter
 
-from braincog.datasets.cut_mix import CutMix, EventMix, MixUp
+from braincog.datasets.cut_mix import CutMix, EventMix, MixUp, BatchCutMix, BatchEventMix, BatchMixUp, BatchMixCompose
+from braincog.datasets.event_store import EventStore, EventFrameDataset, EventCollate
+from braincog.datasets.manifest import FileManifest, load_manifest
 from braincog.datasets.rand_aug import *
 from braincog.datasets.utils import dvs_channel_check_expend, rescale
 
-from torch.utils.data import ConcatDataset, Subset
+from torch.utils.data import ConcatDataset
 from collections import defaultdict
 
 DVSCIFAR10_MEAN_16 = [0.3290, 0.4507]
@@ -106,6 +108,30 @@ class MyAVDataSet(torchvision.datasets.VisionDataset):
         return self.length
 
 
+class EventSubset(torch.utils.data.Dataset):
+    """
+    与 ``Subset(ConcatDataset(datasets), indices)`` 相同, 但和 tonic 数据集一样在读出原始事件之后才应用 ``transform``
+    因此可以交给 ``frame_dataset``, ``EventStore.build`` 把 ``transform`` 置为 ``None`` 读取原始事件
+    :param datasets: transform 为 ``None`` 的 tonic 数据集
+    :param indices: 拼接之后的索引
+    :param transform: 事件的变换, 如 ``ToFrame``
+    """
+
+    def __init__(self, datasets, indices, transform=None):
+        self.dataset = ConcatDataset(datasets)
+        self.indices = indices
+        self.transform = transform
+
+    def __getitem__(self, idx):
+        events, target = self.dataset[self.indices[idx]]
+        if self.transform is not None:
+            events = self.transform(events)
+        return events, target
+
+    def __len__(self):
+        return len(self.indices)
+
+
 def unpack_mix_param(args):
     mix_up = args['mix_up'] if 'mix_up' in args else False
     cut_mix = args['cut_mix'] if 'cut_mix' in args else False
@@ -119,6 +145,68 @@ def unpack_mix_param(args):
     return mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n
 
 
+def batch_mix_fn(**kwargs):
+    """
+    与 ``unpack_mix_param`` 相同的参数, 构建batch级别的 ``CutMix``, ``EventMix``, ``MixUp``
+    在训练循环中对每个batch调用, 代替包装在训练集外, 每个样本额外读取 num 个样本的混合
+    :return: ``(inputs, target) -> (inputs, soft target)`` 的混合, 没有启用任何混合时为 None
+    """
+    mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
+    mixes = []
+    if cut_mix:
+        mixes.append(BatchCutMix(num_classes, num_mix=num, beta=beta, prob=prob, noise=noise))
+    if event_mix:
+        mixes.append(BatchEventMix(num_classes, num_mix=num, beta=beta, prob=prob, noise=noise, gaussian_n=gaussian_n))
+    if mix_up:
+        mixes.append(BatchMixUp(num_classes, num_mix=num, beta=beta, prob=prob, noise=noise))
+    if not mixes:
+        return None
+    return mixes[0] if len(mixes) == 1 else BatchMixCompose(mixes)
+
+
+def cache_root(kwargs, root=DATA_DIR):
+    """
+    ``DiskCachedDataset`` 缓存和事件存储的根目录, 依次取 ``cache_root`` 参数 (训练脚本的 --cache-root),
+    环境变量 ``BRAINCOG_CACHE_DIR``, 数据集的 root
+    :param kwargs: get_*_data 的 kwargs
+    :param root: 数据集的根目录
+    :return: 根目录
+    """
+    cache = kwargs['cache_root'] if 'cache_root' in kwargs else None
+    return cache or os.environ.get('BRAINCOG_CACHE_DIR') or root
+
+
+def frame_dataset(dataset, sensor_size, step, cache_path, store_path, transform=None, num_copies=1, **kwargs):
+    """
+    DVS数据集经过 ``ToFrame(n_time_bins=step)`` 之后的缓存
+    ``event_store=True`` 时原始事件只在 store_path 中存储一次, 每个 step 的帧第一次使用时从中分出并缓存在存储目录中,
+    否则与原来一样使用每个 step 各自的 ``DiskCachedDataset``
+    ``event_batch=True`` 时 (需要 event_store) worker 只传紧凑的事件, 返回的dataset带有 ``collate_fn``,
+    由主进程调用 ``collate_fn.to_frames`` 对整个batch分帧
+    :param dataset: transform 为 ``ToFrame`` 的 tonic 数据集
+    :param sensor_size: ``ToFrame`` 的 sensor_size
+    :param step: 仿真步长
+    :param cache_path: ``DiskCachedDataset`` 的缓存路径
+    :param store_path: 与 step 无关的事件存储的路径
+    :param transform: 分帧之后的变换
+    :param num_copies: ``DiskCachedDataset`` 的 num_copies
+    :return: dataset
+    """
+    event_store = kwargs['event_store'] if 'event_store' in kwargs else False
+    event_batch = kwargs['event_batch'] if 'event_batch' in kwargs else False
+    if event_batch:
+        assert event_store, 'event_batch needs event_store'
+        mix_up, cut_mix, event_mix = unpack_mix_param(kwargs)[:3]
+        assert not (mix_up or cut_mix or event_mix), 'event_batch does not support dataset level mixing'
+        dataset = EventFrameDataset(EventStore.build(dataset, store_path), sensor_size, None)
+        dataset.collate_fn = EventCollate(sensor_size, step, transform=transform)
+        return dataset
+    if event_store:
+        return EventFrameDataset(EventStore.build(dataset, store_path), sensor_size, step, transform=transform,
+                                 cache=True)
+    return DiskCachedDataset(dataset, cache_path=cache_path, transform=transform, num_copies=num_copies)
+
+
 def build_transform(is_train, img_size):
     """
     构建数据增强, 适用于static data
@@ -321,21 +409,25 @@ def get_mnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
         lambda x: F.interpolate(x, size=[size, size], mode='bilinear', align_corners=True),
     ])
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(DATA_DIR, 'DVS/MNIST_DVS/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(DATA_DIR, 'DVS/MNIST_DVS/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/train_events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/test_events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=8,
         shuffle=True,
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=4,
         shuffle=False,
     )
@@ -401,13 +493,48 @@ def get_cifar10_data(batch_size, num_workers=8, same_da=False, root=DATA_DIR, **
     return train_loader, test_loader, None, None
 
 
+def manifest_file(name, **kwargs):
+    """
+    :param name: 清单的文件名
+    :return: ``manifest_dir`` 中清单的路径, 没有设置 ``manifest_dir`` 时为 None, 每次都扫描文件系统
+    """
+    manifest_dir = kwargs['manifest_dir'] if 'manifest_dir' in kwargs else None
+    return os.path.join(manifest_dir, name) if manifest_dir else None
+
+
+def walk_manifest(file_path, class_names, manifest=None, suffix='jpg'):
+    """
+    按类别目录组织的数据集的文件清单, 与原来的 os.walk 扫描结果 (顺序, 标签) 相同
+    os.walk 经过的目录都记录在 watch 中, 增加或删除文件之后重新扫描
+    :param file_path: 根目录, 其中的每个子目录为一个类别
+    :param class_names: {类别目录名: 标签}
+    :param manifest: 清单的路径, 为 None 时不使用清单
+    :param suffix: 样本文件的后缀
+    :return: FileManifest
+    """
+
+    def build():
+        data, targets, dirs = [], [], []
+        for path, subdirs, files in os.walk(file_path):
+            subdirs.sort()
+            dirs.append(path)
+            for file in files:
+                if file.endswith(suffix):
+                    data.append(path + "/" + file)
+                    targets.append(class_names[os.path.basename(path)])
+        return FileManifest(data, targets, watch=dirs)
+
+    return load_manifest(manifest, ('walk', file_path, sorted(class_names.items()), suffix), build)
+
+
 class UrbanSound8KDataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, class_names, modality, visual_transform=None, audio_transform=None):
+    def __init__(self, file_path, class_names, modality, visual_transform=None, audio_transform=None, manifest=None):
         """
         Args:
             file_path (str): 数据集根目录路径
             class_names (list): 类别名称列表
             transform (callable, optional): 变换操作（如数据增强）
+            manifest (str, optional): 文件清单的路径, 只在第一次或文件变化之后扫描目录
         """
         self.file_path = file_path
         self.class_names = class_names
@@ -419,13 +546,8 @@ class UrbanSound8KDataset(torch.utils.data.Dataset):
 
         self.file_path = os.path.join(self.file_path, "Dataset_v3_vision/")
 
-        for path, dirs, files in os.walk(self.file_path):
-            dirs.sort()
-            for file in files:
-                if file.endswith("jpg"):
-                    self.data.append(path + "/" + file)
-                    label_number = class_names[os.path.basename(path)]
-                    self.targets.append(label_number)
+        manifest = walk_manifest(self.file_path, class_names, manifest)
+        self.data, self.targets = manifest.paths, manifest.labels
 
     def __len__(self):
         return len(self.data)
@@ -513,10 +635,12 @@ def get_UrbanSound8K_data(batch_size, num_workers=8, same_da=False, root=DATA_DI
     ])
 
     # 创建数据集实例，传入不同的transform
+    # 训练集和测试集扫描的是同一个目录, 共用一个清单
+    manifest = manifest_file('UrbanSound8K.pkl', **kwargs)
     train_dataset = UrbanSound8KDataset(file_path, class_names, visual_transform=visual_train_transform,
-                                        audio_transform=audio_train_transform, modality=modality)
+                                        audio_transform=audio_train_transform, modality=modality, manifest=manifest)
     test_dataset = UrbanSound8KDataset(file_path, class_names, visual_transform=visual_test_transform,
-                                       audio_transform=audio_test_transform, modality=modality)
+                                       audio_transform=audio_test_transform, modality=modality, manifest=manifest)
 
     indices_train = []
     indices_test = []
@@ -533,7 +657,7 @@ def get_UrbanSound8K_data(batch_size, num_workers=8, same_da=False, root=DATA_DI
         indices_test.extend(list(range(round(cnt_now + class_counts[i] * portion), cnt_now + class_counts[i])))
         cnt_now += class_counts[i]
 
-    DIR = '/home/hexiang/data/'
+    DIR = cache_root(kwargs)
 
     train_dataset = DiskCachedDataset(train_dataset,
                                       cache_path=os.path.join(DIR, 'UrbanSound8K-AV/{}/train_cache_{}'.format(modality,
@@ -597,21 +721,10 @@ def get_AVmnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
         cnt_now_test += class_counts_test[i]
 
     # ------------visual-----------#
-    train_transform = transforms.Compose([
-        # tonic.transforms.Denoise(filter_time=10000),
-        # tonic.transforms.DropEvent(p=0.1),
-        tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step),
-    ])
-    test_transform = transforms.Compose([
-        # tonic.transforms.Denoise(filter_time=10000),
-        tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step),
-    ])
+    # 在原始事件上划分训练集和测试集, 之后由 frame_dataset 分帧, 与其它DVS数据集一样支持 --event-store
+    visual_train_dataset = tonic.datasets.MNISTDVS(os.path.join(DATA_DIR, 'DVS/MNIST_DVS/'), train=True)
 
-    visual_train_dataset = tonic.datasets.MNISTDVS(os.path.join(DATA_DIR, 'DVS/MNIST_DVS/'),
-                                                   transform=train_transform, train=True)
-
-    visual_test_dataset = tonic.datasets.MNISTDVS(os.path.join(DATA_DIR, 'DVS/MNIST_DVS/'),
-                                                  transform=test_transform, train=False)
+    visual_test_dataset = tonic.datasets.MNISTDVS(os.path.join(DATA_DIR, 'DVS/MNIST_DVS/'), train=False)
 
     # 2. 合并训练集和测试集
     full_dataset = ConcatDataset([visual_train_dataset, visual_test_dataset])
@@ -642,8 +755,10 @@ def get_AVmnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
         test_indices.extend(shuffled[500:1000])
 
     # 5. 创建新的训练集和测试集
-    visual_train_dataset = Subset(full_dataset, train_indices)
-    visual_test_dataset = Subset(full_dataset, test_indices)
+    visual_train_dataset = EventSubset(full_dataset.datasets, train_indices,
+                                       transform=tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step))
+    visual_test_dataset = EventSubset(full_dataset.datasets, test_indices,
+                                      transform=tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step))
 
     MNIST_MEAN = 0.1307
     MNIST_STD = 0.3081
@@ -662,25 +777,30 @@ def get_AVmnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
                                                                  align_corners=True),
                                          transforms.Normalize((MNIST_MEAN,), (MNIST_STD,))])
 
-    visual_train_dataset = DiskCachedDataset(visual_train_dataset,
-                                             cache_path=os.path.join("/home/hexiang/",
-                                                                     'DVS/MNIST_DVS/train_cache_{}'.format(step)),
-                                             transform=train_transform, num_copies=3)
+    # 与 train_cache_{step} 一样, 事件存储只在相同的划分下复用
+    # 只有视觉单模态时按batch分帧, 音频和音视频的数据在下面被读入内存, 需要每个样本的帧
+    visual_kwargs = kwargs if modality == "visual" else dict(kwargs, event_batch=False)
+    visual_train_dataset = frame_dataset(visual_train_dataset, sensor_size, step,
+                                         cache_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/train_cache_{}'.format(step)),
+                                         store_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/av_train_events'),
+                                         transform=train_transform, num_copies=3, **visual_kwargs)
 
-    visual_test_dataset = DiskCachedDataset(visual_test_dataset,
-                                            cache_path=os.path.join("/home/hexiang/",
-                                                                    'DVS/MNIST_DVS/test_cache_{}'.format(step)),
-                                            transform=test_transform, num_copies=3)
+    visual_test_dataset = frame_dataset(visual_test_dataset, sensor_size, step,
+                                        cache_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/test_cache_{}'.format(step)),
+                                        store_path=os.path.join(cache_root(kwargs), 'DVS/MNIST_DVS/av_test_events'),
+                                        transform=test_transform, num_copies=3, **visual_kwargs)
 
     # 使用SubsetRandomSampler来创建训练和测试的DataLoader
     train_loader = torch.utils.data.DataLoader(
         visual_train_dataset, batch_size=batch_size,
+        collate_fn=getattr(visual_train_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_train),
         pin_memory=True, drop_last=True, num_workers=4
     )
 
     test_loader = torch.utils.data.DataLoader(
         visual_test_dataset, batch_size=batch_size,
+        collate_fn=getattr(visual_test_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_test),
         pin_memory=True, drop_last=False, num_workers=4
     )
@@ -713,15 +833,17 @@ def get_AVmnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
         lambda x: F.interpolate(x, size=(28, 28), mode='bilinear', align_corners=False)  # 插值到 (B, T, 1, 26, 26)
     ])
 
-    audio_train_dataset = DiskCachedDataset(audio_train_dataset,
-                                            cache_path=os.path.join("/home/hexiang/",
-                                                                    'DVS/NTIDIGITS/train_cache_{}'.format(step)),
-                                            transform=cached_transform, num_copies=3)
+    # 音频的帧在下面被读入内存, 不按batch分帧
+    audio_kwargs = dict(kwargs, event_batch=False)
+    audio_train_dataset = frame_dataset(audio_train_dataset, sensor_size, step,
+                                        cache_path=os.path.join(cache_root(kwargs), 'DVS/NTIDIGITS/train_cache_{}'.format(step)),
+                                        store_path=os.path.join(cache_root(kwargs), 'DVS/NTIDIGITS/train_events'),
+                                        transform=cached_transform, num_copies=3, **audio_kwargs)
 
-    audio_test_dataset = DiskCachedDataset(audio_test_dataset,
-                                           cache_path=os.path.join("/home/hexiang/",
-                                                                   'DVS/NTIDIGITS/test_cache_{}'.format(step)),
-                                           transform=cached_transform, num_copies=3)
+    audio_test_dataset = frame_dataset(audio_test_dataset, sensor_size, step,
+                                       cache_path=os.path.join(cache_root(kwargs), 'DVS/NTIDIGITS/test_cache_{}'.format(step)),
+                                       store_path=os.path.join(cache_root(kwargs), 'DVS/NTIDIGITS/test_events'),
+                                       transform=cached_transform, num_copies=3, **audio_kwargs)
 
     spec_index = [[] for i in range(10)]
     for idx, (spec, label) in enumerate(audio_train_dataset):
@@ -816,12 +938,14 @@ def get_AVmnistdvs_data(batch_size, step, dvs_da=False, **kwargs):
 
 
 class CREMADDataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, class_names, modality, train, visual_transform=None, audio_transform=None):
+    def __init__(self, file_path, class_names, modality, train, visual_transform=None, audio_transform=None,
+                 manifest=None):
         """
         Args:
             file_path (str): 数据集根目录路径
             class_names (list): 类别名称列表
             transform (callable, optional): 变换操作（如数据增强）
+            manifest (str, optional): 文件清单的路径, 只在第一次或文件变化之后扫描目录
         """
         self.file_path = file_path
         self.class_names = class_names
@@ -837,13 +961,8 @@ class CREMADDataset(torch.utils.data.Dataset):
         else:
             self.file_path = os.path.join(self.file_path, "test/visual")
 
-        for path, dirs, files in os.walk(self.file_path):
-            dirs.sort()
-            for file in files:
-                if file.endswith("jpg"):
-                    self.data.append(path + "/" + file)
-                    label_number = class_names[os.path.basename(path)]
-                    self.targets.append(label_number)
+        manifest = walk_manifest(self.file_path, class_names, manifest)
+        self.data, self.targets = manifest.paths, manifest.labels
 
     def __len__(self):
         return len(self.data)
@@ -932,9 +1051,11 @@ def get_CREMAD_data(batch_size, num_workers=8, same_da=False, root=DATA_DIR, **k
 
     # 创建数据集实例，传入不同的transform
     train_dataset = CREMADDataset(file_path, class_names, visual_transform=visual_train_transform,
-                                  audio_transform=audio_train_transform, modality=modality, train=True)
+                                  audio_transform=audio_train_transform, modality=modality, train=True,
+                                  manifest=manifest_file('CREMAD_train.pkl', **kwargs))
     test_dataset = CREMADDataset(file_path, class_names, visual_transform=visual_test_transform,
-                                 audio_transform=audio_test_transform, modality=modality, train=False)
+                                 audio_transform=audio_test_transform, modality=modality, train=False,
+                                 manifest=manifest_file('CREMAD_test.pkl', **kwargs))
 
     indices_train = []
 
@@ -956,11 +1077,11 @@ def get_CREMAD_data(batch_size, num_workers=8, same_da=False, root=DATA_DIR, **k
         cnt_now_test += class_counts_test[i]
 
     # train_dataset = DiskCachedDataset(train_dataset,
-    #                                   cache_path=os.path.join(DATA_DIR, 'CREMA-D/{}/train_cache_{}'.format(modality, args.step)),
+    #                                   cache_path=os.path.join(cache_root(kwargs), 'CREMA-D/{}/train_cache_{}'.format(modality, args.step)),
     #                                   transform=None, num_copies=3)
     #
     # test_dataset = DiskCachedDataset(test_dataset,
-    #                                   cache_path=os.path.join(DATA_DIR, 'CREMA-D/{}/test_cache_{}'.format(modality, args.step)),
+    #                                   cache_path=os.path.join(cache_root(kwargs), 'CREMA-D/{}/test_cache_{}'.format(modality, args.step)),
     #                                   transform=None, num_copies=3)
 
     # 使用SubsetRandomSampler来创建训练和测试的DataLoader
@@ -977,13 +1098,45 @@ def get_CREMAD_data(batch_size, num_workers=8, same_da=False, root=DATA_DIR, **k
     return train_loader, test_loader, None, None
 
 
+def kinetics_manifest(data_root, mode, class_names, feature, manifest=None):
+    """
+    KineticSound 的文件清单, 样本和标签与读取 my_train.txt/my_test.txt 的结果相同
+    :param data_root: 数据根路径
+    :param mode: ``train`` 或 ``test``
+    :param class_names: {类别名: 标签}
+    :param feature: ``audio`` 时路径为每个样本的wav文件, ``video`` 时为帧所在的目录
+    :param manifest: 清单的路径, 为 None 时不使用清单
+    :return: FileManifest
+    """
+    csv_file = os.path.join(data_root, 'my_train.txt' if mode == 'train' else 'my_test.txt')
+    feature_path = os.path.join(data_root, mode, feature + '/')
+    class2name = {v: k for k, v in class_names.items()}
+    suffix = '.wav' if feature == 'audio' else ''
+
+    def build():
+        paths, labels = [], []
+        with open(csv_file) as f:
+            for item in csv.reader(f):
+                vid_start_end = item[0]
+                if mode == "test":
+                    vid_start_end = vid_start_end[:11]
+                label_id = int(item[2])
+                paths.append(os.path.join(feature_path, class2name[label_id], vid_start_end + suffix))
+                labels.append(label_id)
+        watch = [csv_file] + [os.path.join(feature_path, name) for name in sorted(class_names)]
+        return FileManifest(paths, labels, watch=watch)
+
+    return load_manifest(manifest, ('kinetics', data_root, mode, feature, sorted(class_names.items())), build)
+
+
 class KineticSoundAudioDataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, class_names, train):
+    def __init__(self, file_path, class_names, train, manifest=None):
         """
         Args:
             file_path (str): 数据集根目录路径
             class_names (list): 类别名称列表
             transform (callable, optional): 变换操作（如数据增强）
+            manifest (str, optional): 文件清单的路径, 只在第一次或文件变化之后读取csv并stat每个样本
         """
 
         if train:
@@ -1004,22 +1157,13 @@ class KineticSoundAudioDataset(torch.utils.data.Dataset):
         self.train_txt = os.path.join(self.data_root, 'my_train.txt')
         self.test_txt = os.path.join(self.data_root, 'my_test.txt')
 
-        # 选择相应的 CSV 文件
-        csv_file = self.train_txt if self.mode == 'train' else self.test_txt
-
         # 读取类别信息
         self.class2name = {v: k for k, v in class_names.items()}
-        with open(csv_file) as f2:
-            csv_reader = csv.reader(f2)
-            for item in csv_reader:
-                vid_start_end = item[0]  # 视频音频标识符
-                if self.mode == "test":
-                    vid_start_end = vid_start_end[:11]
-                label_id = int(item[2])  # 类别名称
-
-                # if os.path.exists(audio_path) and os.path.exists(visual_path):
-                self.av_files.append(vid_start_end)
-                self.name2class[vid_start_end] = label_id  # 关联类别
+        manifest = kinetics_manifest(self.data_root, self.mode, class_names, 'audio', manifest)
+        for path, label_id in zip(manifest.paths, manifest.labels):
+            vid_start_end = os.path.basename(path)[:-len('.wav')]  # 视频音频标识符
+            self.av_files.append(vid_start_end)
+            self.name2class[vid_start_end] = label_id  # 关联类别
 
     def __len__(self):
         return len(self.av_files)
@@ -1045,12 +1189,13 @@ class KineticSoundAudioDataset(torch.utils.data.Dataset):
 
 
 class KineticSoundVisualDataset(torch.utils.data.Dataset):
-    def __init__(self, file_path, class_names, train):
+    def __init__(self, file_path, class_names, train, manifest=None):
         """
         Args:
             file_path (str): 数据集根目录路径
             class_names (list): 类别名称列表
             transform (callable, optional): 变换操作（如数据增强）
+            manifest (str, optional): 文件清单的路径, 只在第一次或文件变化之后读取csv并stat每个样本
         """
 
         if train:
@@ -1071,22 +1216,13 @@ class KineticSoundVisualDataset(torch.utils.data.Dataset):
         self.train_txt = os.path.join(self.data_root, 'my_train.txt')
         self.test_txt = os.path.join(self.data_root, 'my_test.txt')
 
-        # 选择相应的 CSV 文件
-        csv_file = self.train_txt if self.mode == 'train' else self.test_txt
-
         # 读取类别信息
         self.class2name = {v: k for k, v in class_names.items()}
-        with open(csv_file) as f2:
-            csv_reader = csv.reader(f2)
-            for item in csv_reader:
-                vid_start_end = item[0]  # 视频音频标识符
-                if self.mode == "test":
-                    vid_start_end = vid_start_end[:11]
-                label_id = int(item[2])  # 类别名称
-
-                # if os.path.exists(audio_path) and os.path.exists(visual_path):
-                self.av_files.append(vid_start_end)
-                self.name2class[vid_start_end] = label_id  # 关联类别
+        manifest = kinetics_manifest(self.data_root, self.mode, class_names, 'video', manifest)
+        for path, label_id in zip(manifest.paths, manifest.labels):
+            vid_start_end = os.path.basename(path)  # 视频音频标识符
+            self.av_files.append(vid_start_end)
+            self.name2class[vid_start_end] = label_id  # 关联类别
 
     def __len__(self):
         return len(self.av_files)
@@ -1189,26 +1325,30 @@ def get_KineticSound_data(batch_size, step, num_workers=8, same_da=False, root=D
     ])
 
     # 创建数据集实例，传入不同的transform
-    audio_train_dataset = KineticSoundAudioDataset(file_path, class_names, train=True)
-    audio_train_dataset = DiskCachedDataset(audio_train_dataset, cache_path=os.path.join("/mnt/home/hexiang/",
+    audio_train_dataset = KineticSoundAudioDataset(file_path, class_names, train=True,
+                                                   manifest=manifest_file('KineticSound_audio_train.pkl', **kwargs))
+    audio_train_dataset = DiskCachedDataset(audio_train_dataset, cache_path=os.path.join(cache_root(kwargs),
                                                                                          'KineticSound/audio/train_cache_{}'.format(
                                                                                              step)),
                                             transform=audio_train_transform, num_copies=1)
-    audio_test_dataset = KineticSoundAudioDataset(file_path, class_names, train=False)
-    audio_test_dataset = DiskCachedDataset(audio_test_dataset, cache_path=os.path.join("/mnt/home/hexiang/",
+    audio_test_dataset = KineticSoundAudioDataset(file_path, class_names, train=False,
+                                                  manifest=manifest_file('KineticSound_audio_test.pkl', **kwargs))
+    audio_test_dataset = DiskCachedDataset(audio_test_dataset, cache_path=os.path.join(cache_root(kwargs),
                                                                                        'KineticSound/audio/test_cache_{}'.format(
                                                                                            step)),
                                            transform=audio_test_transform, num_copies=1)
 
-    visual_train_dataset = KineticSoundVisualDataset(file_path, class_names, train=True)
+    visual_train_dataset = KineticSoundVisualDataset(file_path, class_names, train=True,
+                                                     manifest=manifest_file('KineticSound_visual_train.pkl', **kwargs))
     visual_train_dataset = RandomChoiceDiskCachedDataset(visual_train_dataset,
-                                                         cache_path=os.path.join("/mnt/home/hexiang/",
+                                                         cache_path=os.path.join(cache_root(kwargs),
                                                                                  'KineticSound/visual/train_cache_{}'.format(
                                                                                      step)),
                                                          transform=visual_train_transform, num_copies=1)
-    visual_test_dataset = KineticSoundVisualDataset(file_path, class_names, train=False)
+    visual_test_dataset = KineticSoundVisualDataset(file_path, class_names, train=False,
+                                                    manifest=manifest_file('KineticSound_visual_test.pkl', **kwargs))
     visual_test_dataset = RandomChoiceDiskCachedDataset(visual_test_dataset,
-                                                        cache_path=os.path.join("/mnt/home/hexiang/",
+                                                        cache_path=os.path.join(cache_root(kwargs),
                                                                                 'KineticSound/visual/test_cache_{}'.format(
                                                                                     step)),
                                                         transform=visual_test_transform, num_copies=1)
@@ -1505,12 +1645,14 @@ def get_dvsg_data(batch_size, step, root=DATA_DIR, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(root, 'DVS/DVSGesture/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(root, 'DVS/DVSGesture/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs, root), 'DVS/DVSGesture/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs, root), 'DVS/DVSGesture/train_events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs, root), 'DVS/DVSGesture/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs, root), 'DVS/DVSGesture/test_events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -1541,12 +1683,14 @@ def get_dvsg_data(batch_size, step, root=DATA_DIR, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=True, num_workers=8,
         shuffle=True,
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=2,
         shuffle=False,
     )
@@ -1595,12 +1739,14 @@ def get_bullyingdvs_data(batch_size, step, root=DATA_DIR, **kwargs):
             # print('randaug', m, n)
             train_transform.transforms.insert(2, RandAugment(m=m, n=n))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(root, 'DVS/BULLYINGDVS/train_cache_{}'.format(step)),
-                                      transform=train_transform)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(root, 'DVS/BULLYINGDVS/test_cache_{}'.format(step)),
-                                     transform=test_transform)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs, root), 'DVS/BULLYINGDVS/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs, root), 'DVS/BULLYINGDVS/train_events'),
+                                  transform=train_transform, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs, root), 'DVS/BULLYINGDVS/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs, root), 'DVS/BULLYINGDVS/test_events'),
+                                 transform=test_transform, **kwargs)
 
     num_train = len(train_dataset)
     num_per_cls = num_train // 10
@@ -1646,12 +1792,14 @@ def get_bullyingdvs_data(batch_size, step, root=DATA_DIR, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_train),
         pin_memory=True, drop_last=True, num_workers=8
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_test),
         pin_memory=True, drop_last=False, num_workers=2
     )
@@ -1716,12 +1864,14 @@ def get_dvsc10_data(batch_size, step, root=DATA_DIR, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(root, 'DVS/DVS_Cifar10/train_cache_{}'.format(step)),
-                                      transform=train_transform)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(root, 'DVS/DVS_Cifar10/test_cache_{}'.format(step)),
-                                     transform=test_transform)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs, root), 'DVS/DVS_Cifar10/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs, root), 'DVS/DVS_Cifar10/events'),
+                                  transform=train_transform, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs, root), 'DVS/DVS_Cifar10/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs, root), 'DVS/DVS_Cifar10/events'),
+                                 transform=test_transform, **kwargs)
 
     num_train = len(train_dataset)
     num_per_cls = num_train // 10
@@ -1767,12 +1917,14 @@ def get_dvsc10_data(batch_size, step, root=DATA_DIR, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_train),
         pin_memory=True, drop_last=True, num_workers=8
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         sampler=torch.utils.data.sampler.SubsetRandomSampler(indices_test),
         pin_memory=True, drop_last=False, num_workers=2
     )
@@ -1857,12 +2009,14 @@ def get_NCALTECH101_data(batch_size, step, root=DATA_DIR, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(root, 'DVS/NCALTECH101/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(root, 'DVS/NCALTECH101/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs, root), 'DVS/NCALTECH101/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs, root), 'DVS/NCALTECH101/events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs, root), 'DVS/NCALTECH101/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs, root), 'DVS/NCALTECH101/events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -1896,12 +2050,14 @@ def get_NCALTECH101_data(batch_size, step, root=DATA_DIR, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         sampler=train_sampler,
         pin_memory=True, drop_last=True, num_workers=8
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         sampler=test_sampler,
         pin_memory=True, drop_last=False, num_workers=2
     )
@@ -1958,12 +2114,14 @@ def get_NCARS_data(batch_size, step, root=DATA_DIR, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(root, 'DVS/NCARS/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(root, 'DVS/NCARS/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, None, step,
+                                  cache_path=os.path.join(cache_root(kwargs, root), 'DVS/NCARS/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs, root), 'DVS/NCARS/train_events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, None, step,
+                                 cache_path=os.path.join(cache_root(kwargs, root), 'DVS/NCARS/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs, root), 'DVS/NCARS/test_events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -1994,12 +2152,14 @@ def get_NCARS_data(batch_size, step, root=DATA_DIR, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=True, num_workers=8,
         shuffle=True,
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=2,
         shuffle=False,
     )
@@ -2210,12 +2370,14 @@ def get_nmnist_data(batch_size, step, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(DATA_DIR, 'DVS/N-MNIST/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(DATA_DIR, 'DVS/N-MNIST/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs), 'DVS/N-MNIST/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs), 'DVS/N-MNIST/train_events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs), 'DVS/N-MNIST/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs), 'DVS/N-MNIST/test_events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -2246,12 +2408,14 @@ def get_nmnist_data(batch_size, step, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=True, num_workers=8,
         shuffle=True,
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=2,
         shuffle=False,
     )
@@ -2293,21 +2457,25 @@ def get_shd_data(batch_size, step, **kwargs):
         lambda x: x.squeeze(1)
     ])
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(DATA_DIR, 'DVS/SHD/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(DATA_DIR, 'DVS/SHD/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs), 'DVS/SHD/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs), 'DVS/SHD/train_events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs), 'DVS/SHD/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs), 'DVS/SHD/test_events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=8,
         shuffle=True,
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=2,
         shuffle=False,
     )
@@ -2534,12 +2702,14 @@ def get_UCF101DVS_data(batch_size, step, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(DATA_DIR, 'UCF101DVS/train_cache_{}'.format(step)),
-                                      transform=train_transform)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(DATA_DIR, 'UCF101DVS/test_cache_{}'.format(step)),
-                                     transform=test_transform)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs), 'UCF101DVS/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs), 'UCF101DVS/train_events'),
+                                  transform=train_transform, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs), 'UCF101DVS/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs), 'UCF101DVS/test_events'),
+                                 transform=test_transform, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -2572,11 +2742,13 @@ def get_UCF101DVS_data(batch_size, step, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size, shuffle=True,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=True, num_workers=8
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size, shuffle=False,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         pin_memory=True, drop_last=False, num_workers=2
     )
 
@@ -2660,12 +2832,14 @@ def get_HMDBDVS_data(batch_size, step, **kwargs):
     #         train_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
     #         test_transform.transforms.insert(-1, lambda x: temporal_flatten(x))
 
-    train_dataset = DiskCachedDataset(train_dataset,
-                                      cache_path=os.path.join(DATA_DIR, 'HMDBDVS/train_cache_{}'.format(step)),
-                                      transform=train_transform, num_copies=3)
-    test_dataset = DiskCachedDataset(test_dataset,
-                                     cache_path=os.path.join(DATA_DIR, 'HMDBDVS/test_cache_{}'.format(step)),
-                                     transform=test_transform, num_copies=3)
+    train_dataset = frame_dataset(train_dataset, sensor_size, step,
+                                  cache_path=os.path.join(cache_root(kwargs), 'HMDBDVS/train_cache_{}'.format(step)),
+                                  store_path=os.path.join(cache_root(kwargs), 'HMDBDVS/events'),
+                                  transform=train_transform, num_copies=3, **kwargs)
+    test_dataset = frame_dataset(test_dataset, sensor_size, step,
+                                 cache_path=os.path.join(cache_root(kwargs), 'HMDBDVS/test_cache_{}'.format(step)),
+                                 store_path=os.path.join(cache_root(kwargs), 'HMDBDVS/events'),
+                                 transform=test_transform, num_copies=3, **kwargs)
 
     mix_up, cut_mix, event_mix, beta, prob, num, num_classes, noise, gaussian_n = unpack_mix_param(kwargs)
     mixup_active = cut_mix | event_mix | mix_up
@@ -2699,12 +2873,14 @@ def get_HMDBDVS_data(batch_size, step, **kwargs):
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset, batch_size=batch_size,
+        collate_fn=getattr(train_dataset, 'collate_fn', None),
         sampler=train_sampler,
         pin_memory=True, drop_last=True, num_workers=8
     )
 
     test_loader = torch.utils.data.DataLoader(
         test_dataset, batch_size=batch_size,
+        collate_fn=getattr(test_dataset, 'collate_fn', None),
         sampler=test_sampler,
         pin_memory=True, drop_last=False, num_workers=2
     )
@@ -0,0 +1,187 @@
+import glob
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+import torch
+from tonic import DiskCachedDataset
+from tonic.cached_dataset import save_to_disk_cache
+
+# fork 出来的 worker 直接使用父进程中的 dataset, transform 中的 lambda 不需要 pickle
+_caches = []
+
+
+def is_disk_cache(obj):
+    """
+    ``DiskCachedDataset`` 以及同样按 ``{item}_{copy}.hdf5`` 缓存的 ``RandomChoiceDiskCachedDataset``
+    """
+    return isinstance(obj, DiskCachedDataset) or \
+        all(hasattr(obj, name) for name in ('dataset', 'cache_path', 'num_copies'))
+
+
+def find_disk_caches(obj, found=None, seen=None):
+    """
+    在 DataLoader, Subset 以及各种包装的 dataset 中递归地找到所有的磁盘缓存
+    :param obj: get_*_data 返回的 loader, 或者 dataset
+    :return: 磁盘缓存的list, 同一个 cache_path 只出现一次
+    """
+    found = [] if found is None else found
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return found
+    seen.add(id(obj))
+
+    if is_disk_cache(obj):
+        if all(os.path.abspath(c.cache_path) != os.path.abspath(obj.cache_path) for c in found):
+            found.append(obj)
+        return found
+    if isinstance(obj, (list, tuple)):
+        children = obj
+    elif isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (torch.utils.data.Dataset, torch.utils.data.DataLoader)) or hasattr(obj, 'loader'):
+        children = vars(obj).values()
+    else:
+        return found
+    for child in children:
+        find_disk_caches(child, found, seen)
+    return found
+
+
+def cache_file(cache, item, copy):
+    return os.path.join(cache.cache_path, '{}_{}.hdf5'.format(item, copy))
+
+
+def missing_items(cache, stale=3600.):
+    """
+    :param stale: 超过这么多秒没有修改的临时文件视为中断时留下的, 删除; 其他进程正在写的临时文件保留
+    :return: 还没有写入的 (item, copy), 只列一次目录, 中断之后再次运行时跳过已经完成的文件
+    """
+    os.makedirs(cache.cache_path, exist_ok=True)
+    now = time.time()
+    for tmp in glob.glob(os.path.join(cache.cache_path, '*.hdf5.tmp*')):
+        # 临时文件以写入进程的pid结尾, 当前进程的一定是之前中断留下的
+        try:
+            if tmp.endswith('.tmp{}'.format(os.getpid())) or now - os.path.getmtime(tmp) > stale:
+                os.remove(tmp)
+        except FileNotFoundError:
+            pass  # 其他进程刚好写完并重命名
+    done = set(os.listdir(cache.cache_path))
+    return [(item, copy) for item in range(len(cache.dataset)) for copy in range(cache.num_copies)
+            if '{}_{}.hdf5'.format(item, copy) not in done]
+
+
+def _warm_item(task):
+    index, item, copy, seed = task
+    cache = _caches[index]
+    # 每个文件的随机增强只由 seed, item, copy 决定, 与 worker 的个数和调度无关
+    seed = (seed * 1000003 + item * cache.num_copies + copy) % 2 ** 32
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    data, targets = cache.dataset[item]
+    file_path = cache_file(cache, item, copy)
+    tmp = '{}.tmp{}'.format(file_path, os.getpid())
+    save_to_disk_cache(data, targets, file_path=tmp, compress=getattr(cache, 'compress', True))
+    # 写完之后再重命名, 训练时读取和并发的写入都不会看到不完整的文件
+    os.replace(tmp, file_path)
+    return index, os.path.getsize(file_path)
+
+
+def warm_caches(caches, workers=8, seed=0, log_interval=10., stale=3600.):
+    """
+    用进程池填满磁盘缓存, 代替训练的第一个epoch中由 DataLoader 的 worker 边读边写
+    已经存在的文件被跳过, 每个文件先写到临时文件再原子地重命名, 可以随时中断后继续
+    :param caches: ``find_disk_caches`` 找到的磁盘缓存
+    :param workers: 进程数, 为0时在当前进程中执行
+    :param seed: 随机增强的种子
+    :param log_interval: 打印进度的间隔 (秒)
+    :param stale: 见 ``missing_items``
+    :return: 每个缓存的 {cache_path, total, skipped, written, bytes, seconds}
+    """
+    global _caches
+    _caches = list(caches)
+    stats = []
+    tasks = []
+    for index, cache in enumerate(_caches):
+        missing = missing_items(cache, stale)
+        total = len(cache.dataset) * cache.num_copies
+        stats.append({'cache_path': cache.cache_path, 'total': total, 'skipped': total - len(missing),
+                      'written': 0, 'bytes': 0, 'seconds': 0.})
+        tasks.extend((index, item, copy, seed) for item, copy in missing)
+
+    start = last = time.perf_counter()
+    if workers > 0 and len(tasks) > 0:
+        pool = multiprocessing.get_context('fork').Pool(workers)
+        results = pool.imap_unordered(_warm_item, tasks, chunksize=max(1, min(64, len(tasks) // (workers * 16))))
+    else:
+        pool, results = None, map(_warm_item, tasks)
+    try:
+        for done, (index, size) in enumerate(results, 1):
+            stats[index]['written'] += 1
+            stats[index]['bytes'] += size
+            stats[index]['seconds'] = time.perf_counter() - start
+            now = time.perf_counter()
+            if now - last > log_interval:
+                last = now
+                print('{}/{} files, {:.1f} files/s'.format(done, len(tasks), done / (now - start)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    from braincog.datasets import datasets
+
+    parser = argparse.ArgumentParser(description='Fill the tonic disk caches of a get_*_data dataset before training')
+    parser.add_argument('--dataset', required=True, type=str, help='the X in get_X_data, e.g. dvsg, dvsc10, KineticSound')
+    parser.add_argument('--step', default=10, type=int)
+    parser.add_argument('--batch-size', default=32, type=int)
+    parser.add_argument('--event-size', default=48, type=int)
+    parser.add_argument('--num-classes', default=10, type=int)
+    parser.add_argument('--modality', default='audio-visual', type=str)
+    parser.add_argument('--train-portion', default=0.9, type=float)
+    parser.add_argument('--root', default='', type=str, help='dataset root (default: DATA_DIR)')
+    parser.add_argument('--cache-root', default='', type=str,
+                        help='root of the caches, same as --cache-root of the training scripts '
+                             '(default: $BRAINCOG_CACHE_DIR or the dataset root)')
+    parser.add_argument('--workers', default=8, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--stale', default=3600., type=float,
+                        help='remove leftover temporary files not modified for this many seconds')
+    args = parser.parse_args()
+
+    # 与训练脚本相同的参数, 不使用事件存储和数据集级别的混合, 得到的缓存路径与训练时相同
+    kwargs = {'root': args.root} if args.root else {}
+    loaders = getattr(datasets, 'get_%s_data' % args.dataset)(
+        batch_size=args.batch_size,
+        step=args.step,
+        args=args,
+        size=args.event_size,
+        num_classes=args.num_classes,
+        portion=args.train_portion,
+        modality=args.modality,
+        cache_root=args.cache_root,
+        **kwargs
+    )
+    caches = find_disk_caches(loaders)
+    if not caches:
+        print('get_{}_data does not use a disk cache'.format(args.dataset))
+
+    start = time.perf_counter()
+    stats = warm_caches(caches, workers=args.workers, seed=args.seed, stale=args.stale)
+    elapsed = time.perf_counter() - start
+    for s in stats:
+        print('{}: {} files, {} already cached, {} written ({:.1f} MB, {:.1f} files/s)'.format(
+            s['cache_path'], s['total'], s['skipped'], s['written'], s['bytes'] / 2 ** 20,
+            s['written'] / max(s['seconds'], 1e-9)))
+    written = sum(s['written'] for s in stats)
+    print('{} files in {:.1f} s, {:.1f} files/s, {:.1f} MB/s with {} workers'.format(
+        written, elapsed, written / max(elapsed, 1e-9), sum(s['bytes'] for s in stats) / 2 ** 20 / max(elapsed, 1e-9),
+        args.workers))
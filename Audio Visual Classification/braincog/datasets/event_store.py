@@ -0,0 +1,281 @@
+import copy
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+STORE_META = 'meta.json'
+
+
+def _identity(sample):
+    return sample
+
+
+def events_to_frames(events, sensor_size, n_time_bins):
+    """
+    与 ``tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=n_time_bins)`` 的结果相同
+    按时间窗口计算每个事件所在的帧, 所有帧一次 ``np.bincount``, 代替逐帧的 ``np.add.at``
+    :param events: tonic 格式的结构化数组, 或 ``{field: array}``, 包含 x, t, p, 可选 y, 按 t 排序
+    :param sensor_size: (W, H, P), 为 ``None`` 时与 tonic 一样由样本本身推断
+    :param n_time_bins: 帧数, 即仿真步长
+    :return: int16 的 [T, P, H, W], 没有 y 时为 [T, P, W]
+    """
+    index, shape = frame_index(events, sensor_size, n_time_bins)
+    frames = np.bincount(index, minlength=int(np.prod(shape)))
+    return frames.astype(np.int16).reshape(shape)
+
+
+def frame_index(events, sensor_size, n_time_bins):
+    """
+    每个事件在展平的帧中的位置, ``events_to_frames`` 即对它做 ``np.bincount``
+    :return: int64 的位置, 被丢弃的事件不在其中, 以及帧的shape
+    """
+    names = events.dtype.names if hasattr(events, 'dtype') else tuple(events)
+    has_y = 'y' in names
+    if not sensor_size:
+        sensor_size = (int(events['x'].max() + 1), int(events['y'].max() + 1) if has_y else 1,
+                       len(np.unique(events['p'])))
+    width, height, polarity = sensor_size
+    shape = (n_time_bins, polarity, height, width) if has_y else (n_time_bins, polarity, width)
+
+    t = events['t']
+    # 与 SliceByTimeBins 相同: 第 k 帧为 [t0 + k * window, t0 + (k + 1) * window), 最后不足一个窗口的事件被丢弃
+    window = (t[-1] - t[0]) // n_time_bins if len(t) > 0 else 0
+    if window <= 0:
+        return np.zeros(0, dtype=np.int64), shape
+    bins = ((t - t[0]) // window).astype(np.int64)
+    keep = bins < n_time_bins
+
+    if polarity == 1:
+        index = bins[keep]
+    else:
+        index = bins[keep] * polarity + events['p'][keep].astype(np.int64) % polarity
+    if has_y:
+        index = index * height + events['y'][keep].astype(np.int64)
+    return index * width + events['x'][keep].astype(np.int64), shape
+
+
+class EventStore(object):
+    """
+    与step无关的事件存储, 所有样本的事件按字段 (x, y, t, p) 分别拼接成连续的数组, 用 offsets 索引
+    目录中包含每个字段的 ``{field}.bin``, ``offsets.npy``, ``targets.npy`` 和 ``meta.json``
+    :param root: 由 ``EventStore.build`` 写好的目录
+    """
+
+    def __init__(self, root):
+        with open(os.path.join(root, STORE_META)) as f:
+            meta = json.load(f)
+        self.root = root
+        self.fields = [(name, np.dtype(fmt)) for name, fmt in meta['fields']]
+        self.offsets = np.load(os.path.join(root, 'offsets.npy'))
+        self.targets = np.load(os.path.join(root, 'targets.npy'), allow_pickle=True)
+        self.columns = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        # 打开的memmap不随dataset传给DataLoader的worker, 每个worker各自打开
+        state = self.__dict__.copy()
+        state['columns'] = None
+        return state
+
+    def open(self):
+        if self.columns is None:
+            total = int(self.offsets[-1])
+            self.columns = {
+                name: np.memmap(os.path.join(self.root, name + '.bin'), dtype=dtype, mode='r', shape=(total,))
+                if total > 0 else np.zeros(0, dtype=dtype)
+                for name, dtype in self.fields}
+        return self.columns
+
+    def __getitem__(self, idx):
+        """
+        :return: ``{field: array}`` 形式的事件和标签, 数组是存储的只读view
+        """
+        columns = self.open()
+        begin, end = self.offsets[idx], self.offsets[idx + 1]
+        return {name: column[begin:end] for name, column in columns.items()}, self.targets[idx]
+
+    @staticmethod
+    def build(dataset, root, num_workers=0):
+        """
+        root 中没有完整的存储时, 读取 dataset 中未经 transform 的原始事件写入存储
+        先写到临时目录, 全部写完之后再整体重命名为 root, 中断后不会留下不完整的存储
+        :param dataset: tonic 格式的数据集, ``__getitem__`` 返回 (events, target), 有 ``transform`` 属性
+        :param root: 存储的目录, 与 step 无关, 同一个数据集只需要构建一次
+        :param num_workers: 读取原始事件的进程数
+        :return: EventStore
+        """
+        if os.path.exists(os.path.join(root, STORE_META)):
+            return EventStore(root)
+
+        raw = copy.copy(dataset)
+        raw.transform = None
+        tmp = '{}.tmp{}'.format(root.rstrip('/'), os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        loader = torch.utils.data.DataLoader(raw, batch_size=None, num_workers=num_workers, collate_fn=_identity)
+        offsets, targets, fields, files = [0], [], None, {}
+        try:
+            for events, target in loader:
+                if fields is None:
+                    fields = [(name, events.dtype[name]) for name in events.dtype.names]
+                    files = {name: open(os.path.join(tmp, name + '.bin'), 'wb') for name, _ in fields}
+                for name, dtype in fields:
+                    files[name].write(np.ascontiguousarray(events[name], dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(events))
+                targets.append(target)
+            for f in files.values():
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            for f in files.values():
+                f.close()
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        for f in files.values():
+            f.close()
+
+        np.save(os.path.join(tmp, 'offsets.npy'), np.asarray(offsets, dtype=np.int64))
+        np.save(os.path.join(tmp, 'targets.npy'), np.asarray(targets))
+        with open(os.path.join(tmp, STORE_META), 'w') as f:
+            json.dump({'fields': [[name, dtype.str] for name, dtype in fields or []], 'length': len(targets)}, f)
+
+        os.makedirs(os.path.dirname(os.path.abspath(root)), exist_ok=True)
+        try:
+            os.replace(tmp, root)
+        except OSError:
+            # 其他进程已经写好了同一个存储
+            shutil.rmtree(tmp, ignore_errors=True)
+        return EventStore(root)
+
+    def cache_frames(self, sensor_size, n_time_bins):
+        """
+        将所有样本按 n_time_bins 分好的帧写入存储目录中的 ``frames_{T}_{W}x{H}x{P}.npy``, 已经存在时直接返回
+        与每个 step 各自的 ``DiskCachedDataset`` 一样读取时不需要再分帧, 但只从存储中分帧, 不需要重新读取原始事件
+        :param sensor_size: (W, H, P), 不支持 ``None``
+        :param n_time_bins: 帧数, 即仿真步长
+        :return: 缓存的路径, 内容为 int16 的 [N, T, P, H, W], 没有 y 时为 [N, T, P, W]
+        """
+        assert sensor_size, 'cache_frames needs a fixed sensor_size'
+        width, height, polarity = sensor_size
+        path = os.path.join(self.root, 'frames_{}_{}x{}x{}.npy'.format(n_time_bins, width, height, polarity))
+        if os.path.exists(path):
+            return path
+
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        shape = frame_index(self[0][0], sensor_size, n_time_bins)[1] if len(self) > 0 else (n_time_bins,)
+        try:
+            frames = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int16, shape=(len(self),) + shape)
+            for idx in range(len(self)):
+                frames[idx] = events_to_frames(self[idx][0], sensor_size, n_time_bins)
+            frames.flush()
+            del frames
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return path
+
+
+class EventFrameDataset(torch.utils.data.Dataset):
+    """
+    从 ``EventStore`` 按需分帧, 代替 ``DiskCachedDataset`` 缓存的 ``ToFrame(n_time_bins=step)`` 输出
+    同一个存储可以用于任意的 step, 不需要为每个 step 重新缓存整个数据集
+    :param store: EventStore
+    :param sensor_size: 与 ``ToFrame`` 的 sensor_size 相同
+    :param n_time_bins: 帧数, 即仿真步长, 为 ``None`` 时直接返回事件, 由 ``EventCollate`` 在主进程中分帧
+    :param transform: 分帧之后的变换, 与 ``DiskCachedDataset`` 的 transform 相同
+    :param target_transform: 标签的变换
+    :param cache: 是否用 ``EventStore.cache_frames`` 缓存当前 step 的帧, 读取时不再分帧, 默认为 ``False``
+    """
+
+    def __init__(self, store, sensor_size, n_time_bins, transform=None, target_transform=None, cache=False):
+        self.store = store
+        self.sensor_size = sensor_size
+        self.n_time_bins = n_time_bins
+        self.transform = transform
+        self.target_transform = target_transform
+        self.cache_path = store.cache_frames(sensor_size, n_time_bins) if cache and n_time_bins is not None else None
+        self.frames = None
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getstate__(self):
+        # 打开的memmap不随dataset传给DataLoader的worker
+        state = self.__dict__.copy()
+        state['frames'] = None
+        return state
+
+    def __getitem__(self, idx):
+        events, target = self.store[idx]
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        if self.n_time_bins is None:
+            return events, target
+        if self.cache_path is not None:
+            if self.frames is None:
+                self.frames = np.load(self.cache_path, mmap_mode='r')
+            frames = np.array(self.frames[idx])
+        else:
+            frames = events_to_frames(events, self.sensor_size, self.n_time_bins)
+        if self.transform is not None:
+            frames = self.transform(frames)
+        return frames, target
+
+
+class EventCollate(object):
+    """
+    DataLoader 的 collate_fn, worker 只把一个batch的事件紧凑地拼接起来传给主进程, 不传稠密的帧
+    worker 中计算每个事件在展平的帧中的位置 (``frame_index``), 一帧不超过 2^15 个元素时为 int16, 否则为 int32,
+    每个事件只占 2 或 4 字节, offsets 为每个样本的起止位置, shape 为每个样本的帧的shape
+    主进程 (如 ``MultiModalPrefetcher`` 的 ``batch_transform``) 调用 ``to_frames``, 每个样本只需要一次 ``bincount``,
+    结果与每个样本分别 ``ToFrame(sensor_size, n_time_bins)`` 再 ``transform`` 相同
+    :param sensor_size: (W, H, P), 不支持 ``None``
+    :param n_time_bins: 帧数, 即仿真步长
+    :param transform: 每个样本分帧之后的变换, 与 worker 中分帧时的 transform 相同
+    """
+
+    def __init__(self, sensor_size, n_time_bins, transform=None):
+        assert sensor_size, 'EventCollate needs a fixed sensor_size'
+        self.sensor_size = sensor_size
+        self.n_time_bins = n_time_bins
+        self.transform = transform
+
+    def __call__(self, batch):
+        events, targets = zip(*batch)
+        index = [frame_index(e, self.sensor_size, self.n_time_bins) for e in events]
+        shape = index[0][1]
+        dtype = np.int16 if np.prod(shape) <= 2 ** 15 else np.int32
+        counts = torch.tensor([len(i) for i, _ in index], dtype=torch.int64)
+        packed = {'offsets': torch.cat([counts.new_zeros(1), counts.cumsum(0)]),
+                  'index': torch.from_numpy(np.concatenate([i for i, _ in index], dtype=dtype, casting='unsafe')),
+                  'shape': torch.tensor(shape)}
+        return packed, torch.utils.data.dataloader.default_collate(list(targets))
+
+    def to_frames(self, events):
+        """
+        :param events: ``__call__`` 返回的紧凑事件
+        :return: [B, T, P, H, W] 的帧, 有 transform 时为每个样本 transform 之后的结果叠在一起
+        """
+        offsets = events['offsets'].tolist()
+        batch_size = len(offsets) - 1
+        shape = tuple(events['shape'].tolist())
+        numel = int(np.prod(shape))
+
+        # 逐样本 bincount 直接写入 int16 的输出, 不产生整个batch大小的 int64 中间结果
+        index = events['index'].numpy()
+        frames = np.empty((batch_size, numel), dtype=np.int16)
+        for i in range(batch_size):
+            frames[i] = np.bincount(index[offsets[i]:offsets[i + 1]], minlength=numel)
+        frames = torch.from_numpy(frames).view((batch_size,) + shape)
+
+        if self.transform is None:
+            return frames
+        return torch.stack([self.transform(f.numpy()) for f in frames])
@@ -0,0 +1,102 @@
+import os
+import pickle
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+
+def file_stat(path):
+    """
+    :return: (size, mtime_ns), 文件不存在时为 (-1, -1)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, -1
+    return st.st_size, st.st_mtime_ns
+
+
+class FileManifest(object):
+    """
+    数据集的文件清单: 每个样本的路径, 标签, 大小和mtime, 以及扫描时依赖的目录和文件 (watch) 的mtime
+    构建时只扫描一次文件系统, 之后从清单中读取, 只需要 stat 少量的 watch 路径来检查清单是否过期
+    :param paths: 每个样本的路径, 或多个路径组成的tuple (如音频和视频)
+    :param labels: 每个样本的标签
+    :param watch: 扫描时依赖的目录和文件, 如 os.walk 经过的目录, 读取的csv, 样本所在的目录.
+        目录中增加或删除文件时目录的mtime会改变
+    :param stats: 每个样本的 ``file_stat``, 扫描时已经 stat 过时直接传入, 否则重新 stat
+    """
+
+    def __init__(self, paths, labels, watch=(), stats=None):
+        self.paths = list(paths)
+        self.labels = list(labels)
+        if stats is None:
+            stats = [[file_stat(p) for p in (path if isinstance(path, tuple) else (path,))] for path in self.paths]
+        stats = np.asarray(stats, dtype=np.int64).reshape(len(self.paths), -1, 2) if self.paths \
+            else np.zeros((0, 1, 2), dtype=np.int64)
+        self.sizes = stats[..., 0]
+        self.mtimes = stats[..., 1]
+        self.watch = {path: file_stat(path) for path in watch}
+        self.key = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def is_valid(self, check='watch'):
+        """
+        :param check: ``none`` 不检查, ``watch`` 只检查 watch 中的目录和文件,
+            ``full`` 还检查每个样本的大小和mtime (每个文件一次 stat, 但仍然比重新扫描快)
+        """
+        if check == 'none':
+            return True
+        if any(file_stat(path) != tuple(stat) for path, stat in self.watch.items()):
+            return False
+        if check == 'full':
+            stats = FileManifest(self.paths, self.labels)
+            return np.array_equal(stats.sizes, self.sizes) and np.array_equal(stats.mtimes, self.mtimes)
+        return True
+
+    def save(self, file):
+        """
+        先写到临时文件再重命名, 多个进程 (如DDP的每个rank) 同时写入时不会读到不完整的清单
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        tmp = '{}.tmp{}'.format(file, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': MANIFEST_VERSION, 'manifest': self}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, file)
+
+    @staticmethod
+    def load(file):
+        """
+        :return: FileManifest, 文件不存在或者无法读取时返回 ``None``
+        """
+        try:
+            with open(file, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if not isinstance(state, dict) or state.get('version') != MANIFEST_VERSION:
+            return None
+        return state['manifest']
+
+
+def load_manifest(file, key, build, check='watch'):
+    """
+    读取数据集的文件清单, 清单不存在, 扫描的参数不同或已经过期时调用 build 重新扫描并写入
+    :param file: 清单的路径, 为 ``None`` 或空时每次都重新扫描, 不写入
+    :param key: 扫描的参数, 如根目录, 类别和模式, 与清单中记录的不同时重新扫描
+    :param build: 无参数的函数, 扫描文件系统并返回 ``FileManifest``
+    :param check: 与 ``FileManifest.is_valid`` 相同
+    :return: FileManifest
+    """
+    if file:
+        manifest = FileManifest.load(file)
+        if manifest is not None and manifest.key == key and manifest.is_valid(check):
+            return manifest
+    manifest = build()
+    manifest.key = key
+    if file:
+        manifest.save(file)
+    return manifest
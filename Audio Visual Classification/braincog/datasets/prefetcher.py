@@ -0,0 +1,116 @@
+import queue
+import threading
+
+import torch
+
+
+class _Stop(object):
+    def __init__(self, error=None):
+        self.error = error
+
+
+class MultiModalPrefetcher(object):
+    """
+    通用的预取loader, 支持 ``(inputs, target)`` 形式的batch, inputs 可以是单个tensor或多模态tensor的list/tuple
+    CUDA上: 在独立的stream中用pinned memory做 non_blocking 拷贝, 拷贝到设备之后再转换dtype,
+    下一个batch的拷贝与当前batch的计算重叠
+    CPU上: 在后台线程中读取loader (包括collate) 并转换dtype, 与主线程的计算重叠
+    与 ``item.type(torch.FloatTensor).cuda()`` 得到的数值相同
+    :param loader: DataLoader
+    :param device: 目标设备, 默认有GPU时为 ``cuda``, 否则为 ``cpu``
+    :param dtype: inputs 转换成的类型, target 保持原来的类型
+    :param depth: CPU模式下最多预取的batch数
+    :param batch_transform: 在拷贝之前对host上的 inputs 做的变换, 如 ``EventCollate.to_frames`` 对整个batch分帧
+    """
+
+    def __init__(self, loader, device=None, dtype=torch.float32, depth=2, batch_transform=None):
+        self.loader = loader
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.depth = depth
+        self.batch_transform = batch_transform
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        # sampler, dataset 等属性直接使用原来的loader
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._iter_cuda()
+        return self._iter_cpu()
+
+    def _move(self, x, dtype=None):
+        if self.device.type == 'cuda' and not x.is_pinned():
+            x = x.pin_memory()
+        x = x.to(self.device, non_blocking=True)
+        return x if dtype is None else x.to(dtype)
+
+    def to_device(self, batch):
+        inputs, target = batch
+        if self.batch_transform is not None:
+            inputs = self.batch_transform(inputs)
+        if isinstance(inputs, (list, tuple)):
+            inputs = [self._move(x, self.dtype) for x in inputs]
+        else:
+            inputs = self._move(inputs, self.dtype)
+        return inputs, self._move(target)
+
+    def _iter_cuda(self):
+        stream = torch.cuda.Stream(device=self.device)
+        current = torch.cuda.current_stream(self.device)
+        batch = None
+        for sample in self.loader:
+            with torch.cuda.stream(stream):
+                sample = self.to_device(sample)
+            if batch is not None:
+                yield batch
+            current.wait_stream(stream)
+            inputs, target = sample
+            for x in (inputs if isinstance(inputs, list) else [inputs]) + [target]:
+                x.record_stream(current)
+            batch = sample
+        if batch is not None:
+            yield batch
+
+    def _iter_cpu(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker():
+            try:
+                for sample in self.loader:
+                    if not put(self.to_device(sample)):
+                        return
+                put(_Stop())
+            except Exception as e:
+                put(_Stop(e))
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if isinstance(item, _Stop):
+                    if item.error is not None:
+                        raise item.error
+                    break
+                yield item
+        finally:
+            stop.set()
+            thread.join()
@@ -27,3 +27,87 @@ def dvs_channel_check_expend(x):
         return repeat(x, 'b c w h -> b (r c) w h', r=2)
     else:
         return x
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    可以从epoch中间继续的sampler, 每个epoch的顺序只由 ``seed + epoch`` 决定, 不使用全局随机数
+    分布式训练时与 ``DistributedSampler`` 一样补齐并按 rank 划分
+    :param data_source: 数据集
+    :param shuffle: 是否打乱
+    :param seed: 随机种子
+    :param num_replicas: 进程数
+    :param rank: 当前进程的 rank
+    :param generator: DataLoader 使用的 generator, 每个epoch重新设置种子, 使worker的随机种子也可以复现
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0, num_replicas=1, rank=0, generator=None):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.generator = generator
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = (len(data_source) + num_replicas - 1) // num_replicas
+        # 补齐的重复样本在每个进程的末尾, 前 num_valid 个是不重复的
+        self.num_valid = len(range(rank, len(data_source), num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+        if self.generator is not None:
+            self.generator.manual_seed(self.seed + epoch + (1 << 32))
+
+    def set_start(self, start):
+        """
+        :param start: 当前epoch中当前进程已经用过的样本数, 只对下一次迭代有效
+        """
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(n, generator=g).tolist()
+        else:
+            indices = list(range(n))
+        total_size = self.num_samples * self.num_replicas
+        indices += indices[:total_size - n]
+        indices = indices[self.rank:total_size:self.num_replicas]
+        start, self.start = self.start, 0
+        return iter(indices[start:])
+
+    def __len__(self):
+        # 与完整的epoch相同, 这样 len(loader) 不随继续的位置变化
+        return self.num_samples
+
+
+def make_resumable_loader(loader, seed=0, num_replicas=None, rank=None):
+    """
+    用 ``ResumableSampler`` 重新构建 DataLoader, 其它参数保持不变
+    :param loader: 原来的DataLoader, sampler 为 RandomSampler, SequentialSampler 或 DistributedSampler
+    :param seed: 随机种子, 分布式训练时所有进程需要相同
+    :param num_replicas: 进程数, 默认与原来的 DistributedSampler 相同, 否则为1
+    :param rank: 当前进程的 rank
+    :return: 新的DataLoader
+    """
+    sampler = loader.sampler
+    if isinstance(sampler, torch.utils.data.distributed.DistributedSampler):
+        shuffle = sampler.shuffle
+        num_replicas = sampler.num_replicas if num_replicas is None else num_replicas
+        rank = sampler.rank if rank is None else rank
+    else:
+        shuffle = isinstance(sampler, torch.utils.data.RandomSampler)
+        num_replicas = 1 if num_replicas is None else num_replicas
+        rank = 0 if rank is None else rank
+    generator = torch.Generator()
+    sampler = ResumableSampler(loader.dataset, shuffle=shuffle, seed=seed,
+                               num_replicas=num_replicas, rank=rank, generator=generator)
+    return torch.utils.data.DataLoader(
+        loader.dataset, batch_size=loader.batch_size, sampler=sampler, num_workers=loader.num_workers,
+        collate_fn=loader.collate_fn, pin_memory=loader.pin_memory, drop_last=loader.drop_last,
+        timeout=loader.timeout, worker_init_fn=loader.worker_init_fn, generator=generator,
+        persistent_workers=loader.persistent_workers)
@@ -38,6 +38,7 @@ class BaseLinearModule(nn.Module):
                     out_features=out_features,
                     bias=bias
                 ))
+        self._grouped_cache = None
         self.node = partial(node, **kwargs)()
 
     def forward(self, x):
@@ -46,14 +47,42 @@ class BaseLinearModule(nn.Module):
 
         else: # b (c t)
             x = rearrange(x, 'b (c t) -> t b c', t=self.groups)
-            outputs = []
-            for i in range(self.groups):
-                outputs.append(self.fc[i](x[i]))
-            outputs = torch.stack(outputs) # t b c
+            outputs = self.grouped_linear(x) # t b c
             outputs = rearrange(outputs, 't b c -> b (c t)')
 
         return self.node(outputs)
 
+    def grouped_linear(self, x):
+        """
+        将所有分组的 ``nn.Linear`` 合并为一次 batched matmul, 参数仍保存在 ``self.fc`` 中, 不影响checkpoint的读取
+        :param x: 输入, shape 为 [groups, batch, in_features]
+        :return: 输出, shape 为 [groups, batch, out_features]
+        """
+        weight, bias = self.grouped_weight()
+        if bias is None:
+            return torch.bmm(x, weight)
+        return torch.baddbmm(bias, x, weight)
+
+    def grouped_weight(self):
+        """
+        合并所有分组的权重和偏置. 需要梯度时每次重新合并, 否则缓存合并的结果,
+        参数被原地修改 (``_version`` 改变) 或移动到其他设备时重新合并
+        :return: 权重, shape 为 [groups, in_features, out_features], 偏置, shape 为 [groups, 1, out_features]
+        """
+        params = [p for fc in self.fc for p in fc.parameters()]
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return self._stack_weight()
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if self._grouped_cache is None or self._grouped_cache[0] != key:
+            self._grouped_cache = (key, self._stack_weight())
+        return self._grouped_cache[1]
+
+    def _stack_weight(self):
+        weight = torch.stack([fc.weight for fc in self.fc]).transpose(1, 2)  # t i o
+        if self.fc[0].bias is None:
+            return weight, None
+        return weight, torch.stack([fc.bias for fc in self.fc]).unsqueeze(1)  # t 1 o
+
 
 class BaseConvModule(nn.Module):
     """
@@ -273,11 +302,84 @@ class BaseModule(nn.Module, abc.ABC):
 
         return avg, var, spike, avg_per_step
 
+    def set_spike_count(self, flag):
+        """
+        设置是否在推理过程中流式地统计脉冲, 不需要打开 ``requires_fp`` 保存feature map
+        :param flag: 是否统计
+        :return:
+        """
+        for mod in self.modules():
+            if isinstance(mod, BaseNode):
+                mod.set_n_spike_count(flag)
+
+    def reset_spike_count(self):
+        """
+        清空所有神经元的脉冲统计量, 一般在每个epoch开始时调用
+        :return:
+        """
+        for mod in self.modules():
+            if isinstance(mod, BaseNode):
+                mod.spike_counter.reset()
+
+    def get_spike_counter(self):
+        """
+        结束当前窗口并获取所有记录过脉冲的神经元的 ``SpikeCounter``
+        :return: ``SpikeCounter``, List
+        """
+        outputs = []
+        for mod in self.modules():
+            if isinstance(mod, BaseNode):
+                mod.spike_counter.commit()
+                if mod.spike_counter.windows > 0:
+                    outputs.append(mod.spike_counter)
+        return outputs
+
+    def get_running_fire_rate(self):
+        """
+        获取统计期间神经元的平均fire-rate, 等价于按元素个数 (即batch size) 加权平均的每个batch的 ``get_fire_rate``
+        :return: 所有神经元的fire-rate, 在设备上, 调用 ``.tolist()`` 时同步一次
+        """
+        counters = self.get_spike_counter()
+        if len(counters) == 0:
+            return torch.tensor([0.])
+        return torch.stack([c.fired / c.numel for c in counters])
+
+    def get_running_tot_spike(self):
+        """
+        获取统计期间平均每个样本的脉冲总数, 等价于按batch size加权平均的 ``get_tot_spike``
+        :return: 在设备上的标量
+        """
+        counters = self.get_spike_counter()
+        if len(counters) == 0:
+            return torch.tensor(0.)
+        return sum(c.total for c in counters) / counters[-1].samples
+
     def set_requires_fp(self, flag):
         for mod in self.modules():
             if hasattr(mod, 'requires_fp'):
                 mod.requires_fp = flag
 
+    def set_fp_packed(self, flag):
+        """
+        设置是否以按位压缩的形式记录神经元的feature map, 只适用于输出为 {0, 1} 的神经元
+        :param flag: 是否压缩
+        :return:
+        """
+        for mod in self.modules():
+            if isinstance(mod, BaseNode):
+                mod.set_n_fp_packed(flag)
+
+    def set_compact_grad(self, flag):
+        """
+        设置代理梯度函数是否只为反向传播保存紧凑的中间变量, 见 ``SurrogateFunctionBase`` 的 ``compact``
+        不支持的代理函数保持不变
+        :param flag: 是否开启
+        :return:
+        """
+        for mod in self.modules():
+            if isinstance(mod, SurrogateFunctionBase) and mod.supports_compact:
+                mod.compact = flag
+
     def set_requires_mem(self, flag):
         for mod in self.modules():
             if hasattr(mod, 'requires_mem'):
@@ -1,5 +1,6 @@
 import os
 import sys
+from contextlib import contextmanager
 from functools import partial
 from timm.models import register_model
 from timm.models.layers import trunc_normal_, DropPath
@@ -12,12 +13,73 @@ import torch.nn.functional as F
 from .fusion_modules import SumFusion, ConcatFusion, FiLM, GatedFusion, IdenticalFusion, AvattnlFusion, OGMGE_MetamodalFusion
 
 
+def _step_batch_norm(bn, step, x):
+    return torch.cat([type(bn).forward(bn, x_t) for x_t in x.chunk(step)])
+
+
+@contextmanager
+def step_batch_norm(module, step):
+    """
+    时间步被折叠到batch维度时, 训练模式下的BN仍然按时间步分别计算统计量, 并按时间步顺序更新running统计量
+    与逐时间步调用完全一致, 卷积等其余部分仍然在 T*B 的batch上一次计算
+    :param module: 需要折叠计算的网络
+    :param step: 折叠的时间步数
+    """
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    for bn in bns:
+        bn.forward = partial(_step_batch_norm, bn, step)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
+def _repeat_batch_norm(bn, step, x):
+    with torch.no_grad():
+        for _ in range(step - 1):
+            type(bn).forward(bn, x)
+    return type(bn).forward(bn, x)
+
+
+@contextmanager
+def repeat_batch_norm(module, step):
+    """
+    各时间步的输入完全相同, 只计算一个时间步时, 训练模式下的BN补齐其余 ``step - 1`` 次对running统计量的更新
+    每次更新使用的batch统计量都相同, 与逐时间步调用完全一致
+    :param module: 只计算一个时间步的网络
+    :param step: 原本的时间步数
+    """
+    bns = [m for m in module.modules()
+           if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training and m.track_running_stats]
+    for bn in bns:
+        bn.forward = partial(_repeat_batch_norm, bn, step)
+    try:
+        yield
+    finally:
+        for bn in bns:
+            del bn.forward
+
+
 class AVClassifier(BaseModule):
+    """
+    音视频分类网络
+    :param num_classes: 类别数
+    :param step: 仿真步长
+    :param node_type: 神经元类型, audio/visual的backbone固定使用 ``ReLUNode``
+    :param encode_type: 编码方式
+    :param time_fold: 是否将时间步折叠到batch维度, 每个backbone只调用一次, 只在backbone中的神经元都是无状态的情况下生效, 默认为 ``False``
+        折叠只减少了算子调用次数, 适合调用开销占主导的GPU; CPU上受内存带宽限制, 实测 (B=64, T=4, 128x128, 推理) 为逐步计算的 0.82x,
+        B=16, 64x64 时推理 1.04x, 训练 1.13x
+    :param args:
+    :param kwargs:
+    """
     def __init__(self, num_classes=20, step=15, node_type=LIFNode, encode_type='direct', *args, **kwargs):
         super().__init__(step, encode_type, *args, **kwargs)
 
         self.fusion = kwargs['fusion_method'] if 'fusion_method' in kwargs else False
         self.modality = kwargs['modality'] if 'modality' in kwargs else False
+        self.time_fold = kwargs['time_fold'] if 'time_fold' in kwargs else False
         n_classes = num_classes
 
         if self.fusion == 'sum':
@@ -43,6 +105,79 @@ class AVClassifier(BaseModule):
         self.audio_fc = nn.Linear(512, n_classes)
         self.visual_fc = nn.Linear(512, n_classes)
 
+    def stateless_backbone(self):
+        """
+        backbone中的神经元都是无状态的, 且不需要记录feature map等逐时间步的状态
+        """
+        for mod in self.modules():
+            if isinstance(mod, BaseNode):
+                if type(mod) not in (ReLUNode, BiasReLUNode):
+                    return False
+                if mod.requires_fp or mod.requires_mem or mod.requires_spike_count:
+                    return False
+        return True
+
+    def use_time_fold(self):
+        """
+        backbone无状态时, 才能将时间步折叠到batch维度
+        """
+        return self.time_fold and self.stateless_backbone()
+
+    def use_static_input(self, *inputs):
+        """
+        direct编码的静态输入由 ``repeat`` 沿时间维度扩展得到, 时间维度的stride为0, 各时间步完全相同.
+        backbone无状态时每个时间步的输出也完全相同, 只需要计算一个时间步
+        :param inputs: shape [b, t, ...] 的输入, 不存在的模态为 ``None``
+        """
+        if self.step == 1 or self.encoder.encode_type != 'direct' or self.layer_by_layer or self.temporal_flatten \
+                or self.encoder.no_encode or self.encoder.groups != 1:
+            return False
+        if not all(x is None or (x.dim() >= 5 and x.stride(1) == 0) for x in inputs):
+            return False
+        return self.stateless_backbone()
+
+    def forward_time_fold(self, audio, visual, withSampling, step):
+        """
+        将 T 个时间步折叠为 T*B 的batch, 每个backbone只调用一次, 输出与逐时间步计算一致
+        :param audio: shape [t, b, 1, h, w]
+        :param visual: shape [t, b, 3, h, w] 或 [t, b*n, 3, h, w]
+        :param withSampling: visual是否包含多帧
+        :param step: 输入的时间步数
+        """
+        output_a, output_v = None, None
+
+        if audio is not None:
+            with step_batch_norm(self.audio_net, step):
+                a = self.audio_net(audio.flatten(0, 1))
+            a = F.adaptive_avg_pool2d(a, 1)
+            a = torch.flatten(a, 1)
+
+        if visual is not None:
+            with step_batch_norm(self.visual_net, step):
+                v = self.visual_net(visual.flatten(0, 1))
+            (_, C, H, W) = v.size()
+            if audio is not None:
+                B = audio.size()[1]
+            elif withSampling:
+                B = visual.size()[1] // 3
+            else:
+                B = visual.size()[1]
+            v = v.view(step * B, -1, C, H, W)
+            v = torch.mean(v, dim=1)
+            v = F.adaptive_avg_pool2d(v, 1)
+            v = torch.flatten(v, 1)
+
+        if self.modality == "audio":
+            output_a = self.audio_fc(a)
+            return None, None, sum(output_a.chunk(step)) / step
+
+        if self.modality == "visual":
+            output_v = self.visual_fc(v)
+            return None, None, sum(output_v.chunk(step)) / step
+
+        output_a, output_v, out = self.fusion_module(a, v)
+        return sum(output_a.chunk(step)) / step, sum(output_v.chunk(step)) / step, sum(out.chunk(step)) / step
+
     def forward(self, input):
         """
             audio: shape [128, t, 1, 128, 128]
@@ -55,6 +190,34 @@ class AVClassifier(BaseModule):
         else:
             audio, visual = input
 
+        # 静态输入只取一个时间步计算, 输出复制到所有时间步, BN的running统计量按原本的时间步数更新
+        static = self.use_static_input(audio, visual)
+        if static:
+            audio = audio[:, :1] if audio is not None else None
+            visual = visual[:, :1] if visual is not None else None
+            with repeat_batch_norm(self, self.step):
+                output_a, output_v, out = self.forward_step(audio, visual, 1)
+            return self.mean_step(output_a, self.step), self.mean_step(output_v, self.step), \
+                self.mean_step(out, self.step)
+
+        return self.forward_step(audio, visual, self.step)
+
+    @staticmethod
+    def mean_step(output, step):
+        """
+        与逐时间步计算时对 ``step`` 个相同输出求平均的结果完全一致
+        """
+        if output is None or step == 1:
+            return output
+        outputs = [output] * step
+        return sum(outputs) / len(outputs)
+
+    def forward_step(self, audio, visual, step):
+        """
+        :param audio: shape [b, step, 1, h, w]
+        :param visual: shape [b, step, 3, h, w] 或 [b, step, 3, n, h, w]
+        :param step: 输入的时间步数
+        """
         withSampling = False
 
         if visual is not None:
@@ -73,8 +236,10 @@ class AVClassifier(BaseModule):
             audio, visual = self.encoder(audio), self.encoder(visual)
         self.reset()
 
+        if self.use_time_fold():
+            return self.forward_time_fold(audio, visual, withSampling, step)
+
         output_a_list, output_v_list, disc_pred_a_list, disc_pred_v_list, out_list = [], [], [], [], []
-        step = self.step
 
         if self.modality == "audio":
             for t in range(step):
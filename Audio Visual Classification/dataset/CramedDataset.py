@@ -1,5 +1,6 @@
 import copy
 import csv
+import json
 import os
 import pickle
 import librosa
@@ -14,6 +15,46 @@ import pdb
 import PIL
 import torchaudio
 
+from braincog.datasets.manifest import FileManifest, file_stat, load_manifest
+
+STORE_INDEX = 'index.json'
+
+
+class SpectrogramLoader(object):
+    """
+    从wav文件计算224x224的log谱图, 与原来 __getitem__ 中的计算一致, 只构建一次 transform
+    """
+
+    def __init__(self):
+        self.stft = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=353, power=None, pad_mode='constant')
+        self.resize = transforms.Compose([
+            transforms.Resize((224, 224)),  # 将频谱图像调整到224x224
+            transforms.ToTensor(),
+        ])
+
+    def __call__(self, audio_file_path):
+        waveform, sample_rate = torchaudio.load(audio_file_path, normalize=True)
+        waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=22050)
+        waveform = torch.clamp(waveform, -1, 1)
+
+        spectrogram = self.stft(waveform)
+        spectrogram = torch.log(torch.abs(spectrogram) + 1e-7)
+
+        spectrogram = PIL.Image.fromarray(spectrogram.squeeze().numpy())  # (249, 257)
+        return self.resize(spectrogram)
+
+
+_loader = None
+
+
+def _store_worker(item):
+    global _loader
+    if _loader is None:
+        _loader = SpectrogramLoader()
+    audio_path, visual_path = item
+    return _loader(audio_path).numpy(), os.listdir(visual_path)
+
+
 class CramedDataset(Dataset):
 
     def __init__(self, args, mode='train'):
@@ -37,19 +78,93 @@ class CramedDataset(Dataset):
         else:
             csv_file = self.test_csv
 
-        with open(csv_file, encoding='UTF-8-sig') as f2:
-            csv_reader = csv.reader(f2)
-            for item in csv_reader:
-                audio_path = os.path.join(self.audio_feature_path, item[0] + '.wav')
-                visual_path = os.path.join(self.visual_feature_path, 'Image-{:02d}-FPS'.format(self.args.fps), item[0])
+        visual_root = os.path.join(self.visual_feature_path, 'Image-{:02d}-FPS'.format(self.args.fps))
+
+        def build():
+            paths, labels, stats = [], [], []
+            with open(csv_file, encoding='UTF-8-sig') as f2:
+                csv_reader = csv.reader(f2)
+                for item in csv_reader:
+                    audio_path = os.path.join(self.audio_feature_path, item[0] + '.wav')
+                    visual_path = os.path.join(visual_root, item[0])
+
+                    # 一次 stat 同时得到是否存在, 大小和mtime
+                    stat = (file_stat(audio_path), file_stat(visual_path))
+                    if stat[0][0] >= 0 and stat[1][0] >= 0:
+                        paths.append((audio_path, visual_path))
+                        labels.append(class_dict[item[1]])
+                        stats.append(stat)
+            return FileManifest(paths, labels, watch=[csv_file, self.audio_feature_path, visual_root], stats=stats)
+
+        # 文件清单只在第一次或者csv, 音频目录, 帧目录变化之后重新扫描
+        manifest_dir = getattr(args, 'manifest_dir', None)
+        manifest_file = os.path.join(manifest_dir, '{}_{}_{:02d}fps.pkl'.format(args.dataset, mode, args.fps)) \
+            if manifest_dir else None
+        manifest = load_manifest(manifest_file, (csv_file, self.audio_feature_path, visual_root), build)
+        for (audio_path, visual_path), label in zip(manifest.paths, manifest.labels):
+            self.image.append(visual_path)
+            self.audio.append(audio_path)
+            self.label.append(label)
+
+        self.spectrogram_loader = SpectrogramLoader()
+        if self.mode == 'train':
+            self.transform = transforms.Compose([
+                transforms.RandomResizedCrop(224),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            ])
+        else:
+            self.transform = transforms.Compose([
+                transforms.Resize(size=(224, 224)),
+                transforms.ToTensor(),
+                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+            ])
+
+        # 预处理好的谱图存储, 不存在时退回到逐个样本解码
+        self.store_path = getattr(args, 'store_path', None)
+        self.store = None
+        self.shards = {}
+        if self.store_path:
+            self.store = self.load_store()
 
-                if os.path.exists(audio_path) and os.path.exists(visual_path):
-                    self.image.append(visual_path)
-                    self.audio.append(audio_path)
-                    self.label.append(class_dict[item[1]])
-                else:
-                    continue
+    def store_dir(self):
+        return os.path.join(self.store_path, self.mode)
 
+    def load_store(self):
+        """
+        读取存储的索引, 只保留已经写完的shard中的样本
+        :return: {audio_path: (shard, offset, frames)}, 存储不存在时返回 ``None``
+        """
+        index_file = os.path.join(self.store_dir(), STORE_INDEX)
+        if not os.path.exists(index_file):
+            print('Spectrogram store {} not found, decoding on the fly'.format(index_file))
+            return None
+        with open(index_file) as f:
+            index = json.load(f)
+        store = {}
+        for shard in index['shards']:
+            if not shard['done']:
+                continue
+            for offset, (audio_path, frames) in enumerate(zip(shard['audio'], shard['frames'])):
+                store[audio_path] = (shard['file'], offset, frames)
+        missing = sum(1 for audio_path in self.audio if audio_path not in store)
+        if missing > 0:
+            print('{} of {} samples are missing from {}, decoding them on the fly'.format(
+                missing, len(self.audio), self.store_dir()))
+        return store
+
+    def get_shard(self, name):
+        # 每个worker进程各自打开memmap, copy-on-write模式下切片不会复制数据
+        if name not in self.shards:
+            self.shards[name] = np.load(os.path.join(self.store_dir(), name), mmap_mode='c')
+        return self.shards[name]
+
+    def __getstate__(self):
+        # 打开的memmap不随dataset传给DataLoader的worker
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
 
     def __len__(self):
         return len(self.image)
@@ -77,43 +192,20 @@ class CramedDataset(Dataset):
 
         audio_file_path = self.audio[idx]
 
-        waveform, sample_rate = torchaudio.load(audio_file_path, normalize=True)
-        waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=22050)
-        waveform = torch.clamp(waveform, -1, 1)
-
-        stft_transforms = torchaudio.transforms.Spectrogram(n_fft=512, hop_length=353, power=None, pad_mode='constant')
-        spectrogram = stft_transforms(waveform)
-        spectrogram = torch.log(torch.abs(spectrogram) + 1e-7)
-
-        spectrogram = PIL.Image.fromarray(spectrogram.squeeze().numpy())  # (249, 257)
-
-        spectrogram = transforms.Compose([
-            transforms.Resize((224, 224)),  # 将频谱图像调整到224x224
-            transforms.ToTensor(),
-        ])(spectrogram)
-
-        if self.mode == 'train':
-            transform = transforms.Compose([
-                transforms.RandomResizedCrop(224),
-                transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            ])
+        if self.store is not None and audio_file_path in self.store:
+            shard, offset, image_samples = self.store[audio_file_path]
+            spectrogram = torch.from_numpy(self.get_shard(shard)[offset])
         else:
-            transform = transforms.Compose([
-                transforms.Resize(size=(224, 224)),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            ])
+            spectrogram = self.spectrogram_loader(audio_file_path)
+            image_samples = os.listdir(self.image[idx])
 
         # Visual
-        image_samples = os.listdir(self.image[idx])
         select_index = np.random.choice(len(image_samples), size=self.args.fps, replace=False)
         select_index.sort()
         images = torch.zeros((self.args.fps, 3, 224, 224))
         for i in range(self.args.fps):
             img = Image.open(os.path.join(self.image[idx], image_samples[i])).convert('RGB')
-            img = transform(img)
+            img = self.transform(img)
             images[i] = img
 
         images = torch.permute(images, (1,0,2,3))
@@ -121,4 +213,82 @@ class CramedDataset(Dataset):
         # label
         label = self.label[idx]
 
-        return spectrogram, images, label
\ No newline at end of file
+        return spectrogram, images, label
+
+
+def build_store(args, mode='train', shard_size=512, workers=8):
+    """
+    一次性地将所有样本的谱图和帧列表写入按shard划分的 .npy 文件, 可中断后继续
+    每写完一个shard就原子地更新索引, 重新运行时跳过已经完成的shard
+    :param args: 与 ``CramedDataset`` 相同的参数, 需要包含 ``store_path``
+    :param mode: ``train`` 或 ``test``
+    :param shard_size: 每个shard的样本数
+    :param workers: 计算谱图的进程数
+    """
+    from multiprocessing import Pool
+
+    dataset = CramedDataset(args, mode=mode)
+    root = dataset.store_dir()
+    os.makedirs(root, exist_ok=True)
+    index_file = os.path.join(root, STORE_INDEX)
+
+    items = list(zip(dataset.audio, dataset.image))
+    chunks = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+    shards = {}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            shards = {s['file']: s for s in json.load(f)['shards'] if s['done']}
+
+    def save_index():
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump({'shards': [shards[k] for k in sorted(shards)]}, f)
+        os.replace(index_file + '.tmp', index_file)
+
+    with Pool(workers) as pool:
+        for k, chunk in enumerate(chunks):
+            name = 'spectrogram_{:04d}.npy'.format(k)
+            audio = [a for a, _ in chunk]
+            if name in shards and shards[name]['audio'] == audio:
+                continue
+
+            tmp = os.path.join(root, name + '.tmp')
+            array = None
+            frames = []
+            for i, (spectrogram, frame_list) in enumerate(pool.imap(_store_worker, chunk)):
+                if array is None:
+                    array = np.lib.format.open_memmap(tmp, mode='w+', dtype=spectrogram.dtype,
+                                                      shape=(len(chunk),) + spectrogram.shape)
+                array[i] = spectrogram
+                frames.append(frame_list)
+            array.flush()
+            del array
+            os.replace(tmp, os.path.join(root, name))
+
+            shards[name] = {'file': name, 'audio': audio, 'frames': frames, 'done': True}
+            save_index()
+            print('[{}] shard {}/{} written'.format(mode, k + 1, len(chunks)))
+
+    # 样本数变少时去掉多余的shard, 先更新索引再删除文件, 读取方不会引用到已删除的shard
+    names = set('spectrogram_{:04d}.npy'.format(k) for k in range(len(chunks)))
+    shards = {k: v for k, v in shards.items() if k in names}
+    save_index()
+    for name in os.listdir(root):
+        if name.startswith('spectrogram_') and name not in names:
+            os.remove(os.path.join(root, name))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Preprocess CREMA-D spectrograms into a memory-mapped store')
+    parser.add_argument('--dataset', default='CREMAD', type=str)
+    parser.add_argument('--fps', default=1, type=int)
+    parser.add_argument('--audio_path', default='/mnt/home/hexiang/datasets/CREMA-D/AudioWAV/', type=str)
+    parser.add_argument('--visual_path', default='/mnt/home/hexiang/datasets/CREMA-D/', type=str)
+    parser.add_argument('--store_path', required=True, type=str, help='where to write the spectrogram store')
+    parser.add_argument('--shard_size', default=512, type=int)
+    parser.add_argument('--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    for mode in ['train', 'test']:
+        build_store(args, mode=mode, shard_size=args.shard_size, workers=args.workers)
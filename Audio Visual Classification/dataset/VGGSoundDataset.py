@@ -12,6 +12,11 @@ from torchvision import transforms
 import pdb
 import random
 
+from braincog.datasets.manifest import FileManifest, file_stat, load_manifest
+
+VGGSOUND_CSV = '/home/hudi/OGM-GE_CVPR2022/data/VGGSound/vggsound.csv'
+VGGSOUND_ROOT = '/data/users/xiaokang_peng/VGGsound/'
+
 class VGGSound(Dataset):
 
     def __init__(self, args, mode='train'):
@@ -26,27 +31,46 @@ class VGGSound(Dataset):
         train_class = []
         test_class  = []
 
-        with open('/home/hudi/OGM-GE_CVPR2022/data/VGGSound/vggsound.csv') as f:
-            csv_reader = csv.reader(f)
-
-            for item in csv_reader:
-                if item[3] == 'train':
-                    video_dir = os.path.join('/data/users/xiaokang_peng/VGGsound/', 'train-videos/train-set-img', 'Image-{:02d}-FPS'.format(self.args.fps), item[0]+'_'+item[1]+'.mp4')
-                    audio_dir = os.path.join('/data/users/xiaokang_peng/VGGsound/', 'train-audios/train-set', item[0]+'_'+item[1]+'.wav')
-                    if os.path.exists(video_dir) and os.path.exists(audio_dir) and len(os.listdir(video_dir))>3 :
-                        train_video_data.append(video_dir)
-                        train_audio_data.append(audio_dir)
-                        if item[2] not in train_class: train_class.append(item[2])
-                        train_label.append(item[2])
-
-                if item[3] == 'test':
-                    video_dir = os.path.join('/data/users/xiaokang_peng/VGGsound/', 'test-videos/test-set-img', 'Image-{:02d}-FPS'.format(self.args.fps), item[0]+'_'+item[1]+'.mp4')
-                    audio_dir = os.path.join('/data/users/xiaokang_peng/VGGsound/', 'test-audios/test-set', item[0]+'_'+item[1]+'.wav')
-                    if os.path.exists(video_dir) and os.path.exists(audio_dir) and len(os.listdir(video_dir))>3:
-                        test_video_data.append(video_dir)
-                        test_audio_data.append(audio_dir)
-                        if item[2] not in test_class: test_class.append(item[2])
-                        test_label.append(item[2])
+        video_root = {split: os.path.join(VGGSOUND_ROOT, '{0}-videos/{0}-set-img'.format(split),
+                                          'Image-{:02d}-FPS'.format(self.args.fps)) for split in ('train', 'test')}
+        audio_root = {split: os.path.join(VGGSOUND_ROOT, '{0}-audios/{0}-set'.format(split)) for split in ('train', 'test')}
+
+        def build():
+            # 训练集和测试集一起扫描, 标签为 (split, 类别名)
+            paths, labels, stats = [], [], []
+            with open(VGGSOUND_CSV) as f:
+                csv_reader = csv.reader(f)
+
+                for item in csv_reader:
+                    if item[3] not in ('train', 'test'):
+                        continue
+                    video_dir = os.path.join(video_root[item[3]], item[0]+'_'+item[1]+'.mp4')
+                    audio_dir = os.path.join(audio_root[item[3]], item[0]+'_'+item[1]+'.wav')
+                    stat = (file_stat(video_dir), file_stat(audio_dir))
+                    if stat[0][0] >= 0 and stat[1][0] >= 0 and len(os.listdir(video_dir))>3:
+                        paths.append((video_dir, audio_dir))
+                        labels.append((item[3], item[2]))
+                        stats.append(stat)
+            watch = [VGGSOUND_CSV] + list(video_root.values()) + list(audio_root.values())
+            return FileManifest(paths, labels, watch=watch, stats=stats)
+
+        # 文件清单只在第一次或者csv, 视频和音频目录变化之后重新扫描
+        manifest_dir = getattr(args, 'manifest_dir', None)
+        manifest_file = os.path.join(manifest_dir, 'VGGSound_{:02d}fps.pkl'.format(self.args.fps)) if manifest_dir else None
+        manifest = load_manifest(manifest_file, (VGGSOUND_CSV, video_root, audio_root), build)
+
+        for (video_dir, audio_dir), (split, label) in zip(manifest.paths, manifest.labels):
+            if split == 'train':
+                train_video_data.append(video_dir)
+                train_audio_data.append(audio_dir)
+                if label not in train_class: train_class.append(label)
+                train_label.append(label)
+
+            if split == 'test':
+                test_video_data.append(video_dir)
+                test_audio_data.append(audio_dir)
+                if label not in test_class: test_class.append(label)
+                test_label.append(label)
 
         assert len(train_class) == len(test_class)
         self.classes = train_class
@@ -96,6 +96,10 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress):
     model.eval()
     end = time.time()
     last_idx = len(loader) - 1
+    if not args.distributed:
+        # 流式统计脉冲, 不再每个batch保存feature map并同步
+        model.set_spike_count(True)
+        model.reset_spike_count()
     with torch.no_grad():
         for batch_idx, (inputs, target) in enumerate(loader):
             if args.dataset == "UrbanSound8K" or args.dataset == "AvCifar10" or args.dataset == "CREMAD":
@@ -149,13 +153,6 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress):
 
             closs = torch.tensor([0.], device=loss.device)
 
-            if not args.distributed:
-                spike_rate_avg_layer = model.get_fire_rate().tolist()
-                threshold = model.get_threshold()
-                threshold_str = ['{:.3f}'.format(i) for i in threshold]
-                spike_rate_avg_layer_str = ['{:.3f}'.format(i) for i in spike_rate_avg_layer]
-                tot_spike = model.get_tot_spike()
-
             reduced_loss = loss.data
 
             torch.cuda.synchronize()
@@ -166,6 +163,14 @@ def validate(model, loader, loss_fn, args, amp_autocast=suppress):
 
             batch_time_m.update(time.time() - end)
             end = time.time()
+
+    if not args.distributed:
+        spike_rate_avg_layer = model.get_running_fire_rate().tolist()
+        threshold = model.get_threshold()
+        threshold_str = ['{:.3f}'.format(i) for i in threshold]
+        spike_rate_avg_layer_str = ['{:.3f}'.format(i) for i in spike_rate_avg_layer]
+        tot_spike = model.get_running_tot_spike()
+        model.set_spike_count(False)
     return losses_m.avg, top1_m.avg
 
 
@@ -1,7 +1,6 @@
 import argparse
 import os
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
@@ -13,7 +12,9 @@ from dataset.CramedDataset import CramedDataset
 from dataset.VGGSoundDataset import VGGSound
 from dataset.dataset import AVDataset
 from models.basic_model import AVClassifier
-from utils.utils import setup_seed, weight_init
+from utils.evaluation import ScoreAccumulator
+from utils.utils import CheckpointManager, setup_seed, weight_init, modality_params, ogm_ge_coeff, modulate_grad_, \
+    modality_scores, split_micro_batches, SNRNoise
 
 from tqdm import tqdm
 import math
@@ -31,8 +32,14 @@ def get_arguments():
     parser.add_argument('--use_video_frames', default=3, type=int)
     parser.add_argument('--audio_path', default='/mnt/home/hexiang/datasets/CREMA-D/AudioWAV/', type=str)
     parser.add_argument('--visual_path', default='/mnt/home/hexiang/datasets/CREMA-D/', type=str)
+    parser.add_argument('--store_path', default=None, type=str,
+                        help='preprocessed spectrogram store built by dataset/CramedDataset.py, decode on the fly if absent')
+    parser.add_argument('--manifest_dir', default=None, type=str,
+                        help='cache the scanned file lists here, rescan only when the data directories change')
 
     parser.add_argument('--batch_size', default=64, type=int)
+    parser.add_argument('--micro_batches', default=1, type=int,
+                        help='split every batch into this many micro-batches and accumulate their gradients')
     parser.add_argument('--epochs', default=100, type=int)
 
     parser.add_argument('--optimizer', default='sgd', type=str, choices=['sgd', 'adam'])
@@ -45,6 +52,7 @@ def get_arguments():
     parser.add_argument('--alpha', required=True, type=float, help='alpha in OGM-GE')
 
     parser.add_argument('--ckpt_path', required=True, type=str, help='path to save trained models')
+    parser.add_argument('--keep_top_k', default=1, type=int, help='how many best checkpoints to keep')
     parser.add_argument('--train', action='store_true', help='turn on train mode')
 
     parser.add_argument('--use_tensorboard', action='store_true', help='whether to visualize')
@@ -161,7 +169,6 @@ def compute_inverse_loss(output_a, output_v, out, label, criterion, rho):
 def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
     criterion = nn.CrossEntropyLoss()
     bce = nn.BCELoss()
-    softmax = nn.Softmax(dim=1)
     relu = nn.ReLU(inplace=True)
     tanh = nn.Tanh()
 
@@ -172,6 +179,10 @@ def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
     _loss_a = 0
     _loss_v = 0
 
+    # 因为是并行的所以有一个moudle前缀. 因此序列索引为1.
+    audio_conv_params = modality_params(model, 'audio', depth=1, dim=4)
+    visual_conv_params = modality_params(model, 'visual', depth=1, dim=4)
+    fusion_params = modality_params(model, 'fusion', depth=1)
 
     for step, (spec, image, label) in tqdm(enumerate(dataloader), total=len(dataloader)):
 
@@ -180,52 +191,64 @@ def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
         image = image.to(device)
         label = label.to(device)
 
-        # 判别器的标签，音频为0，视觉为1
-        audio_labels = torch.zeros(spec.shape[0], 1).to(device)
-        visual_labels = torch.ones(image.shape[0], 1).to(device)
-
         optimizer.zero_grad()
 
-        # TODO: make it simpler and easier to extend
-        if args.fusion_method == 'metamodal':
-            output_a, output_v, disc_pred_a, disc_pred_v, out = model(spec.float(), image.float())
-        else:
-            a, v, out = model(spec.float(), image.float())
-            a = a.detach()
-            v = v.detach()
-            weight_size = model.module.fusion_module.fc_out.weight.size(1)
-            output_v = (torch.mm(v, torch.transpose(model.module.fusion_module.fc_out.weight[:, weight_size // 2:], 0, 1))
-                     + model.module.fusion_module.fc_out.bias / 2)
+        # 切成micro-batch依次前向/反向, 梯度在 .grad 中累积, 置信度之和在整个batch上累积后再计算调制系数
+        micro_batches = split_micro_batches([spec, image], label, args.micro_batches)
+        accumulate = len(micro_batches) > 1
+        scores = None
+        loss_total = loss_a_total = loss_v_total = 0.
+        for (micro_spec, micro_image), micro_label, weight in micro_batches:
+            # 判别器的标签，音频为0，视觉为1
+            audio_labels = torch.zeros(micro_spec.shape[0], 1).to(device)
+            visual_labels = torch.ones(micro_image.shape[0], 1).to(device)
+
+            # TODO: make it simpler and easier to extend
+            if args.fusion_method == 'metamodal':
+                output_a, output_v, disc_pred_a, disc_pred_v, out = model(micro_spec.float(), micro_image.float())
+            else:
+                a, v, out = model(micro_spec.float(), micro_image.float())
+                a = a.detach()
+                v = v.detach()
+                weight_size = model.module.fusion_module.fc_out.weight.size(1)
+                output_v = (torch.mm(v, torch.transpose(model.module.fusion_module.fc_out.weight[:, weight_size // 2:], 0, 1))
+                         + model.module.fusion_module.fc_out.bias / 2)
 
-            output_a = (torch.mm(a, torch.transpose(model.module.fusion_module.fc_out.weight[:, :weight_size // 2], 0, 1))
-                     + model.module.fusion_module.fc_out.bias / 2)
+                output_a = (torch.mm(a, torch.transpose(model.module.fusion_module.fc_out.weight[:, :weight_size // 2], 0, 1))
+                         + model.module.fusion_module.fc_out.bias / 2)
 
 
-        # inverse_loss = compute_inverse_loss(softmax(output_a), softmax(output_v), softmax(out), label, criterion, args.rho)
+            # inverse_loss = compute_inverse_loss(softmax(output_a), softmax(output_v), softmax(out), label, criterion, args.rho)
 
-        cls_loss = criterion(out, label)
+            cls_loss = criterion(out, micro_label)
 
-        if args.meta_ratio >= 0.0:
-            loss_v = bce(disc_pred_v, visual_labels)
-            loss_a = bce(disc_pred_a, audio_labels)
-            loss = args.meta_ratio * (loss_a + loss_v) + cls_loss
-        else:
-            loss_v = criterion(output_v, label)
-            loss_a = criterion(output_a, label)
-            loss = cls_loss
+            if args.meta_ratio >= 0.0:
+                loss_v = bce(disc_pred_v, visual_labels)
+                loss_a = bce(disc_pred_a, audio_labels)
+                loss = args.meta_ratio * (loss_a + loss_v) + cls_loss
+            else:
+                loss_v = criterion(output_v, micro_label)
+                loss_a = criterion(output_a, micro_label)
+                loss = cls_loss
 
-        # if epoch > args.inverse_epoch:  # 大于设定的才启用
-        #     loss = loss + inverse_loss
-        loss.backward()
+            # if epoch > args.inverse_epoch:  # 大于设定的才启用
+            #     loss = loss + inverse_loss
+            (loss * weight if accumulate else loss).backward()
 
+            micro_scores = modality_scores(micro_label, output_v, output_a, out)
+            scores = micro_scores if scores is None else [s + m for s, m in zip(scores, micro_scores)]
+            if accumulate:
+                loss_total = loss_total + loss.detach() * weight
+                loss_a_total = loss_a_total + loss_a.detach() * weight
+                loss_v_total = loss_v_total + loss_v.detach() * weight
+
+        if accumulate:
+            loss, loss_a, loss_v = loss_total, loss_a_total, loss_v_total
 
         # Modulation starts here !
-        score_v = sum([softmax(output_v)[i][label[i]] for i in range(output_v.size(0))])
-        score_a = sum([softmax(output_a)[i][label[i]] for i in range(output_a.size(0))])
-        score_av = sum([softmax(out)[i][label[i]] for i in range(out.size(0))])
+        score_v, score_a, score_av = scores
 
         ratio_v = score_v / score_a
-        ratio_a = 1 / ratio_v
         ratio_av = (score_a + score_v) / score_av
 
         """
@@ -236,12 +259,7 @@ def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
         coeff_u is k_t_u, where t means iteration steps and u is modality indicator, either a or v.
         """
 
-        if ratio_v > 1:
-            coeff_v = 1 - tanh(args.alpha * relu(ratio_v))
-            coeff_a = 1
-        else:
-            coeff_a = 1 - tanh(args.alpha * relu(ratio_a))
-            coeff_v = 1
+        coeff_a, coeff_v = ogm_ge_coeff(ratio_v, args.alpha)
         coeff_av = 1 + tanh(torch.tensor(1.0)) - tanh(relu(ratio_av))  # a 和 v 越弱, av出来越强
 
         if args.use_tensorboard:
@@ -256,22 +274,12 @@ def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
                                                'av': coeff_av}, iteration)
 
         if args.modulation_starts <= epoch <= args.modulation_ends: # bug fixed
-            for name, parms in model.named_parameters():
-                layer = str(name).split('.')[1]  # 因为是并行的所以有一个moudle前缀. 因此序列索引为1.
-
-                if 'audio' in layer and len(parms.grad.size()) == 4:
-                    if args.modulation == 'OGM_GE':  # bug fixed
-                        parms.grad = parms.grad * coeff_a + \
-                                     torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
-
-                if 'visual' in layer and len(parms.grad.size()) == 4:
-                    if args.modulation == 'OGM_GE':  # bug fixed
-                        parms.grad = parms.grad * coeff_v + \
-                                     torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
-
-                if 'fusion' in layer:
-                    if args.inverse is True:
-                        parms.grad = parms.grad * coeff_av
+            if args.modulation == 'OGM_GE':  # bug fixed
+                modulate_grad_(audio_conv_params, coeff_a)
+                modulate_grad_(visual_conv_params, coeff_v)
+
+            if args.inverse is True:
+                modulate_grad_(fusion_params, coeff_av, noise=False)
         else:
             pass
 
@@ -288,40 +296,6 @@ def train_epoch(args, epoch, model, device, dataloader, optimizer, scheduler):
     return _loss / len(dataloader), _loss_a / len(dataloader), _loss_v / len(dataloader)
 
 
-def calculate_map(predictions, labels, n_classes):
-    APs = []
-
-    for class_id in range(n_classes):
-        # 提取所有样本的当前类别的预测分数
-        class_scores = predictions[:, class_id]
-        true_class = (labels == class_id).float()
-
-        # 按分数排序样本
-        sorted_indices = torch.argsort(class_scores, descending=True)
-        true_class = true_class[sorted_indices]
-
-        # 计算每个样本的精度和召回
-        tp = torch.cumsum(true_class, dim=0)
-        fp = torch.cumsum(1 - true_class, dim=0)
-
-        precision = tp / (tp + fp)
-        recall = tp / true_class.sum()
-
-        # 计算插值精度
-        precision = torch.cat([torch.tensor([1]).cuda(), precision])
-        recall = torch.cat([torch.tensor([0]).cuda(), recall])
-
-        for i in range(precision.size(0) - 1, 0, -1):
-            precision[i - 1] = torch.max(precision[i - 1], precision[i])
-
-        # 计算AP
-        AP = torch.sum((recall[1:] - recall[:-1]) * precision[1:])
-        APs.append(AP)
-
-    # 计算MAP
-    MAP = torch.mean(torch.tensor(APs))
-    return MAP.item()
-
 def valid(args, model, device, dataloader):
     softmax = nn.Softmax(dim=1)
 
@@ -338,26 +312,24 @@ def valid(args, model, device, dataloader):
 
     with torch.no_grad():
         model.eval()
-        # TODO: more flexible
-        num = [0.0 for _ in range(n_classes)]
-        acc = [0.0 for _ in range(n_classes)]
-        acc_a = [0.0 for _ in range(n_classes)]
-        acc_v = [0.0 for _ in range(n_classes)]
-
-        predictions = []
-        labels = []
+        # 融合, 音频, 视觉三个输出预测正确的样本数, 留在设备上
+        num = 0
+        correct = torch.zeros(3, dtype=torch.long, device=device)
+        scores = ScoreAccumulator(n_classes)
+        # 固定种子在设备上加噪, 不同SNR下的结果可以复现
+        snr_noise = SNRNoise(seed=args.seed, reduce='batch')
         for step, (spec, image, label) in enumerate(dataloader):
 
-            if args.snr > 0:
-                if args.snrModality == 'visual':
-                    image = image + torch.randn(image.shape) * math.sqrt(torch.mean(torch.pow(image, 2)) / math.pow(10, args.snr / 10))
-                elif args.snrModality == 'audio':
-                    spec = spec + torch.randn(spec.shape) * math.sqrt(torch.mean(torch.pow(spec, 2)) / math.pow(10, args.snr / 10))
-
             spec = spec.to(device)
             image = image.to(device)
             label = label.to(device)
 
+            if args.snr > 0:
+                if args.snrModality == 'visual':
+                    image = snr_noise(image, args.snr)
+                elif args.snrModality == 'audio':
+                    spec = snr_noise(spec, args.snr)
+
             if args.fusion_method == 'metamodal':
                 out_a, out_v, _, _, out = model(spec.float(), image.float())
             else:
@@ -369,39 +341,21 @@ def valid(args, model, device, dataloader):
                 out_a = (torch.mm(out_a, torch.transpose(model.module.fusion_module.fc_out.weight[:, :512], 0, 1)) +
                          model.module.fusion_module.fc_out.bias / 2)
 
-            predictions.append(out)
-            labels.append(label)
+            scores.update(out, label)
 
             prediction = softmax(out)
             pred_v = softmax(out_v)
             pred_a = softmax(out_a)
 
-            for i in range(image.shape[0]):
-
-                ma = np.argmax(prediction[i].cpu().data.numpy())
-                v = np.argmax(pred_v[i].cpu().data.numpy())
-                a = np.argmax(pred_a[i].cpu().data.numpy())
-                num[label[i]] += 1.0
-
-                # pdb.set_trace()
-                if np.asarray(label[i].cpu()) == ma:
-                    acc[label[i]] += 1.0
-                if np.asarray(label[i].cpu()) == v:
-                    acc_v[label[i]] += 1.0
-                if np.asarray(label[i].cpu()) == a:
-                    acc_a[label[i]] += 1.0
-
-    predictions = torch.cat(predictions, dim=0)  # 假设你有一个保存所有预测值的列表
-    labels = torch.cat(labels, dim=0)  # 假设你有一个保存所有真实标签的列表
-    map_value = calculate_map(predictions, labels, n_classes)
+            num += label.size(0)
+            correct += torch.stack([(pred.argmax(dim=1) == label).sum() for pred in (prediction, pred_a, pred_v)])
 
-    from sklearn.metrics import roc_auc_score
-    labels_one_hot = torch.nn.functional.one_hot(labels, num_classes=6).cpu().numpy()
-    # 计算AUC-ROC
-    roc_auc = roc_auc_score(labels_one_hot, predictions.cpu().numpy(), multi_class='ovr')
-    print("roc_auc:{}".format(roc_auc))
+    # 与 sklearn 的 average_precision_score / roc_auc_score (macro) 一致
+    metrics = scores.compute()
+    print("roc_auc:{}".format(metrics['auc_mean']))
 
-    return sum(acc) / sum(num), sum(acc_a) / sum(num), sum(acc_v) / sum(num), map_value
+    acc, acc_a, acc_v = (correct.double() / num).tolist()
+    return acc, acc_a, acc_v, metrics['map']
 
 
 def main():
@@ -454,7 +408,8 @@ def main():
 
         best_acc = 0.0
 
-        best_models = []
+        # 后台线程写checkpoint, 保留最好的 keep_top_k 个和滚动的 last.pth
+        saver = CheckpointManager(args.ckpt_path, k=args.keep_top_k)
 
         for epoch in range(args.epochs):
 
@@ -473,51 +428,40 @@ def main():
                                                   'Audio Accuracy': acc_a,
                                                   'Visual Accuracy': acc_v}, epoch)
 
+            model_name = '{}_inverse_{}_alpha_{}_' \
+                         'bs_{}_fusion_{}_metaratio_{}_' \
+                         'epoch_{}_acc_{}_rho_{}_seed_{}.pth'.format(args.modulation,
+                                                      args.inverse,
+                                                      args.alpha,
+                                                      args.batch_size,
+                                                      args.fusion_method,
+                                                      args.meta_ratio,
+                                                      epoch, acc, args.rho, args.seed)
+
+            saved_dict = {'saved_epoch': epoch,
+                          'modulation': args.modulation,
+                          'alpha': args.alpha,
+                          'fusion': args.fusion_method,
+                          'acc': acc,
+                          'model': model.state_dict(),
+                          'optimizer': optimizer.state_dict(),
+                          'scheduler': scheduler.state_dict()}
+
+            save_dir = saver.save(saved_dict, model_name, acc)
+
             if acc > best_acc:
                 best_acc = float(acc)
 
-                if not os.path.exists(args.ckpt_path):
-                    os.mkdir(args.ckpt_path)
-
-                model_name = '{}_inverse_{}_alpha_{}_' \
-                             'bs_{}_fusion_{}_metaratio_{}_' \
-                             'epoch_{}_acc_{}_rho_{}_seed_{}.pth'.format(args.modulation,
-                                                          args.inverse,
-                                                          args.alpha,
-                                                          args.batch_size,
-                                                          args.fusion_method,
-                                                          args.meta_ratio,
-                                                          epoch, acc, args.rho, args.seed)
-
-                saved_dict = {'saved_epoch': epoch,
-                              'modulation': args.modulation,
-                              'alpha': args.alpha,
-                              'fusion': args.fusion_method,
-                              'acc': acc,
-                              'model': model.state_dict(),
-                              'optimizer': optimizer.state_dict(),
-                              'scheduler': scheduler.state_dict()}
-
-                save_dir = os.path.join(args.ckpt_path, model_name)
-
-                torch.save(saved_dict, save_dir)
                 logger.info('The best model has been saved at {}.'.format(save_dir))
                 logger.info("Loss: {:.3f}, Acc: {:.3f}".format(batch_loss, acc))
                 logger.info("Audio Acc: {:.3f}， Visual Acc: {:.3f} ".format(acc_a, acc_v))
 
-                # 更新已保存的最佳模型列表
-                best_models.append((acc, save_dir))
-                best_models.sort(key=lambda x: x[0], reverse=True)  # 按准确率降序排序
-
-                # 如果保存的模型超过1个，则删除准确率最低的模型
-                while len(best_models) > 1:
-                    _, oldest_model_path = best_models.pop()  # 获取准确率最低的模型
-                    os.remove(oldest_model_path)  # 删除该模型文件
-
             else:
                 logger.info("Loss: {:.3f}, Acc: {:.3f}, Best Acc: {:.3f}".format(batch_loss, acc, best_acc))
                 logger.info("Audio Acc: {:.3f}， Visual Acc: {:.3f} ".format(acc_a, acc_v))
 
+        saver.close()
+
     else:
         # first load trained model
         loaded_dict = torch.load(args.ckpt_path)
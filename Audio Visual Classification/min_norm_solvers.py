@@ -204,6 +204,131 @@ class MinNormSolver:
                 return sol_vec, nd
             sol_vec = new_sol_vec
 
+    def _gram_matrix(vecs):
+        """
+        Gram matrix G[i, j] = <vecs[i], vecs[j]> computed with one matmul
+        vecs is a list of flat tensors, or a list of lists of tensors as in find_min_norm_element
+        """
+        if torch.is_tensor(vecs[0]):
+            x = torch.stack([v.flatten() for v in vecs])
+            return x @ x.t()
+        gram = 0.
+        for k in range(len(vecs[0])):
+            x = torch.stack([v[k].flatten() for v in vecs])
+            gram = gram + x @ x.t()
+        return gram
+
+    def _min_norm_element_from2_batched(v1v1, v1v2, v2v2):
+        """
+        Same as _min_norm_element_from2, elementwise on tensors without host-side branches
+        """
+        gamma = torch.where(v1v2 >= v1v1, torch.full_like(v1v1, 0.999),
+                            torch.where(v1v2 >= v2v2, torch.full_like(v1v1, 0.001),
+                                        -1.0 * ((v1v2 - v2v2) / (v1v1 + v2v2 - 2 * v1v2))))
+        cost = torch.where(v1v2 >= v1v1, v1v1,
+                           torch.where(v1v2 >= v2v2, v2v2, v2v2 + gamma * (v1v2 - v2v2)))
+        return gamma, cost
+
+    def _min_norm_2d_batched(grad_mat):
+        """
+        Same as _min_norm_2d, all pairs (i, j), i < j are solved at once and the first pair with the lowest cost is kept
+        """
+        n = grad_mat.shape[0]
+        i, j = torch.triu_indices(n, n, 1, device=grad_mat.device)
+        c, d = MinNormSolver._min_norm_element_from2_batched(grad_mat[i, i], grad_mat[i, j], grad_mat[j, j])
+        best = torch.argmin(d)
+        sol_vec = torch.zeros(n, dtype=grad_mat.dtype, device=grad_mat.device)
+        sol_vec[i[best]] = c[best]
+        sol_vec[j[best]] = 1 - c[best]
+        return sol_vec, d[best]
+
+    def _projection2simplex_batched(y):
+        """
+        Same as _projection2simplex, without the python loop over the sorted values
+        """
+        m = y.shape[0]
+        sorted_y = torch.sort(y, descending=True)[0]
+        tmax = (torch.cumsum(sorted_y, 0)[:-1] - 1) / torch.arange(1, m, dtype=y.dtype, device=y.device)
+        hit = tmax > sorted_y[1:]
+        tmax_f = torch.where(hit.any(), tmax[hit.int().argmax()], (y.sum() - 1.0) / m)
+        return torch.clamp(y - tmax_f, min=0.)
+
+    def _next_point_batched(cur_val, grad):
+        """
+        Same as _next_point
+        """
+        proj_grad = grad - grad.mean()
+        neg = proj_grad < 0
+        # 沿 proj_grad 到达各个边界 (c_i = 0 或 c_i = 1) 的步长, 只保留大于 1e-7 的
+        tm = torch.where(neg, -cur_val, 1.0 - cur_val) / proj_grad
+        valid = (tm > 1e-7) & (proj_grad != 0)
+        t = torch.where(valid, tm, torch.full_like(tm, float('inf'))).min()
+        # 没有 c_i = 0 的边界时, 步长不超过 1
+        t = torch.where((valid & neg).any(), t, torch.clamp(t, max=1.))
+
+        next_point = proj_grad * t + cur_val
+        return MinNormSolver._projection2simplex_batched(next_point)
+
+    def find_min_norm_element_batched(vecs, max_iter=None, stop_crit=None):
+        """
+        Tensor version of find_min_norm_element
+        The Gram matrix is built with one matmul on the device of vecs and the solver only works on this (tiny)
+        matrix in float64. For two tasks the closed form is returned directly. Otherwise, on CPU the projected
+        gradient descent runs with the numpy helpers on a zero-copy view of the Gram matrix, on other devices
+        it stays on the device, see _min_norm_loop_batched
+        :return: sol_vec, cost as tensors with the device and dtype of vecs, detached from the graph
+        """
+        max_iter = MinNormSolver.MAX_ITER if max_iter is None else max_iter
+        stop_crit = MinNormSolver.STOP_CRIT if stop_crit is None else stop_crit
+
+        grad_mat = MinNormSolver._gram_matrix(vecs).detach()
+        dtype = grad_mat.dtype
+        grad_mat = grad_mat.double()
+        n = grad_mat.shape[0]
+        if n < 3:
+            # This is optimal for n=2, so return the solution
+            gamma, cost = MinNormSolver._min_norm_element_from2_batched(grad_mat[0, 0], grad_mat[0, 1], grad_mat[1, 1])
+            return torch.stack([gamma, 1 - gamma]).to(dtype), cost.to(dtype)
+
+        sol_vec, nd = MinNormSolver._min_norm_2d_batched(grad_mat)
+        if grad_mat.device.type != 'cpu':
+            sol_vec, nd = MinNormSolver._min_norm_loop_batched(grad_mat, sol_vec, nd, max_iter, stop_crit)
+            return sol_vec.to(dtype), nd.to(dtype)
+
+        # CPU上每个torch算子的调用开销远大于 n x n 的计算量, 直接用numpy迭代
+        grad_mat, sol_vec, nd = grad_mat.numpy(), sol_vec.numpy(), float(nd)
+        for _ in range(max_iter):
+            g_sol = np.dot(grad_mat, sol_vec)
+            new_point = MinNormSolver._next_point(sol_vec, -1.0 * g_sol, n)
+            g_new = np.dot(grad_mat, new_point)
+            nc, nd = MinNormSolver._min_norm_element_from2(np.dot(sol_vec, g_sol), np.dot(sol_vec, g_new),
+                                                            np.dot(new_point, g_new))
+            new_sol_vec = nc * sol_vec + (1 - nc) * new_point
+            if np.sum(np.abs(new_sol_vec - sol_vec)) < stop_crit:
+                break
+            sol_vec = new_sol_vec
+        return torch.from_numpy(sol_vec).to(dtype), torch.tensor(nd, dtype=dtype)
+
+    def _min_norm_loop_batched(grad_mat, sol_vec, nd, max_iter, stop_crit, check_every=8):
+        """
+        The projected gradient descent of find_min_norm_element on the device of grad_mat
+        The convergence flag is only read back every check_every iterations. Iterations after convergence leave
+        the solution unchanged, so the result is the same as stopping as soon as the update is below stop_crit
+        """
+        done = torch.zeros((), dtype=torch.bool, device=grad_mat.device)
+        for it in range(max_iter):
+            g_sol = grad_mat @ sol_vec
+            new_point = MinNormSolver._next_point_batched(sol_vec, -1.0 * g_sol)
+            g_new = grad_mat @ new_point
+            nc, cost = MinNormSolver._min_norm_element_from2_batched(sol_vec @ g_sol, sol_vec @ g_new, new_point @ g_new)
+            new_sol_vec = nc * sol_vec + (1 - nc) * new_point
+            nd = torch.where(done, nd, cost)
+            done = done | ((new_sol_vec - sol_vec).abs().sum() < stop_crit)
+            sol_vec = torch.where(done, sol_vec, new_sol_vec)
+            if (it + 1) % check_every == 0 and done:
+                break
+        return sol_vec, nd
+
 
 def gradient_normalizers(grads, losses, normalization_type):
     gn = {}
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试在仓库根目录 (Audio Visual Classification) 下以 ``python -m pytest tests`` 运行, 与训练脚本相同的导入路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
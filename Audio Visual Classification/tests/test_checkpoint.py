@@ -0,0 +1,102 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from utils.utils import CheckpointManager, get_resume_state, load_resume_state, rng_state, set_rng_state
+
+
+def test_keeps_top_k(tmp_path):
+    random.seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 8), torch.nn.Linear(8, 2))
+    metrics = [round(random.random(), 1) for _ in range(15)]  # 保留一位小数, 制造相同的指标
+    saver = CheckpointManager(str(tmp_path), k=3)
+    for epoch, metric in enumerate(metrics):
+        saver.save({'epoch': epoch, 'model': model.state_dict()}, 'epoch_{}.pth'.format(epoch), metric)
+        committed = model[0].weight.detach().clone()
+        with torch.no_grad():
+            model[0].weight.add_(1.)  # 保存之后继续训练, 不能影响已经提交的checkpoint
+    saver.close()
+
+    # 指标相同时先保存的排在前面
+    expected = ['epoch_{}.pth'.format(e) for e in sorted(range(15), key=lambda e: metrics[e], reverse=True)[:3]]
+    assert [os.path.basename(p) for _, p in saver.checkpoints] == expected
+    assert sorted(f for f in os.listdir(tmp_path) if f != 'last.pth') == sorted(expected)
+    last = torch.load(os.path.join(tmp_path, 'last.pth'))
+    assert last['epoch'] == 14 and torch.equal(last['model']['0.weight'], committed)
+    for path in expected:
+        state = torch.load(os.path.join(tmp_path, path))
+        assert torch.allclose(state['model']['0.weight'], committed - (14 - state['epoch']), atol=1e-5)
+
+
+def test_decreasing_and_shared_file(tmp_path):
+    saver = CheckpointManager(str(tmp_path), k=2, decreasing=True)
+    assert saver.save({'x': torch.zeros(3)}, 'a.pth', 1.) is not None
+    assert saver.save({'x': torch.ones(3)}, 'b.pth', 2.) is not None
+    assert saver.save({'x': torch.full((3,), 2.)}, 'c.pth', 0.5) is not None
+    assert saver.save({'x': torch.full((3,), 3.)}, 'd.pth', 5.) is None
+    saver.wait()
+    assert sorted(os.listdir(tmp_path)) == ['a.pth', 'c.pth', 'last.pth']
+    assert torch.equal(torch.load(os.path.join(tmp_path, 'last.pth'))['x'], torch.full((3,), 3.))
+    # 既进入 top-k 又是 last 时只写一次, last 与它是同一个文件
+    saver.save({'x': torch.full((3,), 4.)}, 'e.pth', 0.1)
+    saver.close()
+    assert sorted(os.listdir(tmp_path)) == ['c.pth', 'e.pth', 'last.pth']
+    assert os.path.samefile(os.path.join(tmp_path, 'e.pth'), os.path.join(tmp_path, 'last.pth'))
+    assert not any(f.endswith('.tmp') for f in os.listdir(tmp_path))
+
+
+def test_buffers_reused_between_saves(tmp_path):
+    saver = CheckpointManager(str(tmp_path), k=0, max_pending=1)
+    w = torch.randn(16, 16)
+    for step in range(5):
+        saver.save({'w': w + step, 'step': step}, None, None)
+    saver.close()
+    # 一份正在写入, 一份在队列中, 缓冲区不随保存的次数增加
+    pool = []
+    while not saver.free.empty():
+        pool.append(saver.free.get())
+    assert len(pool) == 2
+    state = torch.load(os.path.join(tmp_path, 'last.pth'))
+    assert state['step'] == 4 and torch.equal(state['w'], w + 4)
+
+
+def test_write_error_is_raised(tmp_path):
+    saver = CheckpointManager(str(tmp_path), k=1)
+    saver.save({'f': lambda x: x}, 'a.pth', 1.)  # lambda 不能 pickle
+    with pytest.raises(Exception):
+        saver.wait()
+    saver.close()
+
+
+def test_rng_state_round_trip():
+    random.seed(1)
+    np.random.seed(1)
+    torch.manual_seed(1)
+    state = rng_state()
+    ref = (random.random(), np.random.rand(), torch.rand(1))
+    random.random(), np.random.rand(), torch.rand(1)
+    set_rng_state(state)
+    out = (random.random(), np.random.rand(), torch.rand(1))
+    assert ref[0] == out[0] and ref[1] == out[1] and torch.equal(ref[2], out[2])
+
+
+def test_resume_state(tmp_path):
+    model = torch.nn.Linear(4, 2)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    model(torch.randn(3, 4)).sum().backward()
+    optimizer.step()
+    saver = CheckpointManager(str(tmp_path), k=0, last_name='last_step.pth.tar')
+    saver.save(get_resume_state(2, 5, model=model, optimizer=optimizer, lr_scheduler=None), None, None)
+    saver.close()
+
+    state = torch.load(os.path.join(tmp_path, 'last_step.pth.tar'))
+    assert 'lr_scheduler' not in state
+    other = torch.nn.Linear(4, 2)
+    other_optimizer = torch.optim.SGD(other.parameters(), lr=0.1, momentum=0.9)
+    assert load_resume_state(state, model=other, optimizer=other_optimizer) == (2, 6)
+    assert all(torch.equal(a, b) for a, b in zip(model.state_dict().values(), other.state_dict().values()))
+    assert torch.equal(optimizer.state_dict()['state'][0]['momentum_buffer'],
+                       other_optimizer.state_dict()['state'][0]['momentum_buffer'])
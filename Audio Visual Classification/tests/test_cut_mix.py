@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+import torch
+
+from braincog.datasets import cut_mix
+
+NUM_CLASSES = 10
+BETA, PROB, GAUSSIAN_N = 1., 0.5, 3
+
+MODES = {
+    'mix_up': lambda seed: cut_mix.BatchMixUp(NUM_CLASSES, beta=BETA, prob=PROB, seed=seed),
+    'cut_mix': lambda seed: cut_mix.BatchCutMix(NUM_CLASSES, beta=BETA, prob=PROB, seed=seed),
+    'event_mix': lambda seed: cut_mix.BatchEventMix(NUM_CLASSES, beta=BETA, prob=PROB, noise=0.,
+                                                    gaussian_n=GAUSSIAN_N, seed=seed),
+    'st': lambda seed: cut_mix.BatchEventMix(NUM_CLASSES, beta=BETA, prob=PROB, noise=0., mask_type='st', seed=seed),
+    'difference': lambda seed: cut_mix.BatchEventMix(NUM_CLASSES, beta=BETA, prob=PROB, noise=0.,
+                                                     gaussian_n=GAUSSIAN_N, lam_mode='difference', seed=seed),
+}
+
+
+def per_sample_mix(mode, x, target):
+    # 按 BatchMix 抽取随机数的顺序, 用原来逐样本的函数 (rand_bbox, GMM_mask, st_mask, calc_masked_lam ...) 混合
+    batch = len(x)
+    active = np.random.rand(batch) <= PROB
+    lam = np.random.beta(BETA, BETA, size=batch)
+    index = np.random.randint(batch, size=batch)
+    out, lbs = x.clone(), []
+    for i in range(batch):
+        img, img2, lm = x[i].clone(), x[index[i]], lam[i]
+        if mode == 'mix_up':
+            img = img * lm + img2 * (1. - lm)
+        elif mode == 'cut_mix':
+            bbx1, bby1, bbx2, bby2 = cut_mix.rand_bbox(img.shape, 1. - lm)
+            lm = 1 - ((bbx2 - bbx1) * (bby2 - bby1) / (img.shape[-1] * img.shape[-2]))
+            img[:, :, bbx1:bbx2, bby1:bby2] = img2[:, :, bbx1:bbx2, bby1:bby2]
+        else:
+            if mode == 'st':
+                mask = cut_mix.st_mask(img.shape, 1. - lm)
+            else:
+                mask = cut_mix.GMM_mask(img.shape, 1. - lm, GAUSSIAN_N)
+            mix = img.clone()
+            mix[mask] = img2[mask]
+            if mode == 'difference':
+                lm = cut_mix.calc_masked_lam_with_difference(img, img2, mix, kernel_size=3)
+            else:
+                lm = cut_mix.calc_masked_lam(img, img2, mask)
+            img = mix
+        lb = cut_mix.onehot(NUM_CLASSES, target[i])
+        if active[i]:
+            out[i] = img
+            lb = lb * float(lm) + cut_mix.onehot(NUM_CLASSES, target[index[i]]) * (1. - float(lm))
+        lbs.append(lb)
+    return out, torch.stack(lbs)
+
+
+class CountingFrames(torch.utils.data.Dataset):
+    # 合成的 [T, 2, H, W] 事件帧, 记录读取的次数
+    def __init__(self, length, step=4, size=16):
+        self.length = length
+        self.shape = (step, 2, size, size)
+        self.reads = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        self.reads += 1
+        g = torch.Generator().manual_seed(idx)
+        return torch.poisson(torch.rand(self.shape, generator=g) * 2, generator=g), idx % NUM_CLASSES
+
+
+@pytest.fixture(scope='module')
+def batch():
+    dataset = CountingFrames(16)
+    return torch.utils.data.dataloader.default_collate([dataset[i] for i in range(len(dataset))])
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+def test_matches_per_sample(batch, mode):
+    x, target = batch
+    np.random.seed(0)
+    torch.manual_seed(0)
+    out, lb = MODES[mode](None)(x, target)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    ref, ref_lb = per_sample_mix(mode, x, target)
+    # GMM mask 的混合高斯按维度分开计算, 阈值附近的个别位置可能因为舍入不同
+    assert ((out - ref).abs() > 1e-4).float().mean().item() < 1e-3
+    # difference 模式下样本与自己混合时, 原函数的 lam 为 0/0, 两种实现都是 nan
+    assert torch.allclose(lb, ref_lb, rtol=0., atol=1e-3, equal_nan=True)
+    valid = ~lb.isnan().any(1)
+    assert (mode == 'difference' or valid.all()) and valid.sum() > len(valid) // 2
+    assert (lb[valid].sum(1) - 1).abs().max().item() < 1e-5
+
+
+@pytest.mark.parametrize('mode', list(MODES))
+def test_seed_is_reproducible(batch, mode):
+    x, target = batch
+    out1, lb1 = MODES[mode](1)(x, target)
+    torch.manual_seed(123)
+    np.random.seed(123)
+    out2, lb2 = MODES[mode](1)(x, target)
+    assert torch.equal(out1, out2) and torch.allclose(lb1, lb2, rtol=0., atol=0., equal_nan=True)
+
+
+def test_batch_mix_reads_each_sample_once():
+    frames = CountingFrames(32)
+    mix = MODES['event_mix'](0)
+    for inputs, target in torch.utils.data.DataLoader(frames, batch_size=8):
+        inputs, target = mix(inputs, target)
+        assert target.shape == (8, NUM_CLASSES)
+    assert frames.reads == len(frames)
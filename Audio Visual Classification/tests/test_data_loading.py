@@ -0,0 +1,120 @@
+import os
+
+import pytest
+import torch
+
+from braincog.datasets.prefetcher import MultiModalPrefetcher
+from braincog.datasets.utils import ResumableSampler, make_resumable_loader
+from utils.utils import CheckpointManager, get_resume_state, load_resume_state, set_rng_state
+
+
+class RandomAVDataset(torch.utils.data.Dataset):
+    # 与CREMAD相同排列的随机音频谱图和视频帧, 用float64模拟numpy读出的数据
+    def __init__(self, length, size=16):
+        self.length = length
+        self.size = size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        g = torch.Generator().manual_seed(idx)
+        spectrogram = torch.randn(1, self.size, self.size, dtype=torch.float64, generator=g)
+        images = torch.randn(3, 1, self.size, self.size, dtype=torch.float64, generator=g)
+        return [spectrogram, images], idx % 6
+
+
+class NoisyDataset(torch.utils.data.Dataset):
+    # __getitem__ 中使用全局随机数, 模拟数据增强
+    def __init__(self, length, dim):
+        self.data = torch.randn(length, dim)
+        self.target = torch.randint(10, (length,))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        return self.data[idx] + 0.1 * torch.randn(self.data.size(1)), self.target[idx]
+
+
+@pytest.mark.parametrize('num_workers', [0, 2])
+def test_prefetcher_matches_type_cast(num_workers):
+    loader = torch.utils.data.DataLoader(RandomAVDataset(20), batch_size=6, num_workers=num_workers)
+    prefetcher = MultiModalPrefetcher(loader, device='cpu')
+    assert len(prefetcher) == len(loader) and prefetcher.sampler is loader.sampler
+    batches = list(prefetcher)
+    assert len(batches) == len(loader)
+    for (inputs, target), (ref_inputs, ref_target) in zip(batches, loader):
+        assert all(x.dtype == torch.float32 for x in inputs)
+        assert all(torch.equal(x, y.type(torch.FloatTensor)) for x, y in zip(inputs, ref_inputs))
+        assert torch.equal(target, ref_target)
+
+
+def test_sampler_shards_and_pads():
+    samplers = [ResumableSampler(range(13), seed=1, num_replicas=3, rank=r) for r in range(3)]
+    shards = [list(s) for s in samplers]
+    assert all(len(s) == len(samplers[0]) == 5 for s in shards)
+    # 每个样本至少出现一次, 补齐的重复样本在每个进程的末尾
+    assert sorted(set(sum(shards, []))) == list(range(13))
+    assert [s.num_valid for s in samplers] == [5, 4, 4]
+    assert sorted(sum([s[:v.num_valid] for s, v in zip(shards, samplers)], [])) == list(range(13))
+
+
+def test_sampler_resumes_mid_epoch():
+    sampler = ResumableSampler(range(20), seed=3)
+    sampler.set_epoch(2)
+    full = list(sampler)
+    sampler.set_epoch(2)
+    sampler.set_start(7)
+    assert list(sampler) == full[7:]
+    # set_start 只对下一次迭代有效
+    assert list(sampler) == full
+    sampler.set_epoch(3)
+    assert list(sampler) != full
+
+
+def train(root, stop=None, resume=None, epochs=3, interval=3):
+    torch.manual_seed(0)
+    dataset = NoisyDataset(50, 8)
+    loader = make_resumable_loader(torch.utils.data.DataLoader(dataset, batch_size=8, shuffle=True), seed=0)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.ReLU(), torch.nn.Dropout(0.2), torch.nn.Linear(16, 10))
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
+    lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=1, gamma=0.5)
+    saver = CheckpointManager(root, k=0, last_name='last_step.pth.tar')
+    loss_fn = torch.nn.CrossEntropyLoss()
+
+    start_epoch, start_batch, state = 0, 0, None
+    if resume is not None:
+        state = torch.load(resume)
+        start_epoch, start_batch = load_resume_state(state, model=model, optimizer=optimizer, lr_scheduler=lr_scheduler)
+    for epoch in range(start_epoch, epochs):
+        loader.sampler.set_epoch(epoch)
+        loader.sampler.set_start(start_batch * 8)
+        if state is not None:
+            set_rng_state(state['rng'])
+            state = None
+        for batch_idx, (x, y) in enumerate(loader, start_batch):
+            loss = loss_fn(model(x), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if (batch_idx + 1) % interval == 0:
+                saver.save(get_resume_state(epoch, batch_idx, model=model, optimizer=optimizer,
+                                            lr_scheduler=lr_scheduler), None, None)
+            if (epoch, batch_idx) == stop:
+                # 模拟中断, 只留下最近的step checkpoint
+                saver.close()
+                return None
+        start_batch = 0
+        lr_scheduler.step()
+    saver.close()
+    return model.state_dict()
+
+
+@pytest.mark.parametrize('stop', [(0, 3), (1, 4), (1, 6)])
+def test_resume_mid_epoch_is_exact(tmp_path, stop):
+    reference = train(str(tmp_path / 'reference'))
+    root = str(tmp_path / 'resumed')
+    train(root, stop=stop)
+    resumed = train(root, resume=os.path.join(root, 'last_step.pth.tar'))
+    assert all(torch.equal(reference[k], resumed[k]) for k in reference)
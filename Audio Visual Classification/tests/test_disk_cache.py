@@ -0,0 +1,83 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import torch
+
+tonic = pytest.importorskip('tonic')
+from tonic import DiskCachedDataset
+from tonic.cached_dataset import load_from_disk_cache
+
+from braincog.datasets.disk_cache import find_disk_caches, missing_items, warm_caches
+
+SENSOR_SIZE = (16, 16, 2)
+
+
+class SyntheticEventDataset(torch.utils.data.Dataset):
+    # tonic 格式的合成事件流, 每个样本的事件数和时长都不同, 由 seed 和 idx 确定
+    dtype = np.dtype([('x', '<i8'), ('y', '<i8'), ('t', '<i8'), ('p', '<i8')])
+
+    def __init__(self, length, transform=None):
+        self.length = length
+        self.transform = transform
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        rng = np.random.RandomState(idx)
+        n = rng.randint(50, 500)
+        events = np.zeros(n, dtype=self.dtype)
+        events['x'] = rng.randint(SENSOR_SIZE[0], size=n)
+        events['y'] = rng.randint(SENSOR_SIZE[1], size=n)
+        events['p'] = rng.randint(SENSOR_SIZE[2], size=n)
+        events['t'] = np.sort(rng.randint(rng.randint(1, 100000), size=n))
+        if self.transform is not None:
+            events = self.transform(events)
+        return events, idx % 10
+
+
+@pytest.fixture
+def cache(tmp_path):
+    to_frame = tonic.transforms.ToFrame(sensor_size=SENSOR_SIZE, n_time_bins=4)
+    dataset = SyntheticEventDataset(12, transform=to_frame)
+    return DiskCachedDataset(dataset, cache_path=str(tmp_path / 'cache'), num_copies=2)
+
+
+def test_find_in_loaders(cache):
+    # 与 get_*_data 一样包装在 Subset 和 DataLoader 中, 同一个缓存只出现一次
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(cache, range(6)), batch_size=4)
+    assert find_disk_caches((loader, loader, False, None)) == [cache]
+
+
+@pytest.mark.parametrize('workers', [0, 2])
+def test_warm_and_resume(cache, workers):
+    stats = warm_caches([cache], workers=workers)[0]
+    assert stats['written'] == 24 and stats['skipped'] == 0
+    for i in range(len(cache.dataset)):
+        data, _ = load_from_disk_cache(os.path.join(cache.cache_path, '{}_0.hdf5'.format(i)))
+        assert np.array_equal(data, cache.dataset[i][0])
+
+    # 模拟中断: 删掉一部分文件, 再次运行只补上缺少的文件
+    removed = sorted(os.listdir(cache.cache_path))[::5]
+    for name in removed:
+        os.remove(os.path.join(cache.cache_path, name))
+    resumed = warm_caches([cache], workers=workers)[0]
+    assert resumed['written'] == len(removed) and resumed['skipped'] == 24 - len(removed)
+    assert warm_caches([cache], workers=workers)[0]['written'] == 0
+
+
+def test_only_stale_tmp_files_removed(cache):
+    os.makedirs(cache.cache_path, exist_ok=True)
+    stale = os.path.join(cache.cache_path, '0_0.hdf5.tmp12345')
+    own = os.path.join(cache.cache_path, '0_1.hdf5.tmp{}'.format(os.getpid()))
+    in_progress = os.path.join(cache.cache_path, '1_0.hdf5.tmp12346')
+    for path in (stale, own, in_progress):
+        open(path, 'wb').close()
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    missing = missing_items(cache, stale=3600.)
+    assert len(missing) == 24
+    # 另一个进程正在写的临时文件保留
+    assert os.listdir(cache.cache_path) == [os.path.basename(in_progress)]
@@ -0,0 +1,69 @@
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+import train_snn
+from braincog.base.node.node import ReLUNode
+from braincog.datasets.utils import make_resumable_loader
+from braincog.model_zoo.basic_model import AVClassifier
+
+
+class NullWriter(object):
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+class RandomAV(torch.utils.data.Dataset):
+    def __init__(self, length, size=16):
+        g = torch.Generator().manual_seed(0)
+        self.audio = torch.randn(length, 1, size, size, generator=g)
+        self.visual = torch.randn(length, 3, size, size, generator=g)
+        self.target = torch.randint(6, (length,), generator=g)
+
+    def __len__(self):
+        return len(self.target)
+
+    def __getitem__(self, idx):
+        return [self.audio[idx], self.visual[idx]], self.target[idx]
+
+
+def run_validate(loader, rank=0, world_size=1):
+    args = train_snn.parser.parse_args(['--alpha', '1.0', '--dataset', 'CREMAD', '--modality', 'audio-visual',
+                                        '--step', '1', '--log-interval', '1000000'])
+    args.device = torch.device('cpu')
+    args.prefetcher = False
+    args.distributed = world_size > 1
+    args.world_size = world_size
+    args.local_rank = rank
+    args.tensorboard_prefix = ''
+    torch.manual_seed(0)
+    model = AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual')
+    return train_snn.validate(0, model, loader, torch.nn.CrossEntropyLoss(), args, summary_writer=NullWriter())
+
+
+def _worker(rank, world_size, length, batch_size, port, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    torch.distributed.init_process_group('gloo', rank=rank, world_size=world_size)
+    loader = torch.utils.data.DataLoader(RandomAV(length), batch_size=batch_size)
+    loader = make_resumable_loader(loader, num_replicas=world_size, rank=rank)
+    metrics = run_validate(loader, rank, world_size)
+    if rank == 0:
+        results.put(dict(metrics))
+    torch.distributed.destroy_process_group()
+
+
+def test_distributed_eval_ignores_padding():
+    # 13 个样本分到 2 个进程, rank 1 的最后一个batch只有一个补齐的重复样本
+    length, batch_size, world_size = 13, 3, 2
+    expected = run_validate(torch.utils.data.DataLoader(RandomAV(length), batch_size=batch_size))
+
+    ctx = mp.get_context('fork')
+    results = ctx.SimpleQueue()
+    mp.start_processes(_worker, args=(world_size, length, batch_size, 29561, results), nprocs=world_size,
+                       join=True, start_method='fork')
+    metrics = results.get()
+    for name in ['loss', 'top1']:
+        assert abs(metrics[name] - expected[name]) < 1e-5, (name, metrics[name], expected[name])
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from utils.evaluation import ScoreAccumulator, average_precision, roc_auc
+
+
+def loop_map(predictions, labels, n_classes):
+    # 原来 main.py 中的 calculate_map: 逐个类别计算, 插值精度逐个元素更新
+    APs = []
+    for class_id in range(n_classes):
+        class_scores = predictions[:, class_id]
+        true_class = (labels == class_id).float()
+        sorted_indices = torch.argsort(class_scores, descending=True)
+        true_class = true_class[sorted_indices]
+        tp = torch.cumsum(true_class, dim=0)
+        fp = torch.cumsum(1 - true_class, dim=0)
+        precision = tp / (tp + fp)
+        recall = tp / true_class.sum()
+        precision = torch.cat([torch.tensor([1], device=precision.device), precision])
+        recall = torch.cat([torch.tensor([0], device=recall.device), recall])
+        for i in range(precision.size(0) - 1, 0, -1):
+            precision[i - 1] = torch.max(precision[i - 1], precision[i])
+        APs.append(torch.sum((recall[1:] - recall[:-1]) * precision[1:]))
+    return torch.mean(torch.tensor(APs)).item()
+
+
+def random_scores(n, c, seed=0, quantize=False):
+    torch.manual_seed(seed)
+    labels = torch.randint(c, (n,))
+    scores = torch.randn(n, c)
+    scores[torch.arange(n), labels] += 1.
+    if quantize:
+        # 量化一部分分数, 制造相同分数的情况
+        scores[:, ::2] = (scores[:, ::2] * 4).round() / 4
+    return scores, labels
+
+
+def test_interpolated_map_matches_loop():
+    scores, labels = random_scores(500, 12)
+    ap = average_precision(scores, labels, interpolated=True)
+    assert abs(ap.nanmean().item() - loop_map(scores, labels, 12)) < 1e-6
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_ap_auc_match_sklearn(quantize):
+    metrics = pytest.importorskip('sklearn.metrics')
+    scores, labels = random_scores(1000, 20, quantize=quantize)
+    one_hot = torch.nn.functional.one_hot(labels, 20).numpy()
+    ap_ref = torch.from_numpy(metrics.average_precision_score(one_hot, scores.numpy(), average=None))
+    auc_ref = torch.from_numpy(metrics.roc_auc_score(one_hot, scores.numpy(), average=None))
+    assert (average_precision(scores, labels) - ap_ref).abs().max().item() < 1e-9
+    assert (roc_auc(scores, labels) - auc_ref).abs().max().item() < 1e-9
+
+
+def test_missing_class_is_nan():
+    scores, labels = random_scores(100, 5)
+    labels[labels == 4] = 0
+    ap, auc = average_precision(scores, labels), roc_auc(scores, labels)
+    assert torch.isnan(ap[4]) and torch.isnan(auc[4])
+    assert not torch.isnan(ap[:4]).any() and not torch.isnan(auc[:4]).any()
+
+
+def test_accumulator_matches_full_batch():
+    scores, labels = random_scores(1000, 20, quantize=True)
+    meter = ScoreAccumulator(20)
+    for i in range(0, 1000, 64):
+        meter.update(scores[i:i + 64], labels[i:i + 64])
+    metrics = meter.compute()
+    assert torch.equal(metrics['ap'], average_precision(scores, labels))
+    assert torch.equal(metrics['auc'], roc_auc(scores, labels))
+    assert abs(metrics['map'] - average_precision(scores, labels).mean().item()) < 1e-12
+    assert abs(metrics['acc'] - (scores.argmax(1) == labels).double().mean().item()) < 1e-12
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import tonic
+import torch
+
+from braincog.datasets.event_store import EventCollate, events_to_frames
+
+DTYPE = np.dtype([('x', '<i8'), ('y', '<i8'), ('t', '<i8'), ('p', '<i8')])
+
+
+def random_events(rng, sensor_size, n, duration):
+    events = np.zeros(n, dtype=DTYPE)
+    events['x'] = rng.randint(sensor_size[0], size=n)
+    events['y'] = rng.randint(sensor_size[1], size=n)
+    events['p'] = rng.randint(sensor_size[2], size=n)
+    events['t'] = np.sort(rng.randint(duration, size=n))
+    return events
+
+
+@pytest.mark.parametrize('size, step', [(16, 4), (64, 16)])
+def test_collate_matches_to_frame(size, step):
+    # 一帧不超过 2^15 个元素时传 int16 的位置, 否则为 int32
+    sensor_size = (size, size, 2)
+    rng = np.random.RandomState(0)
+    batch = [(random_events(rng, sensor_size, n, duration), k) for k, (n, duration) in
+             enumerate([(500, 100000), (0, 1), (3, 2), (2000, 7)])]
+    collate = EventCollate(sensor_size, step)
+    packed, targets = collate(batch)
+    assert packed['index'].dtype == (torch.int16 if size * size * 2 * step <= 2 ** 15 else torch.int32)
+    assert targets.tolist() == [0, 1, 2, 3]
+
+    frames = collate.to_frames(packed)
+    to_frame = tonic.transforms.ToFrame(sensor_size=sensor_size, n_time_bins=step)
+    for (events, _), f in zip(batch, frames):
+        ref = to_frame(events) if len(events) > 0 else np.zeros(f.shape, dtype=np.int16)
+        assert np.array_equal(f.numpy(), ref)
+
+
+@pytest.mark.parametrize('scale', [1e2, 1e3])
+def test_collate_float_timestamps(scale):
+    sensor_size = (32, 32, 2)
+    rng = np.random.RandomState(1)
+    batch = []
+    for k in range(4):
+        events = random_events(rng, sensor_size, 1000, 500000)
+        events = {name: events[name] for name in DTYPE.names}
+        events['t'] = events['t'] / scale
+        batch.append((events, k))
+    collate = EventCollate(sensor_size, 8)
+    frames = collate.to_frames(collate(batch)[0])
+    ref = np.stack([events_to_frames(events, sensor_size, 8) for events, _ in batch])
+    assert (ref.reshape(4, -1).sum(1) > 0).all()
+    assert np.array_equal(frames.numpy(), ref)
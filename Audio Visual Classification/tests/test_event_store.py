@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import tonic
+
+from braincog.datasets.event_store import EventStore, EventFrameDataset
+
+DTYPE = np.dtype([('x', '<i8'), ('y', '<i8'), ('t', '<i8'), ('p', '<i8')])
+SENSOR_SIZE = (16, 16, 2)
+
+
+class Events(object):
+    # tonic 格式的合成事件流, 由 idx 确定
+    transform = None
+
+    def __len__(self):
+        return 6
+
+    def __getitem__(self, idx):
+        rng = np.random.RandomState(idx)
+        n = rng.randint(1, 500)
+        events = np.zeros(n, dtype=DTYPE)
+        events['x'] = rng.randint(SENSOR_SIZE[0], size=n)
+        events['y'] = rng.randint(SENSOR_SIZE[1], size=n)
+        events['p'] = rng.randint(SENSOR_SIZE[2], size=n)
+        events['t'] = np.sort(rng.randint(1, 100000, size=n))
+        if self.transform is not None:
+            events = self.transform(events)
+        return events, idx % 3
+
+
+def test_store_matches_to_frame(tmp_path):
+    store = EventStore.build(Events(), str(tmp_path / 'events'))
+    assert len(store) == 6
+    for step in [4, 7]:
+        to_frame = tonic.transforms.ToFrame(sensor_size=SENSOR_SIZE, n_time_bins=step)
+        for cache in [False, True]:
+            frames = EventFrameDataset(store, SENSOR_SIZE, step, cache=cache)
+            for i in range(len(frames)):
+                x, target = frames[i]
+                assert np.array_equal(x, to_frame(Events()[i][0])) and target == i % 3
+
+
+def test_cache_frames_is_built_once(tmp_path):
+    store = EventStore.build(Events(), str(tmp_path / 'events'))
+    path = store.cache_frames(SENSOR_SIZE, 4)
+    assert os.path.basename(path) == 'frames_4_16x16x2.npy'
+    assert np.load(path, mmap_mode='r').shape == (6, 4, 2, 16, 16)
+    mtime = os.stat(path).st_mtime_ns
+    assert store.cache_frames(SENSOR_SIZE, 4) == path and os.stat(path).st_mtime_ns == mtime
+    assert sorted(os.listdir(store.root)) == sorted(
+        ['frames_4_16x16x2.npy', 'meta.json', 'offsets.npy', 'targets.npy', 'x.bin', 'y.bin', 't.bin', 'p.bin'])
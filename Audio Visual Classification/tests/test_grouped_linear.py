@@ -0,0 +1,54 @@
+import pytest
+import torch
+from einops import rearrange
+
+from braincog.base.node.node import ReLUNode
+from braincog.model_zoo.base_module import BaseLinearModule
+
+
+def loop_linear(module, x):
+    # 原来的实现: 逐个分组调用 nn.Linear
+    x = rearrange(x, 'b (c t) -> t b c', t=module.groups)
+    outputs = torch.stack([module.fc[i](x[i]) for i in range(module.groups)])
+    return rearrange(outputs, 't b c -> b (c t)')
+
+
+def grouped_linear(module, x):
+    x = rearrange(x, 'b (c t) -> t b c', t=module.groups)
+    return rearrange(module.grouped_linear(x), 't b c -> b (c t)')
+
+
+@pytest.mark.parametrize('groups', [2, 5])
+@pytest.mark.parametrize('bias', [True, False])
+def test_grouped_linear_matches_loop(groups, bias):
+    torch.manual_seed(0)
+    module = BaseLinearModule(16, 8, bias=bias, node=ReLUNode, groups=groups)
+    x = torch.randn(6, 16 * groups)
+    with torch.no_grad():
+        assert (loop_linear(module, x) - grouped_linear(module, x)).abs().max().item() < 1e-5
+
+    x.requires_grad_()
+    grouped_linear(module, x).sum().backward()
+    grads = [fc.weight.grad.clone() for fc in module.fc]
+    module.zero_grad()
+    loop_linear(module, x).sum().backward()
+    for grad, fc in zip(grads, module.fc):
+        assert torch.allclose(grad, fc.weight.grad, atol=1e-5)
+
+
+def test_cache_follows_parameter_updates():
+    torch.manual_seed(0)
+    module = BaseLinearModule(16, 8, node=ReLUNode, groups=3).eval()
+    x = torch.randn(4, 48)
+    with torch.no_grad():
+        grouped_linear(module, x)
+        cached = module._grouped_cache[1][0]
+        assert module.grouped_weight()[0] is cached
+
+        # 原地更新参数 (如 optimizer.step) 之后重新合并
+        module.fc[1].weight.add_(1.)
+        assert module.grouped_weight()[0] is not cached
+        assert torch.allclose(loop_linear(module, x), grouped_linear(module, x), atol=1e-5)
+
+        module.load_state_dict({k: torch.zeros_like(v) for k, v in module.state_dict().items()})
+        assert grouped_linear(module, x).abs().max().item() == 0.
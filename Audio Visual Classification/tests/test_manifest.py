@@ -0,0 +1,65 @@
+import os
+import time
+
+from braincog.datasets.datasets import walk_manifest
+from braincog.datasets.manifest import FileManifest
+
+CLASS_NAMES = {'class_{:02d}'.format(c): c for c in range(3)}
+
+
+def walk(root):
+    # 原来 CREMADDataset/UrbanSound8KDataset 构建时的扫描
+    data, targets = [], []
+    for path, dirs, files in os.walk(root):
+        dirs.sort()
+        for file in files:
+            if file.endswith("jpg"):
+                data.append(path + "/" + file)
+                targets.append(CLASS_NAMES[os.path.basename(path)])
+    return data, targets
+
+
+def make_tree(root, num_files=30):
+    for i in range(num_files):
+        name = 'class_{:02d}'.format(i % len(CLASS_NAMES))
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+        open(os.path.join(root, name, '{:04d}.jpg'.format(i)), 'wb').close()
+    open(os.path.join(root, 'class_00', 'notes.txt'), 'wb').close()
+
+
+def test_matches_os_walk_and_reloads(tmp_path):
+    root, file = str(tmp_path / 'visual'), str(tmp_path / 'manifests' / 'visual.pkl')
+    make_tree(root)
+    data, targets = walk(root)
+    built = walk_manifest(root, CLASS_NAMES, file)
+    assert built.paths == data and built.labels == targets
+    assert os.path.exists(file) and FileManifest.load(file).is_valid('full')
+
+    loaded = walk_manifest(root, CLASS_NAMES, file)
+    assert loaded.paths == data and loaded.labels == targets
+
+
+def test_rescans_after_change(tmp_path):
+    root, file = str(tmp_path / 'visual'), str(tmp_path / 'visual.pkl')
+    make_tree(root)
+    walk_manifest(root, CLASS_NAMES, file)
+
+    # 增加一个文件之后目录的mtime改变, 清单重新扫描
+    time.sleep(0.01)
+    open(os.path.join(root, 'class_01', 'new.jpg'), 'wb').close()
+    assert not FileManifest.load(file).is_valid()
+    assert walk_manifest(root, CLASS_NAMES, file).paths == walk(root)[0]
+
+    # 文件内容改变时只有完整检查能发现
+    with open(os.path.join(root, 'class_02', '0002.jpg'), 'wb') as f:
+        f.write(b'changed')
+    manifest = FileManifest.load(file)
+    assert manifest.is_valid('watch') and not manifest.is_valid('full') and manifest.is_valid('none')
+
+
+def test_unreadable_manifest_is_ignored(tmp_path):
+    file = str(tmp_path / 'broken.pkl')
+    with open(file, 'wb') as f:
+        f.write(b'not a pickle')
+    assert FileManifest.load(file) is None
+    assert FileManifest.load(str(tmp_path / 'missing.pkl')) is None
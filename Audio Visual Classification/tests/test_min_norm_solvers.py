@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from min_norm_solvers import MinNormSolver
+
+
+def conflicting_vecs(n, seed, dtype=torch.float64):
+    torch.manual_seed(seed)
+    vecs = [torch.randn(100, dtype=dtype) for _ in range(n)]
+    # 让一部分任务的梯度相互冲突
+    vecs[-1] = vecs[-1] - vecs[0] * torch.rand(1, dtype=dtype) * 2
+    return vecs
+
+
+@pytest.mark.parametrize('n', [2, 3, 5])
+@pytest.mark.parametrize('seed', range(5))
+def test_batched_matches_reference(n, seed):
+    vecs = conflicting_vecs(n, seed)
+    ref, ref_cost = MinNormSolver.find_min_norm_element([[v] for v in vecs])
+    sol, cost = MinNormSolver.find_min_norm_element_batched(vecs)
+    assert (torch.from_numpy(ref) - sol).abs().max().item() < 1e-6
+    assert abs(float(ref_cost) - cost.item()) < 1e-6 * max(1., abs(float(ref_cost)))
+
+
+@pytest.mark.parametrize('n', [3, 5])
+@pytest.mark.parametrize('seed', range(5))
+def test_device_loop_matches_reference(n, seed):
+    vecs = conflicting_vecs(n, seed)
+    ref, ref_cost = MinNormSolver.find_min_norm_element([[v] for v in vecs])
+    grad_mat = MinNormSolver._gram_matrix(vecs)
+    sol, nd = MinNormSolver._min_norm_2d_batched(grad_mat)
+    sol, cost = MinNormSolver._min_norm_loop_batched(grad_mat, sol, nd, MinNormSolver.MAX_ITER,
+                                                     MinNormSolver.STOP_CRIT, check_every=3)
+    assert (torch.from_numpy(ref) - sol).abs().max().item() < 1e-6
+    assert abs(float(ref_cost) - cost.item()) < 1e-6 * max(1., abs(float(ref_cost)))
+
+
+@pytest.mark.parametrize('n', [2, 3])
+def test_batched_keeps_dtype_and_device(n):
+    vecs = [v.requires_grad_() for v in conflicting_vecs(n, 0, dtype=torch.float32)]
+    sol, cost = MinNormSolver.find_min_norm_element_batched(vecs)
+    for x in (sol, cost):
+        assert x.dtype == torch.float32 and x.device == vecs[0].device and not x.requires_grad
+    assert sol.shape == (n,) and abs(sol.sum().item() - 1) < 1e-6
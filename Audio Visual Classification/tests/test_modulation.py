@@ -0,0 +1,112 @@
+import copy
+
+import pytest
+import torch
+
+from braincog.base.node.node import ReLUNode
+from braincog.model_zoo.basic_model import AVClassifier
+from utils.utils import modality_params, ogm_ge_coeff, modulate_grad_, modality_scores, per_loss_grads, \
+    split_micro_batches
+
+
+def av_classifier():
+    torch.manual_seed(0)
+    return AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                        fusion_method='concat', modality='audio-visual')
+
+
+def loop_modulate(model, ratio_v, alpha):
+    # 原来的实现: 逐个参数调用 normal_, std 通过 .item() 同步到host
+    if ratio_v > 1:
+        coeff_v, coeff_a = 1 - torch.tanh(alpha * torch.relu(ratio_v)), 1
+    else:
+        coeff_a, coeff_v = 1 - torch.tanh(alpha * torch.relu(1 / ratio_v)), 1
+    for name, parms in model.named_parameters():
+        layer = name.split('.')[0]
+        if 'audio' in layer and parms.grad.dim() == 4:
+            parms.grad = parms.grad * coeff_a + torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
+        if 'visual' in layer and parms.grad.dim() == 4:
+            parms.grad = parms.grad * coeff_v + torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
+
+
+@pytest.mark.parametrize('ratio', [0.5, 1.5])
+def test_ogm_ge_matches_loop(ratio):
+    model = av_classifier()
+    ref_model = copy.deepcopy(model)
+    for p, ref in zip(model.parameters(), ref_model.parameters()):
+        p.grad = torch.randn_like(p)
+        ref.grad = p.grad.clone()
+    ratio_v = torch.tensor(ratio)
+
+    torch.manual_seed(1)
+    loop_modulate(ref_model, ratio_v, 1.)
+    torch.manual_seed(1)
+    coeff_a, coeff_v = ogm_ge_coeff(ratio_v, 1.)
+    modulate_grad_(modality_params(model, 'audio', dim=4), coeff_a)
+    modulate_grad_(modality_params(model, 'visual', dim=4), coeff_v)
+
+    assert (coeff_v < 1).item() == (ratio > 1) and (coeff_a < 1).item() == (ratio < 1)
+    for p, ref in zip(model.parameters(), ref_model.parameters()):
+        assert (p.grad - ref.grad).abs().max().item() < 1e-6
+
+
+def test_modulate_without_noise():
+    params = [torch.nn.Parameter(torch.randn(3, 4)) for _ in range(2)] + [torch.nn.Parameter(torch.randn(2))]
+    grads = [torch.randn_like(p) for p in params]
+    for p, g in zip(params, grads):
+        p.grad = g.clone()
+    params[-1].grad = None
+    modulate_grad_(params, torch.tensor(0.5), noise=False)
+    assert all(torch.equal(p.grad, g * 0.5) for p, g in zip(params[:-1], grads))
+    assert params[-1].grad is None
+
+
+@pytest.mark.parametrize('batch_size', [1, 64, 256])
+def test_modality_scores_matches_loop(batch_size):
+    torch.manual_seed(0)
+    target = torch.randint(10, (batch_size,))
+    logits = [torch.randn(batch_size, 10) for _ in range(3)]
+    softmax = torch.nn.Softmax(dim=1)
+    ref = [sum([softmax(o)[i][target[i]] for i in range(o.size(0))]) for o in logits]
+    for score, r in zip(modality_scores(target, *logits), ref):
+        assert score.dim() == 0
+        assert abs(score.item() - r.item()) < 1e-6 * batch_size
+
+
+def test_per_loss_grads_matches_retain_graph():
+    model = av_classifier().train()
+    params = [p for name, p in model.named_parameters()
+              if ('audio_net' in name or 'visual_net' in name) and 'threshold' not in name and '_net.fc' not in name]
+    audio, visual = torch.randn(4, 1, 1, 32, 32), torch.randn(4, 1, 3, 32, 32)
+    target = torch.randint(6, (4,))
+    loss_fn = torch.nn.CrossEntropyLoss()
+    state = copy.deepcopy(model.state_dict())
+
+    def losses():
+        output_a, output_v, output = model([audio, visual])
+        return [loss_fn(output, target), loss_fn(model.audio_fc(output_a), target),
+                loss_fn(model.visual_fc(output_v), target)]
+
+    # 原来的实现: 三次 retain_graph backward, 单模态的loss不经过另一个模态的参数, 梯度按0处理
+    ref = []
+    for loss in losses():
+        loss.backward(retain_graph=True)
+        ref.append(torch.cat([(p.grad.clone() if p.grad is not None else torch.zeros_like(p)).flatten()
+                              for p in params]))
+        model.zero_grad()
+    ref = torch.stack(ref)
+
+    model.load_state_dict(state)
+    flat, offsets = per_loss_grads(losses(), params)
+    assert flat.shape == ref.shape and offsets[-1][0] + offsets[-1][1] == flat.size(1)
+    assert ((flat - ref).norm(dim=1) / ref.norm(dim=1)).max().item() < 1e-5
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 16])
+def test_split_micro_batches(n):
+    audio, visual, target = torch.randn(10, 2), torch.randn(10, 3), torch.arange(10)
+    splits = split_micro_batches([audio, visual], target, n)
+    assert len(splits) == min(n, 10)
+    assert abs(sum(w for _, _, w in splits) - 1.) < 1e-12
+    assert torch.equal(torch.cat([t for _, t, _ in splits]), target)
+    assert torch.equal(torch.cat([x[1] for x, _, _ in splits]), visual)
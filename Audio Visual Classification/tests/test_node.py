@@ -0,0 +1,60 @@
+import copy
+
+import pytest
+import torch
+from einops import rearrange
+
+from braincog.base.node.node import BaseNode, IFNode, LIFNode
+from braincog.model_zoo.resnet import resnet18
+
+
+def layer_by_layer_resnet(model, x):
+    # 以 layer_by_layer 的方式执行 ResNet, 所有时间步折叠在batch维度
+    model.reset()
+    x = model.maxpool(model.node1(model.bn1(model.conv1(x))))
+    x = model.layer4(model.layer3(model.layer2(model.layer1(x))))
+    x = torch.flatten(model.avgpool(x), 1)
+    return rearrange(model.fc(x), '(t b) c -> t b c', t=model.step).mean(0)
+
+
+@pytest.mark.parametrize('node', [LIFNode, IFNode])
+@pytest.mark.parametrize('step', [2, 4])
+def test_fused_step_identical(node, step):
+    torch.manual_seed(0)
+    loop_model = resnet18(node_type=node, step=step, layer_by_layer=True, dataset='cifar10', num_classes=10,
+                          threshold=.1)
+    loop_model.set_attr('step', step)
+    fused_model = copy.deepcopy(loop_model)
+    fused_model.set_attr('fused_step', True)
+    assert all(m.use_fused_step() for m in fused_model.modules() if isinstance(m, BaseNode))
+
+    x = torch.randn(step * 2, 3, 16, 16)
+    grad = torch.randn(2, 10)
+
+    def run(model):
+        inputs = x.clone().requires_grad_()
+        out = layer_by_layer_resnet(model, inputs)
+        out.backward(grad)
+        return [out.detach(), inputs.grad] + [p.grad for p in model.parameters() if p.grad is not None]
+
+    ref, out = run(loop_model), run(fused_model)
+    assert len(ref) == len(out) and ref[1].abs().sum() > 0
+    assert all(torch.equal(a, b) for a, b in zip(ref, out))
+
+
+def test_packed_fp_identical():
+    torch.manual_seed(0)
+    ref = resnet18(node_type=LIFNode, step=4, dataset='cifar10', num_classes=10, threshold=.1).eval()
+    packed = copy.deepcopy(ref)
+    ref.set_requires_fp(True)
+    packed.set_requires_fp(True)
+    packed.set_fp_packed(True)
+    with torch.no_grad():
+        for batch_size in [3, 2]:
+            x = torch.randn(batch_size, 3, 16, 16)
+            ref(x)
+            packed(x)
+            for a, b in zip(ref.get_fp(temporal_info=True), packed.get_fp(temporal_info=True)):
+                assert len(a) == len(b) and all(torch.equal(u, v) for u, v in zip(a, b))
+            assert all(torch.equal(a, b) for a, b in zip(ref.get_fp(), packed.get_fp()))
+            assert torch.equal(ref.get_fire_rate(), packed.get_fire_rate())
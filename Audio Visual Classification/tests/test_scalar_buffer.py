@@ -0,0 +1,44 @@
+import torch
+
+from utils.utils import ScalarBuffer
+
+
+class ScalarRecorder(object):
+    def __init__(self):
+        self.scalars = []
+        self.closed = False
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        self.scalars.append((tag, scalar_value, global_step))
+
+    def close(self):
+        self.closed = True
+
+
+def test_same_values_and_order_as_item():
+    torch.manual_seed(0)
+    values = [torch.randn(()) for _ in range(50)] + [torch.tensor(3, dtype=torch.int64), torch.tensor(True)]
+    direct, buffered = ScalarRecorder(), ScalarRecorder()
+    writer = ScalarBuffer(buffered, flush_interval=7)
+    for step, v in enumerate(values):
+        direct.add_scalar('loss', v.item(), step)
+        writer.add_scalar('loss', v, step)
+        # 不是tensor的标量和tensor混在一起, 保持原来的顺序
+        direct.add_scalar('lr', 0.1 * step, step)
+        writer.add_scalar('lr', 0.1 * step, step)
+    writer.close()
+    assert buffered.closed
+    assert [(t, float(v), s) for t, v, s in buffered.scalars] == [(t, float(v), s) for t, v, s in direct.scalars]
+
+
+def test_wait_writes_everything():
+    recorder = ScalarRecorder()
+    writer = ScalarBuffer(recorder, flush_interval=100)
+    for step in range(10):
+        writer.add_scalar('acc', torch.tensor(float(step)), step)
+    assert len(recorder.scalars) == 0
+    writer.wait()
+    assert [v for _, v, _ in recorder.scalars] == [float(step) for step in range(10)]
+    # 其它属性直接使用原来的 writer
+    assert writer.scalars is recorder.scalars
+    writer.close()
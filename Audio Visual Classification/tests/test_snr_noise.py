@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from utils.utils import SNRNoise
+
+
+def measured_snr(x, noisy, dim):
+    return 10 * torch.log10(x.pow(2).mean(dim=dim) / (noisy - x).pow(2).mean(dim=dim))
+
+
+@pytest.mark.parametrize('snr', [0., 10., 30.])
+def test_per_sample_snr(snr):
+    torch.manual_seed(0)
+    # 每个样本的幅度不同, 按样本计算信号功率
+    x = torch.randn(8, 3, 32, 32) * torch.logspace(-1, 1, 8).view(-1, 1, 1, 1)
+    noisy = SNRNoise(seed=0)(x, snr)
+    assert (measured_snr(x, noisy, (1, 2, 3)) - snr).abs().max().item() < 0.2
+
+
+def test_batch_power():
+    torch.manual_seed(0)
+    x = torch.randn(16, 3, 32, 32)
+    noisy = SNRNoise(seed=0, reduce='batch')(x, 5.)
+    assert abs(measured_snr(x, noisy, (0, 1, 2, 3)).item() - 5.) < 0.05
+
+
+def test_reproducible_and_resumable():
+    x = torch.randn(4, 3, 8, 8)
+    noise = SNRNoise(seed=3)
+    a = [noise(x, 10.) for _ in range(3)]
+    noise.reset()
+    assert all(torch.equal(u, noise(x, 10.)) for u in a)
+
+    # 从保存的状态继续, 得到与不中断时相同的噪声
+    noise.reset()
+    noise(x, 10.)
+    state = noise.state_dict()
+    resumed = SNRNoise(seed=3)
+    resumed.load_state_dict(state)
+    assert torch.equal(resumed(x, 10.), a[1])
+
+
+def test_integer_input_is_promoted():
+    x = torch.randint(0, 255, (2, 3, 8, 8), dtype=torch.uint8)
+    assert SNRNoise(seed=0)(x, 20.).dtype == torch.float32
+
+
+def test_sweep_matches_repeated_batch():
+    torch.manual_seed(0)
+    x = torch.randn(6, 3, 1, 16, 16)
+    levels = torch.tensor([0., 5., 10., 20.])
+    for reduce in ['sample', 'batch']:
+        out = SNRNoise(seed=0, reduce=reduce).sweep(x, levels)
+        ref = SNRNoise(seed=0, reduce=reduce)(x.repeat(len(levels), 1, 1, 1, 1), levels.repeat_interleave(6))
+        assert out.shape == (4, 6, 3, 1, 16, 16)
+        assert torch.equal(out.flatten(0, 1), ref)
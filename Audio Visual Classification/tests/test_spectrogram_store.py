@@ -0,0 +1,49 @@
+import csv
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torchaudio
+from PIL import Image
+
+from dataset.CramedDataset import CramedDataset, build_store
+
+
+def make_dataset(root, n):
+    audio_dir, visual_dir = root / 'audio', root / 'visual'
+    audio_dir.mkdir(exist_ok=True)
+    os.makedirs(root / 'data' / 'CREMAD', exist_ok=True)
+    rows = []
+    for i in range(n):
+        name = 'clip{}'.format(i)
+        torchaudio.save(str(audio_dir / (name + '.wav')), torch.rand(1, 2205) * 2 - 1, 22050)
+        frames = visual_dir / 'Image-01-FPS' / name
+        frames.mkdir(parents=True, exist_ok=True)
+        Image.fromarray(np.zeros((8, 8, 3), dtype=np.uint8)).save(frames / '0.jpg')
+        rows.append([name, 'NEU'])
+    for mode in ['train', 'test']:
+        with open(root / 'data' / 'CREMAD' / '{}.csv'.format(mode), 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+    return SimpleNamespace(dataset='CREMAD', fps=1, audio_path=str(audio_dir) + '/',
+                           visual_path=str(visual_dir) + '/', store_path=str(root / 'store'))
+
+
+def test_rebuild_with_fewer_shards_removes_stale_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    args = make_dataset(tmp_path, 5)
+    build_store(args, shard_size=2, workers=1)
+    store = tmp_path / 'store' / 'train'
+    assert sorted(p.name for p in store.glob('spectrogram_*')) == \
+        ['spectrogram_0000.npy', 'spectrogram_0001.npy', 'spectrogram_0002.npy']
+
+    with open(tmp_path / 'data' / 'CREMAD' / 'train.csv', 'w', newline='') as f:
+        csv.writer(f).writerows([['clip0', 'NEU'], ['clip1', 'NEU']])
+    (store / 'spectrogram_0001.npy.tmp').touch()
+    build_store(args, shard_size=2, workers=1)
+    assert [p.name for p in store.glob('spectrogram_*')] == ['spectrogram_0000.npy']
+
+    dataset = CramedDataset(args, mode='train')
+    assert len(dataset.store) == 2
+    spectrogram, _, _ = dataset[1]
+    assert torch.equal(spectrogram, dataset.spectrogram_loader(dataset.audio[1]))
@@ -0,0 +1,46 @@
+import torch
+
+from braincog.base.node.node import LIFNode, SpikeCounter
+from braincog.model_zoo.resnet import resnet18
+
+
+def test_running_stats_match_feature_map():
+    # 逐batch用 feature_map 计算, 按batch size (即每层的元素个数) 加权平均
+    torch.manual_seed(0)
+    model = resnet18(node_type=LIFNode, step=4, dataset='cifar10', num_classes=10, threshold=.1).eval()
+    model.set_requires_fp(True)
+    model.set_spike_count(True)
+    model.reset_spike_count()
+
+    fired, numel, tot_spike, samples = 0., 0., 0., 0
+    with torch.no_grad():
+        for batch_size in [4, 4, 3]:
+            x = torch.randn(batch_size, 3, 32, 32)
+            model(x)
+            sizes = torch.tensor([f[0].numel() for f in model.get_attr('feature_map')], dtype=torch.float64)
+            fired = fired + model.get_fire_rate().double() * sizes
+            numel = numel + sizes
+            tot_spike += model.get_tot_spike().item() * batch_size
+            samples += batch_size
+
+    rate, spike = model.get_running_fire_rate().double(), model.get_running_tot_spike().item()
+    assert tot_spike > 0
+    assert (rate - fired / numel).abs().max().item() < 1e-6
+    assert abs(spike - tot_spike / samples) / (tot_spike / samples) < 1e-6
+
+
+def test_reset_and_windows():
+    counter = SpikeCounter()
+    counter.commit()
+    assert counter.windows == 0 and counter.total is None
+
+    spikes = (torch.rand(3, 2, 5) > 0.5).float()
+    for t in range(3):
+        counter.update(spikes[t])
+    counter.commit()
+    assert counter.windows == 1 and counter.samples == 2 and counter.numel == 10
+    assert counter.total.item() == spikes.sum().item()
+    assert counter.fired.item() == (spikes.sum(0) > 0).sum().item()
+
+    counter.reset()
+    assert counter.windows == 0 and counter.count is None and counter.fired is None
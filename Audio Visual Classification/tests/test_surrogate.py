@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from braincog.base.strategy.surrogate import SigmoidGrad, AtanGrad, GateGrad, QGateGrad, ReLUGrad, \
+    BackEIGateGrad, EIGrad, MyGrad, pack_mask, unpack_mask
+from braincog.base.node.node import LIFNode
+from braincog.model_zoo.base_module import BaseModule
+
+# 保存按位压缩mask的代理函数梯度完全相同, 以float16保存输入的相对误差不超过5e-4
+EXACT = [GateGrad, ReLUGrad, BackEIGateGrad, EIGrad]
+HALF = [SigmoidGrad, AtanGrad, QGateGrad, MyGrad]
+
+
+def surrogate_grad(cls, x, grad_output, compact):
+    x = x.clone().requires_grad_()
+    (cls(compact=compact)(x) * grad_output).sum().backward()
+    return x.grad
+
+
+@pytest.mark.parametrize('shape', [(13,), (4, 7), (2, 3, 5, 5)])
+def test_pack_mask_roundtrip(shape):
+    mask = torch.rand(shape) > 0.5
+    packed = pack_mask(mask)
+    assert packed.dtype == torch.uint8 and packed.numel() == (mask.numel() + 7) // 8
+    assert torch.equal(unpack_mask(packed, mask.shape), mask)
+
+
+@pytest.mark.parametrize('cls', EXACT + HALF)
+@pytest.mark.parametrize('seed', range(5))
+def test_compact_grad(cls, seed):
+    torch.manual_seed(seed)
+    x = torch.randn(16, 32, 8, 8) * 2
+    grad_output = torch.randn_like(x)
+    ref = surrogate_grad(cls, x, grad_output, False)
+    grad = surrogate_grad(cls, x, grad_output, True)
+    if cls in EXACT:
+        assert torch.equal(grad, ref)
+    else:
+        assert ((grad - ref).norm() / ref.norm()).item() < 5e-4
+
+
+class TwoNodes(BaseModule):
+    def __init__(self):
+        super().__init__(step=1, encode_type='direct')
+        self.node1 = LIFNode(act_fun=QGateGrad)
+        self.node2 = LIFNode(act_fun=AtanGrad)
+
+
+def test_set_compact_grad():
+    model = TwoNodes()
+    model.set_compact_grad(True)
+    assert model.node1.act_fun.compact and model.node2.act_fun.compact
+    model.set_compact_grad(False)
+    assert not model.node1.act_fun.compact and not model.node2.act_fun.compact
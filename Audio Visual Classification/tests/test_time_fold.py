@@ -0,0 +1,61 @@
+import copy
+
+import pytest
+import torch
+
+from braincog.base.node.node import ReLUNode
+from braincog.model_zoo.basic_model import AVClassifier
+
+
+@pytest.mark.parametrize('train', [False, True])
+def test_time_fold_matches_step_loop(train):
+    torch.manual_seed(0)
+    model = AVClassifier(num_classes=6, step=3, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual').train(train)
+    fold = copy.deepcopy(model)
+    fold.time_fold = True
+    assert fold.use_time_fold()
+
+    audio = torch.randn(4, 3, 1, 32, 32)
+    visual = torch.randn(4, 3, 3, 32, 32)
+    ref = model([audio, visual])
+    out = fold([audio, visual])
+    for x, y in zip(ref, out):
+        assert torch.allclose(x, y, atol=1e-5)
+
+    # 训练模式下BN的running统计量按时间步顺序更新, 与逐步计算一致
+    for (name, x), (_, y) in zip(model.named_buffers(), fold.named_buffers()):
+        assert torch.allclose(x.float(), y.float(), atol=1e-5), name
+
+    if train:
+        ref[2].sum().backward()
+        out[2].sum().backward()
+        for (name, x), (_, y) in zip(model.named_parameters(), fold.named_parameters()):
+            if x.grad is None:
+                assert y.grad is None, name
+            else:
+                assert torch.allclose(x.grad, y.grad, atol=1e-4), name
+
+
+@pytest.mark.parametrize('step', [1, 4])
+def test_static_input_matches_repeated(step):
+    # repeat_step 得到stride为0的view, 与在host上拷贝T份的输入结果相同
+    torch.manual_seed(0)
+    model = AVClassifier(num_classes=6, step=step, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual').train()
+    static = copy.deepcopy(model)
+    audio, visual = torch.randn(4, 1, 32, 32), torch.randn(4, 3, 32, 32)
+
+    def run(m, inputs):
+        out = m(inputs)
+        sum(o.sum() for o in out).backward()
+        return [o.detach() for o in out]
+
+    ref = run(model, [x.unsqueeze(1).repeat(1, step, 1, 1, 1) for x in (audio, visual)])
+    out = run(static, [x.unsqueeze(1).expand(-1, step, -1, -1, -1) for x in (audio, visual)])
+    assert all(torch.equal(x, y) for x, y in zip(ref, out))
+    assert all(torch.equal(x, y) for x, y in zip(model.buffers(), static.buffers()))
+    ref_grad = torch.cat([p.grad.flatten() for p in model.parameters() if p.grad is not None])
+    grad = torch.cat([p.grad.flatten() for p in static.parameters() if p.grad is not None])
+    assert ref_grad.norm() > 0
+    assert ((grad - ref_grad).norm() / ref_grad.norm()).item() < 1e-4
@@ -0,0 +1,82 @@
+import copy
+from functools import partial
+
+import pytest
+import torch
+from timm.utils import NativeScaler
+
+import train_snn
+from braincog.base.node.node import ReLUNode
+from braincog.model_zoo.basic_model import AVClassifier
+
+
+class GradRecorder(torch.optim.SGD):
+    # 记录 step 时 (调制之后) 的梯度, 不更新参数, 同一个模型可以重复运行
+    def step(self, closure=None):
+        self.grads = torch.cat([p.grad.flatten() for group in self.param_groups for p in group['params']
+                                if p.grad is not None])
+
+
+class NullWriter(object):
+    def add_scalar(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture(scope='module')
+def setup():
+    torch.manual_seed(0)
+    # eval 模式下 BN 使用running统计量, 每个样本的输出与batch的切分无关, train_epoch 中的 model.train() 不改变它
+    model = AVClassifier(num_classes=6, step=1, node_type=ReLUNode, dataset='CREMAD',
+                         fusion_method='concat', modality='audio-visual').eval()
+    model.train = lambda mode=True: torch.nn.Module.train(model, False)
+    batch = ([torch.randn(8, 1, 32, 32), torch.randn(8, 3, 32, 32)], torch.randint(6, (8,)))
+    return model, batch
+
+
+def train_grads(model, batch, modulation, micro_batches=1, amp=False, extra_argv=()):
+    """
+    在只有一个batch的loader上运行 train_snn.train_epoch
+    :return: 调制之后所有参数的梯度, 拼接成一个向量
+    """
+    argv = ['--alpha', '0.8', '--dataset', 'CREMAD', '--modality', 'audio-visual', '--step', '1',
+            '--micro-batches', str(micro_batches), '--log-interval', '1000000']
+    argv += ['--inverse'] if modulation == 'inverse' else ['--modulation', modulation]
+    args = train_snn.parser.parse_args(argv + list(extra_argv))
+    args.device = torch.device('cpu')
+    args.prefetcher = False
+    args.distributed = False
+    args.world_size = 1
+    args.tensorboard_prefix = ''
+
+    kwargs = {}
+    if amp:
+        # CPU上用bfloat16的autocast, GradScaler在没有CUDA时不缩放, 但仍然走 unscale -> 调制 -> step 的路径
+        kwargs = dict(amp_autocast=partial(torch.autocast, 'cpu', dtype=torch.bfloat16), loss_scaler=NativeScaler())
+    optimizer = GradRecorder(model.parameters(), lr=0.)
+    # 调制中的高斯噪声在相同的随机数状态下采样
+    torch.manual_seed(0)
+    train_snn.train_epoch(0, model, [batch], optimizer, torch.nn.CrossEntropyLoss(), args,
+                          summary_writer=NullWriter(), audio_lr_ratio=1., visual_lr_ratio=1., **kwargs)
+    return optimizer.grads
+
+
+@pytest.mark.parametrize('modulation', ['Normal', 'OGM_GE', 'inverse', 'MMpareto', 'LFM', 'MSLR'])
+@pytest.mark.parametrize('amp', [False, True])
+def test_micro_batches_match_full_batch(setup, modulation, amp):
+    model, batch = setup
+    ref = train_grads(model, batch, modulation, amp=amp)
+    # 半精度下切分batch改变了累加的顺序和舍入, 误差放宽
+    tol = 2e-2 if amp else 1e-4
+    for n in [2, 4]:
+        grads = train_grads(model, batch, modulation, n, amp=amp)
+        assert ((grads - ref).norm() / ref.norm()).item() < tol, n
+
+
+def test_mmpareto_batched_grad(setup):
+    model, batch = setup
+    state = copy.deepcopy(model.state_dict())
+    ref = train_grads(model, batch, 'MMpareto')
+    model.load_state_dict(state)
+    grads = train_grads(model, batch, 'MMpareto', extra_argv=['--mmpareto-batched-grad'])
+    assert ((grads - ref).norm() / ref.norm()).item() < 1e-5
+
@@ -46,6 +46,9 @@ from tqdm import tqdm
 from thop import profile
 
 from min_norm_solvers import MinNormSolver
+from utils.utils import ScalarBuffer, SNRNoise, CheckpointManager, modality_params, ogm_ge_coeff, modulate_grad_, \
+    modality_scores, per_loss_grads, split_micro_batches, get_resume_state, load_resume_state, set_rng_state, \
+    pin_threads
 
 torch.backends.cudnn.benchmark = True
 _logger = logging.getLogger('train')
@@ -232,8 +235,14 @@ parser.add_argument('--seed', type=int, default=42, metavar='S',
                     help='random seed (default: 42)')
 parser.add_argument('--log-interval', type=int, default=50, metavar='N',
                     help='how many batches to wait before logging training status')
+parser.add_argument('--metrics-flush-interval', type=int, default=300, metavar='N',
+                    help='how many tensorboard scalars to buffer on device before writing them (default: 300)')
 parser.add_argument('--recovery-interval', type=int, default=0, metavar='N',
                     help='how many batches to wait before writing recovery checkpoint')
+parser.add_argument('--step-ckpt-interval', type=int, default=0, metavar='N',
+                    help='how many batches to wait before writing a resumable step checkpoint (last_step.pth.tar)')
+parser.add_argument('--resume-step', default='', type=str, metavar='PATH',
+                    help='continue training from the exact next batch of a step checkpoint')
 parser.add_argument('-j', '--workers', type=int, default=8, metavar='N',
                     help='how many training processes to use (default: 1)')
 parser.add_argument('--num-gpu', type=int, default=1,
@@ -264,6 +273,12 @@ parser.add_argument('--use-multi-epochs-loader', action='store_true', default=Fa
                     help='use the multi-epochs-loader to save time at the beginning of every epoch')
 parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
 parser.add_argument('--device', type=int, default=0)
+parser.add_argument('--cpu', action='store_true', default=False,
+                    help='train on CPU, distributed runs use the gloo backend')
+parser.add_argument('--dist-backend', type=str, default='', choices=['', 'nccl', 'gloo'],
+                    help='distributed backend, default nccl on GPU and gloo with --cpu')
+parser.add_argument('--dist-threads', type=int, default=0,
+                    help='intra-op threads per process with --cpu, default cpu_count / local world size')
 
 # Spike parameters
 parser.add_argument('--step', type=int, default=10, help='Simulation time step (default: 10)')
@@ -297,6 +312,11 @@ parser.add_argument('--layer-by-layer', action='store_true',
                     help='forward step-by-step or layer-by-layer. '
                          'Larger Model with layer-by-layer will be faster (default: False)')
 parser.add_argument('--tet-loss', action='store_true')
+parser.add_argument('--fused-step', action='store_true',
+                    help='Use the fused multi-step kernel for supported nodes in layer-by-layer mode (default: False)')
+parser.add_argument('--time-fold', action='store_true',
+                    help='Fold time steps into the batch dimension for stateless AV backbones. Fewer kernel launches, '
+                         'but memory bound on CPU (0.82x at B=64, T=4, 128x128) (default: False)')
 
 # EventData Augmentation
 parser.add_argument('--mix-up', action='store_true', help='Mix-up for event data (default: False)')
@@ -308,6 +328,9 @@ parser.add_argument('--cutmix_num', type=int, default=1, help='cutmix_num for ev
 parser.add_argument('--cutmix_noise', type=float, default=0.,
                     help='Add Pepper noise after mix, sometimes work (default: 0.)')
 parser.add_argument('--gaussian-n', type=int, default=3)
+parser.add_argument('--batch-mix', action='store_true',
+                    help='Apply --mix-up/--cut-mix/--event-mix within each collated batch '
+                         'instead of reading extra samples per item (default: False)')
 parser.add_argument('--rand-aug', action='store_true',
                     help='Rand Augment for Event data (default: False)')
 parser.add_argument('--randaug_n', type=int, default=3,
@@ -318,6 +341,18 @@ parser.add_argument('--train-portion', type=float, default=0.9,
                     help='Dataset portion, only for datasets which do not have validation set (default: 0.9)')
 parser.add_argument('--event-size', default=48, type=int,
                     help='Event size. Resize event data before process (default: 48)')
+parser.add_argument('--event-store', action='store_true',
+                    help='DVS datasets: bin frames on the fly from one step-agnostic event store '
+                         'instead of a per-step DiskCachedDataset (default: False)')
+parser.add_argument('--event-batch', action='store_true',
+                    help='DVS datasets with --event-store: workers ship compact events and the main process '
+                         'bins the whole batch into frames (default: False)')
+parser.add_argument('--manifest-dir', type=str, default='',
+                    help='UrbanSound8K/CREMAD/KineticSound: cache the scanned file lists here and '
+                         'only rescan when the data directories change (default: rescan every run)')
+parser.add_argument('--cache-root', type=str, default='',
+                    help='root of the tonic disk caches and event stores, fill them beforehand with '
+                         'python -m braincog.datasets.disk_cache (default: $BRAINCOG_CACHE_DIR or the dataset root)')
 parser.add_argument('--node-resume', type=str, default='',
                     help='resume weights in node for adaptive node. (default: False)')
 
@@ -326,6 +361,12 @@ parser.add_argument('--visualize', action='store_true',
                     help='Visualize spiking map for each layer, only for validate (default: False)')
 parser.add_argument('--spike-rate', action='store_true',
                     help='Print spiking rate for each layer, only for validate(default: False)')
+parser.add_argument('--fp-packed', action='store_true',
+                    help='Record binary spikes bit-packed instead of as float tensors. '
+                         'Recorded spikes carry no gradient (default: False)')
+parser.add_argument('--compact-grad', action='store_true',
+                    help='Surrogate gradients keep a bit-packed mask or a float16 input for backward. '
+                         'Exact for gate-like surrogates, ~2e-4 relative error otherwise (default: False)')
 parser.add_argument('--tsne', action='store_true')
 parser.add_argument('--conf-mat', action='store_true')
 parser.add_argument('--mem-dist', action='store_true')
@@ -339,6 +380,13 @@ parser.add_argument('--modality', type=str, default='visual')
 # for Multimodal Fusion
 parser.add_argument('--modulation', default='Normal', type=str,
                     choices=['Normal', 'OGM_GE', 'MSLR', 'LFM', 'MMpareto'])
+parser.add_argument('--mmpareto-batched-grad', action='store_true',
+                    help='MMpareto: get the both/audio/visual gradients from one batched backward '
+                         'instead of three retain_graph passes (default: False)')
+parser.add_argument('--micro-batches', type=int, default=1, metavar='N',
+                    help='split every batch into N micro-batches and accumulate their gradients before the step, '
+                         'modulation coefficients are still computed over the whole batch. '
+                         'With AMP this needs --native-amp (default: 1)')
 parser.add_argument('--fusion_method', default='concat', type=str,
                     choices=['concat', 'avattn'])
 parser.add_argument('--fps', default=1, type=int)
@@ -420,6 +468,39 @@ def Alignment(p, q):
     return js_score
 
 
+def repeat_step(inputs, args):
+    """
+    将静态的音频/视觉输入沿时间维度扩展为 ``args.step`` 步
+    ``einops.repeat`` 返回的是共享存储的view, 只有在后续拷贝时才会真正复制T份
+    """
+    if args.dataset == "UrbanSound8K" or args.dataset == "AvCifar10" or args.dataset == "CREMAD":
+        if args.modality == "audio-visual":
+            return list(repeat(item, 'b c w h -> b t c w h', t=args.step) for item in inputs)
+        return repeat(inputs, 'b c w h -> b t c w h', t=args.step)
+    if args.dataset == "KineticSound":
+        if args.modality == "audio-visual":
+            return list([repeat(inputs[0], 'b c w h -> b t c w h', t=args.step),
+                         repeat(inputs[1], 'b c n w h -> b t c n w h', t=args.step)])
+        elif args.modality == "audio":
+            return repeat(inputs, 'b c w h -> b t c w h', t=args.step)
+        return repeat(inputs, 'b c n w h -> b t c n w h', t=args.step)
+    return inputs
+
+
+def add_snr_noise(inputs, args, snr_noise):
+    # 在输入所在的设备上加噪, 每一步的噪声不同
+    inputs[1] = snr_noise(inputs[1], args.snr)
+    return inputs
+
+
+def to_cuda(inputs, target, args):
+    # 先搬运再在设备上转换类型, 与 .type(torch.FloatTensor).cuda() 的结果相同
+    if args.modality == "audio-visual":
+        return list(item.to(args.device, non_blocking=True).float() for item in inputs), \
+               target.to(args.device, non_blocking=True)
+    return inputs.to(args.device, non_blocking=True).float(), target.to(args.device, non_blocking=True)
+
+
 def main(model, loader_train, loader_eval, output_dir):
     # flops, params = profile(model, inputs=(torch.randn(1, args.channels, args.event_size, args.event_size),), verbose=False)
     # _logger.info('flops = %fM', flops / 1e6)
@@ -447,6 +528,13 @@ def main(model, loader_train, loader_eval, output_dir):
     elif args.apex_amp or args.native_amp:
         _logger.warning("Neither APEX or native Torch AMP is available, using float32. "
                         "Install NVIDA apex or upgrade to PyTorch 1.6")
+    if args.cpu and use_amp is not None:
+        _logger.warning('AMP is not supported with --cpu, using float32.')
+        use_amp = None
+
+    if args.micro_batches > 1 and use_amp == 'apex':
+        raise ValueError('Gradient accumulation over micro-batches needs native AMP (--native-amp), '
+                         'APEX AMP runs backward and step in one call.')
 
     if args.num_gpu > 1:
         if use_amp == 'apex':
@@ -456,7 +544,7 @@ def main(model, loader_train, loader_eval, output_dir):
         model = nn.DataParallel(model, device_ids=list(range(args.num_gpu))).cuda()
         assert not args.channels_last, "Channels last not supported with DP, use DDP."
     else:
-        model = model.cuda()
+        model = model.to(args.device)
         if args.channels_last:
             model = model.to(memory_format=torch.channels_last)
 
@@ -496,8 +584,12 @@ def main(model, loader_train, loader_eval, output_dir):
         if hasattr(model, 'set_threshold'):
             model.set_threshold(args.threshold)
 
-    if args.critical_loss or args.spike_rate:
+    if args.critical_loss:
         model.set_requires_fp(True)
+    if args.fp_packed:
+        model.set_fp_packed(True)
+    if args.compact_grad:
+        model.set_compact_grad(True)
 
     model_ema = None
     if args.model_ema:
@@ -515,7 +607,7 @@ def main(model, loader_train, loader_eval, output_dir):
     model_without_ddp = model
     if args.distributed:
         if args.sync_bn:
-            assert not args.split_bn
+            assert not args.split_bn and not args.cpu
             try:
                 if has_apex and use_amp != 'native':
                     # Apex SyncBN preferred unless native amp is activated
@@ -528,7 +620,7 @@ def main(model, loader_train, loader_eval, output_dir):
                         'zero initialized BN layers (enabled by default for ResNets) while sync-bn enabled.')
             except Exception as e:
                 _logger.error('Failed to enable Synchronized BatchNorm. Install Apex or Torch >= 1.1')
-        if has_apex and use_amp != 'native':
+        if has_apex and use_amp != 'native' and not args.cpu:
             # Apex DDP preferred unless native amp is activated
             if args.local_rank == 0:
                 _logger.info("Using NVIDIA APEX DistributedDataParallel.")
@@ -536,8 +628,11 @@ def main(model, loader_train, loader_eval, output_dir):
         else:
             if args.local_rank == 0:
                 _logger.info("Using native Torch DistributedDataParallel.")
-            model = NativeDDP(model.cuda(), device_ids=[args.local_rank],
-                              find_unused_parameters=True)  # can use device str in Torch >= 1.1
+            if args.cpu:
+                model = NativeDDP(model, find_unused_parameters=True)
+            else:
+                model = NativeDDP(model.cuda(), device_ids=[args.local_rank],
+                                  find_unused_parameters=True)  # can use device str in Torch >= 1.1
         model_without_ddp = model.module
     # NOTE: EMA model does not need to be wrapped by DDP
 
@@ -548,12 +643,35 @@ def main(model, loader_train, loader_eval, output_dir):
         start_epoch = args.start_epoch
     elif resume_epoch is not None:
         start_epoch = resume_epoch
+    # 从step checkpoint继续时, 从保存的下一个batch开始
+    resume_state, start_batch = None, 0
+    if args.resume_step:
+        resume_state = torch.load(args.resume_step, map_location='cpu')
+        start_epoch, start_batch = load_resume_state(
+            resume_state, model=model_without_ddp, optimizer=optimizer, lr_scheduler=lr_scheduler,
+            loss_scaler=loss_scaler, model_ema=model_ema.ema if model_ema is not None else None)
+        if args.local_rank == 0:
+            _logger.info('Resume from epoch {} batch {}'.format(start_epoch, start_batch))
     if lr_scheduler is not None and start_epoch > 0:
         lr_scheduler.step(start_epoch)
 
     if args.local_rank == 0:
         _logger.info('Scheduled epochs: {}'.format(num_epochs))
 
+    # sampler 的顺序只由 seed 和 epoch 决定, 可以跳过已经训练过的样本; 分布式训练时按 rank 划分数据
+    if args.distributed and args.dataset != 'imnet':
+        loader_eval = make_resumable_loader(loader_eval, seed=args.seed, num_replicas=args.world_size, rank=args.rank)
+    if (args.distributed or args.step_ckpt_interval > 0 or args.resume_step) and args.dataset != 'imnet':
+        loader_train = make_resumable_loader(loader_train, seed=args.seed, num_replicas=args.world_size, rank=args.rank)
+
+    # imnet 使用timm的prefetcher, 其它数据集使用通用的多模态prefetcher
+    # --event-batch 时由prefetcher在主进程中对整个batch的事件分帧
+    if (args.prefetcher or args.event_batch) and args.dataset != 'imnet':
+        loader_train = MultiModalPrefetcher(loader_train, device=args.device,
+                                            batch_transform=getattr(loader_train.collate_fn, 'to_frames', None))
+        loader_eval = MultiModalPrefetcher(loader_eval, device=args.device,
+                                           batch_transform=getattr(loader_eval.collate_fn, 'to_frames', None))
+
     # _logger.info('train_loader:\n{}\nval_loader:\n{}'.format(loader_train, loader_eval))
     if args.loss_fn == 'mse':
         train_loss_fn = UnilateralMse(1.)
@@ -564,16 +682,16 @@ def main(model, loader_train, loader_eval, output_dir):
     else:
         if args.jsd:
             assert num_aug_splits > 1  # JSD only valid with aug splits set
-            train_loss_fn = JsdCrossEntropy(num_splits=num_aug_splits, smoothing=args.smoothing).cuda()
+            train_loss_fn = JsdCrossEntropy(num_splits=num_aug_splits, smoothing=args.smoothing).to(args.device)
         elif mixup_active:
             # smoothing is handled with mixup target transform
-            train_loss_fn = SoftTargetCrossEntropy().cuda()
+            train_loss_fn = SoftTargetCrossEntropy().to(args.device)
         elif args.smoothing:
-            train_loss_fn = LabelSmoothingCrossEntropy(smoothing=args.smoothing).cuda()
+            train_loss_fn = LabelSmoothingCrossEntropy(smoothing=args.smoothing).to(args.device)
         else:
-            train_loss_fn = nn.CrossEntropyLoss().cuda()
+            train_loss_fn = nn.CrossEntropyLoss().to(args.device)
 
-        validate_loss_fn = nn.CrossEntropyLoss().cuda()
+        validate_loss_fn = nn.CrossEntropyLoss().to(args.device)
 
     if args.loss_fn == 'mix':
         train_loss_fn = MixLoss(train_loss_fn)
@@ -595,7 +713,7 @@ def main(model, loader_train, loader_eval, output_dir):
         model.load_state_dict(torch.load(args.eval_checkpoint)['state_dict'], strict=True)
         model.eval()
         if args.compute_cost:
-            flops, params = profile(model, inputs=([torch.ones([1, 1, 1, 257, 188]).cuda(), torch.ones([1, 1, 3, 3, 224, 224]).cuda()],), verbose=False)
+            flops, params = profile(model, inputs=([torch.ones([1, 1, 1, 257, 188]).to(args.device), torch.ones([1, 1, 3, 3, 224, 224]).to(args.device)],), verbose=False)
             _logger.info('flops = %fG', flops / 1e9)
             _logger.info('param size = %fM', params / 1e6)
             return
@@ -604,6 +722,8 @@ def main(model, loader_train, loader_eval, output_dir):
                                visualize=args.visualize, spike_rate=args.spike_rate,
                                tsne=args.tsne, conf_mat=args.conf_mat, summary_writer=summary_writer)
         print("acc:{}".format(val_metrics['top1']))
+        if summary_writer is not None:
+            summary_writer.close()
         return
 
     saver = None
@@ -618,6 +738,21 @@ def main(model, loader_train, loader_eval, output_dir):
         with open(os.path.join(output_dir, 'args.yaml'), 'w') as f:
             f.write(args_text)
 
+    step_saver = None
+    if args.local_rank == 0 and args.step_ckpt_interval > 0:
+        step_saver = CheckpointManager(output_dir, k=0, last_name='last_step.pth.tar')
+
+    def save_step(epoch, batch_idx, snr_noise=None):
+        state = get_resume_state(
+            epoch, batch_idx, model=model_without_ddp, optimizer=optimizer, lr_scheduler=lr_scheduler,
+            loss_scaler=loss_scaler, model_ema=model_ema.ema if model_ema is not None else None, snr_noise=snr_noise)
+        state['main'] = {
+            'audio_lr_memory': audio_lr_memory, 'visual_lr_memory': visual_lr_memory,
+            'audio_lr_ratio': audio_lr_ratio, 'visual_lr_ratio': visual_lr_ratio,
+            'best_metric': best_metric, 'best_epoch': best_epoch,
+            'checkpoint_files': saver.checkpoint_files if saver is not None else []}
+        step_saver.save(state, None, None)
+
     try:  # train the model
         if args.reset_drop:
             model_without_ddp.reset_drop_path(0.0)
@@ -627,13 +762,23 @@ def main(model, loader_train, loader_eval, output_dir):
         visual_lr_memory = []
         audio_lr_ratio = 1.0
         visual_lr_ratio = 1.0
+        if resume_state is not None:
+            main_state = resume_state['main']
+            audio_lr_memory, visual_lr_memory = main_state['audio_lr_memory'], main_state['visual_lr_memory']
+            audio_lr_ratio, visual_lr_ratio = main_state['audio_lr_ratio'], main_state['visual_lr_ratio']
+            best_metric, best_epoch = main_state['best_metric'], main_state['best_epoch']
+            if saver is not None:
+                saver.checkpoint_files = main_state['checkpoint_files']
+                saver.best_metric, saver.best_epoch = best_metric, best_epoch
         for epoch in range(start_epoch, args.epochs):
 
             if epoch == 0 and args.reset_drop:
                 model_without_ddp.reset_drop_path(args.drop_path)
 
-            if args.distributed:
+            if args.distributed or isinstance(loader_train.sampler, ResumableSampler):
                 loader_train.sampler.set_epoch(epoch)
+            if start_batch > 0:
+                loader_train.sampler.set_start(start_batch * loader_train.batch_size)
 
             cls_k = getAlpha_Learnable_Fitted(epoch)
 
@@ -642,8 +787,11 @@ def main(model, loader_train, loader_eval, output_dir):
                 lr_scheduler=lr_scheduler, saver=saver, output_dir=output_dir,
                 amp_autocast=amp_autocast, loss_scaler=loss_scaler,
                 model_ema=model_ema, mixup_fn=mixup_fn, summary_writer=summary_writer, \
-                cls_k=cls_k,  audio_lr_ratio=audio_lr_ratio, visual_lr_ratio=visual_lr_ratio
+                cls_k=cls_k,  audio_lr_ratio=audio_lr_ratio, visual_lr_ratio=visual_lr_ratio,
+                save_step=save_step if step_saver is not None else None,
+                start_batch=start_batch, resume_state=resume_state
             )
+            start_batch, resume_state = 0, None
 
             if args.distributed and args.dist_bn in ('broadcast', 'reduce'):
                 if args.local_rank == 0:
@@ -696,17 +844,25 @@ def main(model, loader_train, loader_eval, output_dir):
                 save_metric = eval_metrics[eval_metric]
                 best_metric, best_epoch = saver.save_checkpoint(epoch, metric=save_metric)
 
+            if step_saver is not None:
+                save_step(epoch + 1, -1)
+
     except KeyboardInterrupt:
         pass
+    if step_saver is not None:
+        step_saver.close()
     if best_metric is not None:
         _logger.info('*** Best metric: {0} (epoch {1})'.format(best_metric, best_epoch))
+    if summary_writer is not None:
+        summary_writer.close()
 
 
 def train_epoch(
         epoch, model, loader, optimizer, loss_fn, args,
         lr_scheduler=None, saver=None, output_dir='', amp_autocast=suppress,
         loss_scaler=None, model_ema=None, mixup_fn=None, summary_writer=None,
-        cls_k=None, audio_lr_ratio = None, visual_lr_ratio = None):
+        cls_k=None, audio_lr_ratio = None, visual_lr_ratio = None,
+        save_step=None, start_batch=0, resume_state=None):
     if args.mixup_off_epoch and epoch >= args.mixup_off_epoch:
         if args.prefetcher and loader.mixup_enabled:
             loader.mixup_enabled = False
@@ -714,6 +870,9 @@ def train_epoch(
             mixup_fn.mixup_enabled = False
 
     second_order = hasattr(optimizer, 'is_second_order') and optimizer.is_second_order
+    # 原生AMP拆开 scale/backward 和 unscale/step, 梯度可以在micro-batch之间累积, 并在step之前被调制
+    # 是否切分micro-batch都走同一条 unscale -> 调制 -> step 的路径
+    grad_scaler = loss_scaler._scaler if isinstance(loss_scaler, NativeScaler) else None
     batch_time_m = AverageMeter()
     data_time_m = AverageMeter()
     losses_m = AverageMeter()
@@ -730,17 +889,24 @@ def train_epoch(
 
     end = time.time()
     last_idx = len(loader) - 1
-    num_updates = epoch * len(loader)
+    num_updates = epoch * len(loader) + start_batch
     iters_per_epoch = len(loader)
 
     ce = nn.CrossEntropyLoss()
     softmax = nn.Softmax(dim=1)
     relu = nn.ReLU(inplace=True)
     tanh = nn.Tanh()
+    snr_noise = SNRNoise(seed=args.seed + epoch, reduce='batch')
 
     set_MaxUnimodal_epoch = args.epochs
     Coeff_Unimodal = 0.0
 
+    # OGM-GE 只调制卷积核的梯度, inverse 调制融合层输出的梯度
+    audio_conv_params = modality_params(model, 'audio', dim=4)
+    visual_conv_params = modality_params(model, 'visual', dim=4)
+    fusion_out_params = [p for name, p in model.named_parameters()
+                         if 'fusion' in name.split('.')[0] and name.split('.')[1] == 'fc_out']
+
     record_names_audio = []
     record_names_visual = []
     for name, param in model.named_parameters():
@@ -751,148 +917,219 @@ def train_epoch(
             record_names_visual.append((name, param))
             continue
 
-    for batch_idx, samples in enumerate(loader):
+    # 从epoch中间继续时, 恢复保存时下一个batch开始前的随机数状态
+    if resume_state is not None:
+        snr_noise.load_state_dict(resume_state.get('snr_noise', {}))
+        set_rng_state(resume_state['rng'])
+
+    for batch_idx, samples in enumerate(loader, start_batch):
         ratio = ((batch_idx + epoch * iters_per_epoch) / (set_MaxUnimodal_epoch * iters_per_epoch))
         ratio = max(0.0, min(ratio, 1.0))  # clamp 到 [0, 1]
         Coeff_Unimodal = (1 - ratio) ** 3
         inputs, target = samples
-        if args.dataset == "UrbanSound8K" or args.dataset == "AvCifar10" or args.dataset == "CREMAD":
-            if args.modality == "audio-visual":
-                inputs = list(repeat(item, 'b c w h -> b t c w h', t=args.step) for item in inputs)
-                if args.snr >= -10:
-                    image = inputs[1]
-                    inputs[1] = image + torch.randn(image.shape) * math.sqrt(torch.mean(torch.pow(image, 2)) / math.pow(10, args.snr / 10))
-            else:
-                inputs = repeat(inputs, 'b c w h -> b t c w h', t=args.step)
-        if args.dataset == "KineticSound":
-            if args.modality == "audio-visual":
-                inputs = list([repeat(inputs[0], 'b c w h -> b t c w h', t=args.step), repeat(inputs[1], 'b c n w h -> b t c n w h', t=args.step)])
-                if args.snr >= -10:
-                    image = inputs[1]
-                    inputs[1] = image + torch.randn(image.shape) * math.sqrt(torch.mean(torch.pow(image, 2)) / math.pow(10, args.snr / 10))
-            elif args.modality == "audio":
-                inputs = repeat(inputs, 'b c w h -> b t c w h', t=args.step)
-            else:
-                inputs = repeat(inputs, 'b c n w h -> b t c n w h', t=args.step)
+        # 先搬运静态输入, 再在GPU上扩展时间维度和加噪
+        add_noise = args.modality == "audio-visual" and args.snr >= -10 and \
+                    args.dataset in ("UrbanSound8K", "AvCifar10", "CREMAD", "KineticSound")
+        to_device = not isinstance(loader, MultiModalPrefetcher) and (not args.prefetcher or args.dataset != 'imnet')
+        if to_device:
+            inputs, target = to_cuda(inputs, target, args)
+        if mixup_fn is not None:
+            inputs, target = mixup_fn(inputs, target)
+        inputs = repeat_step(inputs, args)
+        if add_noise:
+            inputs = add_snr_noise(inputs, args, snr_noise)
 
         last_batch = batch_idx == last_idx
 
         data_time_m.update(time.time() - end)
-        if not args.prefetcher or args.dataset != 'imnet':
-            if args.modality == "audio-visual":
-                inputs, target = list(item.type(torch.FloatTensor).cuda() for item in inputs), target.cuda()
-            else:
-                inputs, target = inputs.type(torch.FloatTensor).cuda(), target.cuda()
-        with amp_autocast():
-            if args.modality == "audio-visual":
-                output_a, output_v, output = model(inputs)
-                # output_a = output_a.detach()
-                # output_v = output_v.detach()
-                weight_size = model.fusion_module.fc_out.weight.size(1)
-                output_v_ogm = (torch.mm(output_v, torch.transpose(model.fusion_module.fc_out.weight[:, weight_size // 2:], 0, 1))
-                            + model.fusion_module.fc_out.bias / 2)
 
-                output_a_ogm = (torch.mm(output_a, torch.transpose(model.fusion_module.fc_out.weight[:, :weight_size // 2], 0, 1))
-                            + model.fusion_module.fc_out.bias / 2)
+        # 一个batch切成若干micro-batch依次前向/反向, 梯度在 .grad 中累积
+        # 调制用的置信度之和与MMpareto的逐loss梯度也在整个batch上累积, 所有micro-batch结束后只计算一次调制系数
+        optimizer.zero_grad()
+        micro_batches = split_micro_batches(inputs, target, args.micro_batches)
+        accumulate = len(micro_batches) > 1
+        outputs, scores, mmpareto_flat = [], None, None
+        loss_total = loss_single_modal_total = 0.
+        for micro_idx, (micro_inputs, micro_target, weight) in enumerate(micro_batches):
+            with amp_autocast():
+                if args.modality == "audio-visual":
+                    output_a, output_v, output = model(micro_inputs)
+                    # output_a = output_a.detach()
+                    # output_v = output_v.detach()
+                    weight_size = model.fusion_module.fc_out.weight.size(1)
+                    output_v_ogm = (torch.mm(output_v, torch.transpose(model.fusion_module.fc_out.weight[:, weight_size // 2:], 0, 1))
+                                + model.fusion_module.fc_out.bias / 2)
 
-            else:
-                _, _, output = model(inputs)
+                    output_a_ogm = (torch.mm(output_a, torch.transpose(model.fusion_module.fc_out.weight[:, :weight_size // 2], 0, 1))
+                                + model.fusion_module.fc_out.bias / 2)
 
-            loss = loss_fn(output, target)
-            loss_single_modal = torch.tensor(0.)
-            loss_inverse = torch.tensor(0.)
+                else:
+                    _, _, output = model(micro_inputs)
 
-        if args.modality == "audio-visual":
-            # Modulation starts here !
-            score_v = sum([softmax(output_v_ogm)[i][target[i]] for i in range(output_v_ogm.size(0))])
-            score_a = sum([softmax(output_a_ogm)[i][target[i]] for i in range(output_a_ogm.size(0))])
+                loss = loss_fn(output, micro_target)
+                loss_single_modal = torch.tensor(0.)
+                loss_inverse = torch.tensor(0.)
 
-            ratio_v = score_v / score_a
-            ratio_a = 1 / ratio_v
+            if args.modality == "audio-visual":
+                # Modulation starts here !
+                micro_scores = modality_scores(micro_target, output_v_ogm, output_a_ogm)
 
-            if ratio_v > 1:
-                coeff_v = 1 - tanh(args.alpha * relu(ratio_v))
-                coeff_a = 1
-            else:
-                coeff_a = 1 - tanh(args.alpha * relu(ratio_a))
-                coeff_v = 1
+                if args.inverse:
+                    # 单模态分类头与主干一样在 autocast 下计算, AMP时 output_a/output_v 是半精度的
+                    with amp_autocast():
+                        output_a_cls = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
+                        output_v_cls = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
+                        loss_a = loss_fn(output_a_cls, micro_target)
+                        loss_v = loss_fn(output_v_cls, micro_target)
 
-            if args.inverse:
-                output_a_cls = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
-                output_v_cls = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
-                loss_a = loss_fn(output_a_cls, target)
-                loss_v = loss_fn(output_v_cls, target)
+                    loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
 
-                loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
+                    if args.modulation != 'MMpareto':
+                        loss = loss + loss_single_modal
 
-                if args.modulation != 'MMpareto':
-                    loss = loss + loss_single_modal
+                    micro_scores += modality_scores(micro_target, output_v_cls, output_a_cls, output)
 
-                score_v = sum([softmax(output_v_cls)[i][target[i]] for i in range(output_v_cls.size(0))])
-                score_a = sum([softmax(output_a_cls)[i][target[i]] for i in range(output_a_cls.size(0))])
-                score_av = sum([softmax(output)[i][target[i]] for i in range(output.size(0))])
+                scores = micro_scores if scores is None else [s + m for s, m in zip(scores, micro_scores)]
 
-                ratio_av = ((score_a + score_v) / 2) / score_av
-                coeff_av = 1 + tanh(1. - ratio_av)  # a 和 v 越弱, av出来越强
+                if args.modulation == 'MMpareto':  # bug fixed
+                    if not args.inverse:
+                        with amp_autocast():
+                            output_a = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
+                            output_v = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
+                            loss_a = loss_fn(output_a, micro_target)
+                            loss_v = loss_fn(output_v, micro_target)
 
-            if args.modulation == 'MMpareto':  # bug fixed
-                if not args.inverse:
-                    output_a = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
-                    output_v = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
-                    loss_a = loss_fn(output_a, target)
-                    loss_v = loss_fn(output_v, target)
+                        loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
 
-                    loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
+                    losses = [loss, loss_a, loss_v]
+                    all_loss = ['both', 'audio', 'visual']
 
-                losses = [loss, loss_a, loss_v]
-                all_loss = ['both', 'audio', 'visual']
-
-                grads_audio = {}
-                grads_visual = {}
-
-                for idx, loss_type in enumerate(all_loss):
-                    loss = losses[idx]
-                    loss.backward(retain_graph=True)
-
-                    if (loss_type == 'visual'):
-                        for tensor_name, param in record_names_visual:
-                            if param.grad is None:
-                                continue
-                            if loss_type not in grads_visual.keys():
-                                grads_visual[loss_type] = {}
-                            grads_visual[loss_type][tensor_name] = param.grad.data.clone()
-                        grads_visual[loss_type]["concat"] = torch.cat(
-                            [grads_visual[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_visual])
-
-                    elif (loss_type == 'audio'):
-                        for tensor_name, param in record_names_audio:
-                            if param.grad is None:
-                                continue
-                            if loss_type not in grads_audio.keys():
-                                grads_audio[loss_type] = {}
-                            grads_audio[loss_type][tensor_name] = param.grad.data.clone()
-                        grads_audio[loss_type]["concat"] = torch.cat(
-                            [grads_audio[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_audio])
+                    grads_audio = {}
+                    grads_visual = {}
 
+                    if args.mmpareto_batched_grad or accumulate:
+                        # 逐loss的梯度按样本比例累积到一个flat buffer, 所有micro-batch结束后再拆成逐参数的view
+                        params = [p for _, p in record_names_audio + record_names_visual]
+                        flat, offsets = per_loss_grads(losses, params)
+                        if mmpareto_flat is None:
+                            mmpareto_flat = flat.mul_(weight) if accumulate else flat
+                        else:
+                            mmpareto_flat.add_(flat, alpha=weight)
+                        loss = losses[-1]
                     else:
-                        for tensor_name, param in record_names_audio:
-                            if param.grad is None:
-                                continue
-                            if loss_type not in grads_audio.keys():
-                                grads_audio[loss_type] = {}
-                            grads_audio[loss_type][tensor_name] = param.grad.data.clone()
-                        grads_audio[loss_type]["concat"] = torch.cat(
-                            [grads_audio[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_audio])
-                        for tensor_name, param in record_names_visual:
-                            if param.grad is None:
-                                continue
-                            if loss_type not in grads_visual.keys():
-                                grads_visual[loss_type] = {}
-                            grads_visual[loss_type][tensor_name] = param.grad.data.clone()
-                        grads_visual[loss_type]["concat"] = torch.cat(
-                            [grads_visual[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_visual])
-
-                    optimizer.zero_grad()
+                        for idx, loss_type in enumerate(all_loss):
+                            loss = losses[idx]
+                            loss.backward(retain_graph=True)
+
+                            if (loss_type == 'visual'):
+                                for tensor_name, param in record_names_visual:
+                                    if param.grad is None:
+                                        continue
+                                    if loss_type not in grads_visual.keys():
+                                        grads_visual[loss_type] = {}
+                                    grads_visual[loss_type][tensor_name] = param.grad.data.clone()
+                                grads_visual[loss_type]["concat"] = torch.cat(
+                                    [grads_visual[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_visual])
+
+                            elif (loss_type == 'audio'):
+                                for tensor_name, param in record_names_audio:
+                                    if param.grad is None:
+                                        continue
+                                    if loss_type not in grads_audio.keys():
+                                        grads_audio[loss_type] = {}
+                                    grads_audio[loss_type][tensor_name] = param.grad.data.clone()
+                                grads_audio[loss_type]["concat"] = torch.cat(
+                                    [grads_audio[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_audio])
+
+                            else:
+                                for tensor_name, param in record_names_audio:
+                                    if param.grad is None:
+                                        continue
+                                    if loss_type not in grads_audio.keys():
+                                        grads_audio[loss_type] = {}
+                                    grads_audio[loss_type][tensor_name] = param.grad.data.clone()
+                                grads_audio[loss_type]["concat"] = torch.cat(
+                                    [grads_audio[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_audio])
+                                for tensor_name, param in record_names_visual:
+                                    if param.grad is None:
+                                        continue
+                                    if loss_type not in grads_visual.keys():
+                                        grads_visual[loss_type] = {}
+                                    grads_visual[loss_type][tensor_name] = param.grad.data.clone()
+                                grads_visual[loss_type]["concat"] = torch.cat(
+                                    [grads_visual[loss_type][tensor_name].flatten() for tensor_name, _ in record_names_visual])
+
+                            optimizer.zero_grad()
+
+                    loss = loss + loss_single_modal
+
+                if args.modulation == 'LFM':  # bug fixed
+                    # output_a = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
+                    # output_v = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
+                    loss_alignment = Alignment(output_a, output_v)
+                    # if not args.inverse:
+                    #     output_a_cls = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
+                    #     output_v_cls = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
+                    #     loss_a = loss_fn(output_a_cls, target)
+                    #     loss_v = loss_fn(output_v_cls, target)
+                    #
+                    #     loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
+                    #     loss = loss + loss_single_modal
+                    # loss = 2 * (cls_k[0] * loss + cls_k[1] * loss_alignment)
+                    loss = loss + loss_alignment
+
+            # APEX AMP 由 loss_scaler 完成反向, 只在不切分时使用
+            if grad_scaler is not None or loss_scaler is None:
+                # 只在最后一个micro-batch的反向中同步DDP的梯度
+                sync = micro_idx == len(micro_batches) - 1 or not hasattr(model, 'no_sync')
+                with suppress() if sync else model.no_sync():
+                    micro_loss = loss * weight if accumulate else loss
+                    if grad_scaler is not None:
+                        micro_loss = grad_scaler.scale(micro_loss)
+                    micro_loss.backward(create_graph=second_order)
+
+            if accumulate:
+                outputs.append(output.detach())
+                loss_total = loss_total + loss.detach() * weight
+                loss_single_modal_total = loss_single_modal_total + loss_single_modal.detach() * weight
+
+        if accumulate:
+            output = torch.cat(outputs)
+            loss = loss_total
+            loss_single_modal = loss_single_modal_total
+
+        if args.modality == "audio-visual":
+            score_v, score_a = scores[:2]
+            ratio_v = score_v / score_a
+            coeff_a, coeff_v = ogm_ge_coeff(ratio_v, args.alpha)
+
+            if args.inverse:
+                score_v, score_a, score_av = scores[2:]
+                ratio_av = ((score_a + score_v) / 2) / score_av
+                coeff_av = 1 + tanh(1. - ratio_av)  # a 和 v 越弱, av出来越强
+
+            if args.modulation == 'MMpareto':
+                if mmpareto_flat is not None and args.distributed:
+                    # autograd.grad 不经过DDP的hook, 与逐loss backward一样在进程间平均
+                    mmpareto_flat = reduce_tensor(mmpareto_flat, args.world_size)
+                if mmpareto_flat is not None:
+                    # 逐参数的梯度都是flat buffer的view, 不再额外clone
+                    names = [n for n, _ in record_names_audio + record_names_visual]
+                    params = [p for _, p in record_names_audio + record_names_visual]
+                    n_audio = sum(p.numel() for _, p in record_names_audio)
+                    for k, loss_type in enumerate(all_loss):
+                        if loss_type != 'visual':
+                            grads_audio[loss_type] = {}
+                        if loss_type != 'audio':
+                            grads_visual[loss_type] = {}
+                        for name, param, (offset, n) in zip(names, params, offsets):
+                            grads_modal = grads_audio if offset < n_audio else grads_visual
+                            if loss_type in grads_modal:
+                                grads_modal[loss_type][name] = mmpareto_flat[k, offset:offset + n].view_as(param)
+                        if loss_type in grads_audio:
+                            grads_audio[loss_type]["concat"] = mmpareto_flat[k, :n_audio]
+                        if loss_type in grads_visual:
+                            grads_visual[loss_type]["concat"] = mmpareto_flat[k, n_audio:]
 
                 this_cos_audio = F.cosine_similarity(grads_audio['both']["concat"], grads_audio['audio']["concat"],
                                                      dim=0)
@@ -909,33 +1146,17 @@ def train_epoch(
                     audio_k[0] = 0.5
                     audio_k[1] = 0.5
                 else:
-                    audio_k, min_norm = MinNormSolver.find_min_norm_element(
-                        [list(grads_audio[t].values()) for t in audio_task])
+                    audio_k, min_norm = MinNormSolver.find_min_norm_element_batched(
+                        [grads_audio[t]["concat"] for t in audio_task])
                 if (this_cos_visual > 0):
                     visual_k[0] = 0.5
                     visual_k[1] = 0.5
                 else:
-                    visual_k, min_norm = MinNormSolver.find_min_norm_element([list(grads_visual[t].values()) for t in visual_task])
+                    visual_k, min_norm = MinNormSolver.find_min_norm_element_batched(
+                        [grads_visual[t]["concat"] for t in visual_task])
 
                 gamma = 1.5
 
-                loss = loss + loss_single_modal
-
-            if args.modulation == 'LFM':  # bug fixed
-                # output_a = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
-                # output_v = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
-                loss_alignment = Alignment(output_a, output_v)
-                # if not args.inverse:
-                #     output_a_cls = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
-                #     output_v_cls = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
-                #     loss_a = loss_fn(output_a_cls, target)
-                #     loss_v = loss_fn(output_v_cls, target)
-                #
-                #     loss_single_modal = loss_a + loss_v  # 这里需要更新单模态的分类头
-                #     loss = loss + loss_single_modal
-                # loss = 2 * (cls_k[0] * loss + cls_k[1] * loss_alignment)
-                loss = loss + loss_alignment
-
         if not (args.cut_mix | args.mix_up | args.event_mix | (args.cutmix != 0.) | (args.mixup != 0.)):
             # print(output.shape, target.shape)
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -943,12 +1164,13 @@ def train_epoch(
         else:
             acc1, acc5 = torch.tensor([0.]), torch.tensor([0.])
 
-        optimizer.zero_grad()
-        if loss_scaler is not None:
+        if loss_scaler is not None and grad_scaler is None:
             loss_scaler(
                 loss, optimizer, clip_grad=args.clip_grad, parameters=model.parameters(), create_graph=second_order)
         else:
-            loss.backward(create_graph=second_order)
+            if grad_scaler is not None:
+                # 调制和裁剪都作用在 unscale 之后的梯度上
+                grad_scaler.unscale_(optimizer)
             if args.noisy_grad != 0.:
                 random_gradient(model, args.noisy_grad)
             if args.clip_grad is not None:
@@ -966,16 +1188,14 @@ def train_epoch(
             mslr_audio_coeff = audio_lr_init_coeff * audio_lr_ratio
             mslr_visual_coeff = visual_lr_init_coeff * visual_lr_ratio
             if args.modulation_starts <= epoch <= args.modulation_ends:  # bug fixed
+                if args.modulation == 'OGM_GE' and args.modality == "audio-visual":  # bug fixed
+                    modulate_grad_(audio_conv_params, coeff_a)
+                    modulate_grad_(visual_conv_params, coeff_v)
                 for name, parms in model.named_parameters():
                     layer = str(name).split('.')[0]
 
                     if 'audio' in layer:
                         try:
-                            para_len = len(parms.grad.size())
-                            if para_len == 4:
-                                if args.modulation == 'OGM_GE':  # bug fixed
-                                    parms.grad = parms.grad * coeff_a + \
-                                                 torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
                             if args.modulation == 'MSLR':
                                 parms.grad = parms.grad * mslr_audio_coeff
                             if args.modulation == 'MMpareto' and layer != "audio_fc":
@@ -993,11 +1213,6 @@ def train_epoch(
 
                     if 'visual' in layer:
                         try:
-                            para_len = len(parms.grad.size())
-                            if para_len == 4:
-                                if args.modulation == 'OGM_GE':  # bug fixed
-                                    parms.grad = parms.grad * coeff_v + \
-                                                 torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
                             if args.modulation == 'MSLR':
                                 parms.grad = parms.grad * mslr_visual_coeff
                             if args.modulation == 'MMpareto' and layer != "visual_fc":
@@ -1016,15 +1231,15 @@ def train_epoch(
                 pass
 
             if args.inverse_starts <= epoch <= args.inverse_ends:
-                for name, parms in model.named_parameters():
-                    layer = str(name).split('.')[0]
-                    if 'fusion' in layer and str(name).split('.')[1] == "fc_out":
-                        if args.inverse is True:
-                            parms.grad = parms.grad * coeff_av + torch.zeros_like(parms.grad).normal_(0, parms.grad.std().item() + 1e-8)
+                if args.inverse is True:
+                    modulate_grad_(fusion_out_params, coeff_av)
 
-            optimizer.step()
+            if grad_scaler is not None:
+                grad_scaler.step(optimizer)
+                grad_scaler.update()
+            else:
+                optimizer.step()
 
-        torch.cuda.synchronize()
         if model_ema is not None:
             model_ema.update(model)
         num_updates += 1
@@ -1032,9 +1247,9 @@ def train_epoch(
         batch_time_m.update(time.time() - end)
 
         if args.local_rank == 0:
-            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/top1'), acc1.item(), epoch * iters_per_epoch + batch_idx)
-            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/top5'), acc5.item(), epoch * iters_per_epoch + batch_idx)
-            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/loss'), loss.item(), epoch * iters_per_epoch + batch_idx)
+            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/top1'), acc1, epoch * iters_per_epoch + batch_idx)
+            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/top5'), acc5, epoch * iters_per_epoch + batch_idx)
+            summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/train/loss'), loss, epoch * iters_per_epoch + batch_idx)
 
         if last_batch or batch_idx % args.log_interval == 0:
             lrl = [param_group['lr'] for param_group in optimizer.param_groups]
@@ -1067,7 +1282,7 @@ def train_epoch(
                     'Data: {data_time.val:.3f} ({data_time.avg:.3f})'.format(
                         epoch,
                         batch_idx, iters_per_epoch,
-                        100. * batch_idx / last_idx,
+                        100. * batch_idx / max(last_idx, 1),
                         loss=losses_m,
                         loss_single=losses_single_modal_m,
                         loss_inverse=losses_inverse_m,
@@ -1094,6 +1309,9 @@ def train_epoch(
         if lr_scheduler is not None:
             lr_scheduler.step_update(num_updates=num_updates, metric=losses_m.avg)
 
+        if save_step is not None and not last_batch and (batch_idx + 1) % args.step_ckpt_interval == 0:
+            save_step(epoch, batch_idx, snr_noise)
+
         end = time.time()
     # end for
 
@@ -1120,9 +1338,13 @@ def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress,
     top1_a_m = AverageMeter()
     top1_v_m = AverageMeter()
     top5_m = AverageMeter()
-    spike_m = AverageMeter()
 
     model.eval()
+    # 脉冲数量在设备上流式统计, 只在打印时同步, 不需要保存feature map
+    count_spike = spike_rate and not args.distributed
+    if count_spike:
+        model.set_spike_count(True)
+        model.reset_spike_count()
 
     feature_vec = []
     feature_cls = []
@@ -1134,39 +1356,38 @@ def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress,
     last_idx = len(loader) - 1
     iters_per_epoch = len(loader)
     tanh = nn.Tanh()
+    # 固定种子, 每次验证加的噪声相同, 鲁棒性曲线可以复现
+    snr_noise = SNRNoise(seed=args.seed, reduce='batch')
     softmax = nn.Softmax()
+    # 分布式验证时 sampler 补齐的重复样本不计入指标
+    num_valid = getattr(loader.sampler, 'num_valid', None) if args.distributed else None
+    seen = 0
     with torch.no_grad():
 
         for batch_idx, (inputs, target) in enumerate(loader):
-            if args.dataset == "UrbanSound8K" or args.dataset == "AvCifar10" or args.dataset == "CREMAD":
-                if args.modality == "audio-visual":
-                    inputs = list(repeat(item, 'b c w h -> b t c w h', t=args.step) for item in inputs)
-                else:
-                    inputs = repeat(inputs, 'b c w h -> b t c w h', t=args.step)
-            if args.dataset == "KineticSound":
-                if args.modality == "audio-visual":
-                    inputs = list([repeat(inputs[0], 'b c w h -> b t c w h', t=args.step),
-                                   repeat(inputs[1], 'b c n w h -> b t c n w h', t=args.step)])
-                    if args.snr >= -10:
-                        image = inputs[1]
-                        inputs[1] = image + torch.randn(image.shape) * math.sqrt(
-                            torch.mean(torch.pow(image, 2)) / math.pow(10, args.snr / 10))
-                elif args.modality == "audio":
-                    inputs = repeat(inputs, 'b c w h -> b t c w h', t=args.step)
-                else:
-                    inputs = repeat(inputs, 'b c n w h -> b t c n w h', t=args.step)
+            add_noise = args.modality == "audio-visual" and args.snr >= -10 and args.dataset == "KineticSound"
+            to_device = not isinstance(loader, MultiModalPrefetcher) and (not args.prefetcher or args.dataset != 'imnet')
+            if to_device:
+                inputs, target = to_cuda(inputs, target, args)
+            valid = target.size(0)
+            if num_valid is not None:
+                valid = min(max(num_valid - seen, 0), target.size(0))
+                seen += target.size(0)
+                if valid < target.size(0):
+                    # 全是补齐的样本时保留一个参与前向和 all-reduce, 权重为0
+                    keep = max(valid, 1)
+                    inputs = [item[:keep] for item in inputs] if isinstance(inputs, (list, tuple)) else inputs[:keep]
+                    target = target[:keep]
+            inputs = repeat_step(inputs, args)
+            if add_noise:
+                inputs = add_snr_noise(inputs, args, snr_noise)
 
             last_batch = batch_idx == last_idx
-            if not args.prefetcher or args.dataset != 'imnet':
-                if args.modality == "audio-visual":
-                    inputs, target = list(item.type(torch.FloatTensor).cuda() for item in inputs), target.cuda()
-                else:
-                    inputs, target = inputs.type(torch.FloatTensor).cuda(), target.cuda()
             if args.channels_last:
                 inputs = inputs.contiguous(memory_format=torch.channels_last)
 
             if not args.distributed:
-                if (visualize or spike_rate or tsne or conf_mat or args.mem_dist) and not args.critical_loss:
+                if (visualize or tsne or conf_mat or args.mem_dist) and not args.critical_loss:
                     model.set_requires_fp(True)
 
             with amp_autocast():
@@ -1195,12 +1416,10 @@ def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress,
                 output_a = torch.mm(output_a, torch.transpose(model.audio_fc.weight, 0, 1)) + model.audio_fc.bias
                 output_v = torch.mm(output_v, torch.transpose(model.visual_fc.weight, 0, 1)) + model.visual_fc.bias
             else:
-                output_a, output_v = torch.rand((output.shape[0], args.num_classes)).cuda(), torch.rand((output.shape[0], args.num_classes)).cuda()
+                output_a, output_v = torch.rand((output.shape[0], args.num_classes)).to(args.device), torch.rand((output.shape[0], args.num_classes)).to(args.device)
 
             if args.inverse:
-                score_v = sum([softmax(output_v)[i][target[i]] for i in range(output_v.size(0))])
-                score_a = sum([softmax(output_a)[i][target[i]] for i in range(output_a.size(0))])
-                score_av = sum([softmax(output)[i][target[i]] for i in range(output.size(0))])
+                score_v, score_a, score_av = modality_scores(target, output_v, output_a, output)
 
                 ratio_av = ((score_a + score_v) / 2) / score_av
                 coeff_av = 1 + tanh(1. - ratio_av)  # a 和 v 越弱, av出来越强
@@ -1208,41 +1427,37 @@ def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress,
             acc1_a, acc5_a = accuracy(output_a, target, topk=(1, 5))
             acc1_v, acc5_v = accuracy(output_v, target, topk=(1, 5))
             if args.distributed:
-                reduced_loss = reduce_tensor(loss.data, args.world_size)
-                acc1 = reduce_tensor(acc1, args.world_size)
-                acc5 = reduce_tensor(acc5, args.world_size)
+                # 按各进程的有效样本数加权, 一次 all-reduce 得到所有进程上的平均
+                count = torch.tensor(float(valid), device=loss.device)
+                reduced = reduce_tensor(torch.stack([loss.data.float() * count, acc1 * count, acc5 * count, count]),
+                                        args.world_size)
+                reduced_loss, acc1, acc5 = reduced[:3] / reduced[3]
+                n = reduced[3].double() * args.world_size
             else:
                 reduced_loss = loss.data
+                n = valid = output.size(0)
 
-            torch.cuda.synchronize()
+            # 在设备上用float64累加, 与 .item() 后在host上累加的结果相同, 避免每个batch同步
+            losses_m.update(reduced_loss.double(), n)
+            top1_m.update(acc1.double(), n)
+            top1_a_m.update(acc1_a.double(), valid)
+            top1_v_m.update(acc1_v.double(), valid)
 
-            losses_m.update(reduced_loss.item(), output.size(0))
-            top1_m.update(acc1.item(), output.size(0))
-            top1_a_m.update(acc1_a.item(), output.size(0))
-            top1_v_m.update(acc1_v.item(), output.size(0))
-
-            top5_m.update(acc5.item(), output.size(0))
+            top5_m.update(acc5.double(), n)
 
             batch_time_m.update(time.time() - end)
             end = time.time()
 
             if args.local_rank == 0:
-                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/top1'), acc1.item(), epoch * iters_per_epoch + batch_idx)
-                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/top5'), acc5.item(), epoch * iters_per_epoch + batch_idx)
-                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/loss'), loss.item(), epoch * iters_per_epoch + batch_idx)
+                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/top1'), acc1, epoch * iters_per_epoch + batch_idx)
+                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/top5'), acc5, epoch * iters_per_epoch + batch_idx)
+                summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'batch/val/loss'), loss, epoch * iters_per_epoch + batch_idx)
 
             if args.local_rank == 0 and (last_batch or batch_idx % args.log_interval == 0):
                 log_name = 'Test' + log_suffix
 
-            if not args.distributed and spike_rate:
-                spike_m.update(model.get_tot_spike() / output.size(0), output.size(0))
-
-                if not args.distributed and spike_rate:
-                    _logger.info(
-                        '[Spike Info]: {spike.val} ({spike.avg})'.format(
-                            spike=spike_m
-                        )
-                    )
+            if count_spike and (last_batch or batch_idx % args.log_interval == 0):
+                _logger.info('[Spike Info]: {:.4f}'.format(float(model.get_running_tot_spike())))
             if last_batch or batch_idx % args.log_interval == 0:
                 _logger.info(
                     'Eval : {} '
@@ -1259,8 +1474,11 @@ def validate(epoch, model, loader, loss_fn, args, amp_autocast=suppress,
                         top5=top5_m,
                         ))
 
+    if count_spike:
+        model.set_spike_count(False)
+
     # metrics = OrderedDict([('loss', losses_m.avg), ('top1', top1_m.avg), ('top5', top5_m.avg)])
-    metrics = OrderedDict([('loss', losses_m.avg), ('top1', top1_m.avg), ('top1_a', top1_a_m.avg), ('top1_v', top1_v_m.avg)])
+    metrics = OrderedDict([('loss', float(losses_m.avg)), ('top1', float(top1_m.avg)), ('top1_a', float(top1_a_m.avg)), ('top1_v', float(top1_v_m.avg))])
 
     if args.local_rank == 0:
         summary_writer.add_scalar(os.path.join(args.tensorboard_prefix, 'epoch/val/top1'), top1_m.avg, epoch)
@@ -1281,6 +1499,8 @@ if __name__ == '__main__':
     os.environ["OMP_NUM_THREADS"] = "20"  # 设置OpenMP计算库的线程数
     os.environ["MKL_NUM_THREADS"] = "20"  # 设置MKL-DNN CPU加速库的线程数。
     args, args_text = _parse_args()
+    # torchrun 通过环境变量传入 local rank
+    args.local_rank = int(os.environ.get('LOCAL_RANK', args.local_rank))
     # args.no_spike_output = args.no_spike_output | args.cut_mix
     args.no_spike_output = True
     output_dir = ''
@@ -1306,7 +1526,8 @@ if __name__ == '__main__':
             setup_default_logging(log_path=os.path.join(output_dir, 'log_eval.txt'))
         else:
             setup_default_logging(log_path=os.path.join(output_dir, 'log.txt'))
-        summary_writer = SummaryWriter(log_dir=os.path.join(args.tensorboard_dir, exp_name))
+        summary_writer = ScalarBuffer(SummaryWriter(log_dir=os.path.join(args.tensorboard_dir, exp_name)),
+                                      flush_interval=args.metrics_flush_interval)
         args.tensorboard_prefix = os.path.join(args.dataset, args.model)
     else:
         summary_writer = None
@@ -1324,18 +1545,33 @@ if __name__ == '__main__':
     # args.device = 'cuda:0'
     args.world_size = 1
     args.rank = 0  # global rank
-    if args.distributed:
+    if args.cpu:
+        args.num_gpu = 1
+        args.device = torch.device('cpu')
+        if args.distributed:
+            torch.distributed.init_process_group(backend=args.dist_backend or 'gloo', init_method='env://')
+            args.world_size = torch.distributed.get_world_size()
+            args.rank = torch.distributed.get_rank()
+        # 同一台机器上的每个进程各自使用一部分核
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', args.world_size))
+        cores = pin_threads(args.local_rank, local_world_size, args.dist_threads)
+        _logger.info('Process {} uses {} threads on cores {}'.format(args.rank, torch.get_num_threads(), cores))
+    elif args.distributed:
         args.num_gpu = 1
-        args.device = 'cuda:%d' % args.local_rank
+        args.device = torch.device('cuda:%d' % args.local_rank)
         torch.cuda.set_device(args.local_rank)
-        torch.distributed.init_process_group(backend='nccl', init_method='env://')
+        torch.distributed.init_process_group(backend=args.dist_backend or 'nccl', init_method='env://')
         args.world_size = torch.distributed.get_world_size()
         args.rank = torch.distributed.get_rank()
     else:
         torch.cuda.set_device('cuda:%d' % args.device)
+        args.device = torch.device('cuda:%d' % args.device)
     assert args.rank >= 0
 
-    if args.distributed:
+    if args.distributed and args.cpu:
+        _logger.info('Training in distributed mode with multiple CPU processes. Process %d, total %d.'
+                     % (args.rank, args.world_size))
+    elif args.distributed:
         _logger.info('Training in distributed mode with multiple processes, 1 GPU per process. Process %d, total %d.'
                      % (args.rank, args.world_size))
     else:
@@ -1364,9 +1600,9 @@ if __name__ == '__main__':
         data_config=data_config,
         num_aug_splits=num_aug_splits,
         size=args.event_size,
-        mix_up=args.mix_up,
-        cut_mix=args.cut_mix,
-        event_mix=args.event_mix,
+        mix_up=args.mix_up and not args.batch_mix,
+        cut_mix=args.cut_mix and not args.batch_mix,
+        event_mix=args.event_mix and not args.batch_mix,
         beta=args.cutmix_beta,
         prob=args.cutmix_prob,
         gaussian_n=args.gaussian_n,
@@ -1377,9 +1613,19 @@ if __name__ == '__main__':
         randaug_n=args.randaug_n,
         randaug_m=args.randaug_m,
         portion=args.train_portion,
+        event_store=args.event_store,
+        event_batch=args.event_batch,
+        manifest_dir=args.manifest_dir,
+        cache_root=args.cache_root,
         _logger=_logger,
         modality=args.modality
     )
+    # --batch-mix 时训练集不再包装 CutMix/EventMix/MixUp, 在训练循环中对每个batch混合
+    if args.batch_mix:
+        mixup_fn = batch_mix_fn(mix_up=args.mix_up, cut_mix=args.cut_mix, event_mix=args.event_mix,
+                                beta=args.cutmix_beta, prob=args.cutmix_prob, gaussian_n=args.gaussian_n,
+                                num=args.cutmix_num, noise=args.cutmix_noise, num_classes=args.num_classes)
+        mixup_active = mixup_active or mixup_fn is not None
 
     model = create_model(
         args.model,
@@ -1397,6 +1643,8 @@ if __name__ == '__main__':
         act_fun=args.act_fun,
         temporal_flatten=args.temporal_flatten,
         layer_by_layer=args.layer_by_layer,
+        fused_step=args.fused_step,
+        time_fold=args.time_fold,
         n_groups=args.n_groups,
         n_encode_type=args.n_encode_type,
         n_preact=args.n_preact,
@@ -14,3 +14,101 @@ def obtain_top1_accuracy(output, target):
 
     return correct_k, top1
 
+
+def _sorted_by_score(scores, labels):
+    """
+    每一列按分数从大到小排序, 并找出每个样本所在的相同分数组的起止位置
+    :param scores: [N, C]
+    :param labels: [N] 的类别或者 [N, C] 的 one-hot
+    :return: 排序后的 one-hot 标签 [N, C] (float64), 组的起点 [N, C], 组的终点 [N, C]
+    """
+    n, c = scores.shape
+    if labels.dim() == 1:
+        labels = torch.nn.functional.one_hot(labels.long(), num_classes=c)
+    scores, order = torch.sort(scores.double(), dim=0, descending=True)
+    labels = labels.double().gather(0, order)
+
+    index = torch.arange(n, device=scores.device).view(-1, 1).expand(n, c)
+    change = scores[1:] != scores[:-1]
+    first = torch.ones(1, c, dtype=torch.bool, device=scores.device)
+    is_start = torch.cat([first, change], dim=0)
+    is_end = torch.cat([change, first], dim=0)
+    start = torch.where(is_start, index, torch.zeros_like(index)).cummax(dim=0)[0]
+    end = torch.where(is_end, index, torch.full_like(index, n - 1)).flip(0).cummin(dim=0)[0].flip(0)
+    return labels, start, end
+
+
+def average_precision(scores, labels, interpolated=False):
+    """
+    每个类别的 AP, 所有类别一起用排序和 cumsum 计算, 与 ``sklearn.metrics.average_precision_score`` 一致,
+    分数相同的样本作为同一个阈值处理
+    :param scores: 预测分数, shape 为 [N, C]
+    :param labels: [N] 的类别或者 [N, C] 的 one-hot
+    :param interpolated: 为 ``True`` 时使用插值精度 (精度取右侧的最大值), 不合并相同的分数
+    :return: [C] 的 AP, 没有正样本的类别为 nan
+    """
+    labels, start, end = _sorted_by_score(scores, labels)
+    n = labels.size(0)
+    tp = labels.cumsum(dim=0)
+    rank = torch.arange(1, n + 1, dtype=tp.dtype, device=tp.device).view(-1, 1)
+    precision = tp / rank
+    if interpolated:
+        precision = precision.flip(0).cummax(dim=0)[0].flip(0)
+    else:
+        # 同一组内的正样本都取这一组最后一个阈值处的精度
+        precision = precision.gather(0, end)
+    positives = labels.sum(dim=0)
+    return (labels * precision).sum(dim=0) / positives.masked_fill(positives == 0, float('nan'))
+
+
+def roc_auc(scores, labels):
+    """
+    每个类别的 ROC AUC, 由正样本的平均秩计算 (Mann-Whitney U), 分数相同时计 1/2,
+    与 ``sklearn.metrics.roc_auc_score`` 的梯形面积相同
+    :param scores: 预测分数, shape 为 [N, C]
+    :param labels: [N] 的类别或者 [N, C] 的 one-hot
+    :return: [C] 的 AUC, 只有一种标签的类别为 nan
+    """
+    labels, start, end = _sorted_by_score(scores, labels)
+    n = labels.size(0)
+    # 从小到大的秩, 相同分数取平均秩
+    rank = n - (start + end).double() / 2
+    positives = labels.sum(dim=0)
+    negatives = n - positives
+    u = (labels * rank).sum(dim=0) - positives * (positives + 1) / 2
+    return u / (positives * negatives).masked_fill((positives == 0) | (negatives == 0), float('nan'))
+
+
+class ScoreAccumulator(object):
+    """
+    验证时逐batch在设备上保存分数和标签, 结束时一次计算 AP/mAP/AUC 和准确率, 中间不需要同步
+    :param n_classes: 类别数
+    """
+
+    def __init__(self, n_classes):
+        self.n_classes = n_classes
+        self.reset()
+
+    def reset(self):
+        self.scores = []
+        self.labels = []
+
+    def update(self, scores, labels):
+        """
+        :param scores: [B, C] 的预测分数
+        :param labels: [B] 的类别
+        """
+        self.scores.append(scores.detach())
+        self.labels.append(labels.detach())
+
+    def compute(self, interpolated=False):
+        """
+        :return: dict, 包括每个类别的 ``ap``, ``auc`` 和平均后的 ``map``, ``auc_mean``, ``acc``
+        """
+        scores = torch.cat(self.scores, dim=0)
+        labels = torch.cat(self.labels, dim=0)
+        ap = average_precision(scores, labels, interpolated=interpolated)
+        auc = roc_auc(scores, labels)
+        acc = (scores.argmax(dim=1) == labels).double().mean()
+        mean_ap, mean_auc, acc = torch.stack([ap.nanmean(), auc.nanmean(), acc]).tolist()
+        return {'ap': ap, 'auc': auc, 'map': mean_ap, 'auc_mean': mean_auc, 'acc': acc}
@@ -1,4 +1,7 @@
 import os
+import queue
+import shutil
+import threading
 
 import torch
 import torch.nn as nn
@@ -17,6 +20,32 @@ def setup_seed(seed):
     torch.backends.cudnn.benchmark = False
     os.environ['PYTHONHASHSEED'] = str(seed)
 
+
+def pin_threads(local_rank, local_world_size, num_threads=0):
+    """
+    CPU上多进程训练时, 每个进程绑定到不重叠的一组核, 并设置相同数量的 intra-op 线程
+    :param local_rank: 当前机器上的进程序号
+    :param local_world_size: 当前机器上的进程数
+    :param num_threads: 每个进程的线程数, 为0时平分所有可用的核
+    :return: 绑定的核
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count()))
+    if num_threads <= 0:
+        num_threads = max(1, len(available) // local_world_size)
+    cores = available[local_rank * num_threads:(local_rank + 1) * num_threads]
+    if len(cores) == 0:
+        cores = available
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    os.environ['OMP_NUM_THREADS'] = str(len(cores))
+    os.environ['MKL_NUM_THREADS'] = str(len(cores))
+    return cores
+
+
 def weight_init(m):
     if isinstance(m, nn.Linear):
         nn.init.xavier_normal_(m.weight)
@@ -26,3 +55,457 @@ def weight_init(m):
     elif isinstance(m, nn.BatchNorm2d):
         nn.init.constant_(m.weight, 1)
         nn.init.constant_(m.bias, 0)
+
+
+def modality_params(model, modality, depth=0, dim=None):
+    """
+    按模块名获取某一模态的参数, 用于梯度调制
+    :param modality: 模块名中包含的关键字, 如 'audio', 'visual', 'fusion'
+    :param depth: 模块名中表示模态的层级, 被 DataParallel 包装后为 1
+    :param dim: 只保留维度为 dim 的参数, 如 4 表示卷积核, 默认为 ``None`` 不筛选
+    :return: 参数列表
+    """
+    return [p for name, p in model.named_parameters()
+            if modality in name.split('.')[depth] and (dim is None or p.dim() == dim)]
+
+
+def ogm_ge_coeff(ratio_v, alpha):
+    """
+    OGM-GE 的调制系数, 用 torch.where 代替 ``if ratio_v > 1`` 的分支, 不需要同步
+            1 - tanh(alpha * rho_t_u), if rho_t_u > 1
+    k_t_u =
+            1,                         else
+    :param ratio_v: score_v / score_a
+    :param alpha: OGM-GE 中的 alpha
+    :return: coeff_a, coeff_v
+    """
+    ratio_a = 1 / ratio_v
+    one = torch.ones_like(ratio_v)
+    coeff_v = torch.where(ratio_v > 1, 1 - torch.tanh(alpha * torch.relu(ratio_v)), one)
+    coeff_a = torch.where(ratio_v > 1, one, 1 - torch.tanh(alpha * torch.relu(ratio_a)))
+    return coeff_a, coeff_v
+
+
+def modulate_grad_(params, coeff, noise=True):
+    """
+    对一组参数的梯度原地计算 grad * coeff + N(0, std(grad) + 1e-8)
+    使用 multi-tensor 操作, std 留在设备上, 噪声的采样顺序与逐个参数调用 ``normal_`` 一致
+    :param params: 参数列表
+    :param coeff: 调制系数, 标量或设备上的 0 维 tensor
+    :param noise: 是否加入高斯噪声
+    """
+    grads = [p.grad for p in params if p.grad is not None]
+    if len(grads) == 0:
+        return
+    if noise:
+        stds = [g.std() + 1e-8 for g in grads]
+        noises = [torch.randn_like(g) for g in grads]
+        torch._foreach_mul_(noises, stds)
+    if isinstance(coeff, torch.Tensor):
+        torch._foreach_mul_(grads, [coeff.to(grads[0].dtype)] * len(grads))
+    else:
+        torch._foreach_mul_(grads, coeff)
+    if noise:
+        torch._foreach_add_(grads, noises)
+
+
+def modality_scores(target, *logits):
+    """
+    各模态在真实类别上的 softmax 置信度之和, 等价于
+    ``sum([softmax(logit)[i][target[i]] for i in range(logit.size(0))])``
+    所有模态的输出叠在一起只做一次 softmax 和 gather, 结果留在设备上
+    :param target: 标签, shape 为 [B]
+    :param logits: 各模态的输出, shape 均为 [B, C]
+    :return: 每个模态的置信度之和, 0 维 tensor 的 tuple
+    """
+    probs = torch.softmax(torch.stack([logit.float() for logit in logits]), dim=-1)  # m b c
+    index = target.view(1, -1, 1).expand(len(logits), -1, 1)
+    return tuple(probs.gather(2, index).sum(dim=(1, 2)).unbind(0))
+
+
+def per_loss_grads(losses, params):
+    """
+    一次 batched backward 计算每个 loss 对 params 的梯度, 按 params 的顺序写入 [len(losses), P] 的连续buffer
+    不支持 batched backward 时退回逐个 loss 调用 ``autograd.grad``, 同样直接写入buffer
+    :return: buffer, 以及每个参数在buffer中的 (offset, numel)
+    """
+    offsets, total = [], 0
+    for p in params:
+        offsets.append((total, p.numel()))
+        total += p.numel()
+    flat = torch.zeros(len(losses), total, dtype=params[0].dtype, device=params[0].device)
+
+    try:
+        grad_outputs = torch.eye(len(losses), dtype=losses[0].dtype, device=losses[0].device)
+        grads = torch.autograd.grad(torch.stack(losses), params, grad_outputs=grad_outputs,
+                                    retain_graph=True, allow_unused=True, is_grads_batched=True)
+        for g, (offset, n) in zip(grads, offsets):
+            if g is not None:
+                flat[:, offset:offset + n] = g.reshape(len(losses), n)
+    except (RuntimeError, TypeError):
+        for k, loss in enumerate(losses):
+            grads = torch.autograd.grad(loss, params, retain_graph=True, allow_unused=True)
+            for g, (offset, n) in zip(grads, offsets):
+                if g is not None:
+                    flat[k, offset:offset + n] = g.flatten()
+    return flat, offsets
+
+
+def split_micro_batches(inputs, target, n):
+    """
+    沿batch维度把一个batch切成 n 个micro-batch, 用于梯度累积
+    各micro-batch的平均loss乘以 weight 后求和, 等于整个batch的平均loss
+    :param inputs: 单个tensor或多模态tensor的list, 第0维为batch
+    :param target: 标签, 第0维为batch
+    :param n: micro-batch的个数, 超过batch大小时每个micro-batch只有一个样本
+    :return: [(inputs, target, weight)]
+    """
+    batch_size = target.size(0)
+    if n <= 1 or batch_size <= 1:
+        return [(inputs, target, 1.)]
+    size = -(-batch_size // n)
+    targets = target.split(size)
+    if isinstance(inputs, (list, tuple)):
+        inputs = list(zip(*[x.split(size) for x in inputs]))
+        inputs = [list(x) for x in inputs]
+    else:
+        inputs = inputs.split(size)
+    return [(x, t, t.size(0) / batch_size) for x, t in zip(inputs, targets)]
+
+
+class SNRNoise(object):
+    """
+    按信噪比给整个batch加高斯噪声, 在输入所在的设备上一次完成
+    noise ~ N(0, P / 10^(snr / 10)), P 为信号功率 mean(x^2)
+    :param seed: 噪声的随机种子, 相同的种子得到相同的噪声, 使鲁棒性曲线可以复现, 为 ``None`` 时使用全局的随机数
+    :param reduce: ``sample`` 按样本计算信号功率, ``batch`` 按整个batch计算 (与原来逐batch加噪的实现一致)
+    """
+
+    def __init__(self, seed=None, reduce='sample'):
+        self.seed = seed
+        self.reduce = reduce
+        self.generators = {}
+
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        if str(device) not in self.generators:
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed)
+            self.generators[str(device)] = generator
+        return self.generators[str(device)]
+
+    def reset(self):
+        """
+        回到种子的初始状态, 之后的噪声与第一次调用时相同
+        """
+        self.generators = {}
+
+    def state_dict(self):
+        return {device: generator.get_state() for device, generator in self.generators.items()}
+
+    def load_state_dict(self, state_dict):
+        for device, state in state_dict.items():
+            self.generator(torch.device(device)).set_state(state)
+
+    def power(self, x):
+        if self.reduce == 'batch':
+            return x.pow(2).mean()
+        return x.pow(2).mean(dim=tuple(range(1, x.dim())))
+
+    def __call__(self, x, snr):
+        """
+        :param x: 输入, shape 为 [B, ...]
+        :param snr: 信噪比(dB), 标量或者 shape 为 [B] 的每个样本的信噪比
+        :return: 加噪后的输入
+        """
+        if not x.is_floating_point():
+            x = x.float()
+        snr = torch.as_tensor(snr, dtype=x.dtype, device=x.device)
+        std = torch.sqrt(self.power(x) / torch.pow(10., snr / 10))
+        if std.dim() > 0:
+            std = std.view(-1, *([1] * (x.dim() - 1)))
+        # 原地缩放噪声再加上输入, 不产生额外的临时tensor
+        noise = torch.randn(x.shape, generator=self.generator(x.device), dtype=x.dtype, device=x.device)
+        return noise.mul_(std).add_(x)
+
+    def sweep(self, x, snr):
+        """
+        一次调用给整个batch加上所有SNR下的噪声, 信号功率只计算一次, 不复制输入
+        结果与 ``self(x.repeat(S, ...), snr.repeat_interleave(B)).view(S, B, ...)`` 相同
+        :param x: 输入, shape 为 [B, ...]
+        :param snr: S 个信噪比(dB)
+        :return: shape 为 [S, B, ...]
+        """
+        if not x.is_floating_point():
+            x = x.float()
+        snr = torch.as_tensor(snr, dtype=x.dtype, device=x.device).view(-1, 1)
+        std = torch.sqrt(self.power(x) / torch.pow(10., snr / 10))
+        std = std.expand(-1, x.size(0)).reshape(snr.size(0), x.size(0), *([1] * (x.dim() - 1)))
+        noise = torch.randn((snr.size(0),) + tuple(x.shape), generator=self.generator(x.device),
+                            dtype=x.dtype, device=x.device)
+        return noise.mul_(std).add_(x)
+
+
+class ScalarBuffer(object):
+    """
+    包装 SummaryWriter, ``add_scalar`` 直接接收设备上的 tensor, 不在每个batch调用 ``.item()``
+    攒够 flush_interval 个标量后一次性拷贝到复用的pinned memory (CUDA上异步拷贝),
+    由后台线程按原来的顺序写入 SummaryWriter, 写入的数值与逐个 ``.item()`` 相同
+    CPU上的tensor ``.item()`` 不需要同步, 直接取值, 只把写 event 文件放到后台
+    :param writer: SummaryWriter
+    :param flush_interval: 攒多少个标量写一次
+    """
+
+    def __init__(self, writer, flush_interval=100):
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.queue = queue.Queue(maxsize=1)
+        # 两块host缓冲区轮流使用, 一块被后台线程读取时另一块接收下一次flush
+        self.free = queue.Queue()
+        for _ in range(2):
+            self.free.put(None)
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def add_scalar(self, tag, scalar_value, global_step=None):
+        if isinstance(scalar_value, torch.Tensor):
+            scalar_value = scalar_value.detach()
+            if not scalar_value.is_cuda:
+                scalar_value = scalar_value.item()
+        self.pending.append((tag, scalar_value, global_step))
+        if len(self.pending) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        把当前攒下的标量交给后台线程, 不等待写入完成
+        """
+        if len(self.pending) == 0:
+            return
+        pending, self.pending = self.pending, []
+        tensors = [v for _, v, _ in pending if isinstance(v, torch.Tensor)]
+        host, values, event = None, None, None
+        if len(tensors) > 0:
+            host = self.free.get()
+            if host is None or host.numel() < len(tensors):
+                host = torch.empty(max(self.flush_interval, len(tensors)), dtype=torch.float64, pin_memory=True)
+            # 先在设备上 stack, 只有一次拷贝; float32 转 float64 是精确的, 与 .item() 的值相同
+            values = host[:len(tensors)]
+            values.copy_(torch.stack([t.reshape(()) for t in tensors]), non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((pending, host, values, event))
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            pending, host, values, event = item
+            if event is not None:
+                event.synchronize()
+            values = iter(values.tolist() if values is not None else [])
+            if host is not None:
+                self.free.put(host)
+            for tag, scalar_value, global_step in pending:
+                if isinstance(scalar_value, torch.Tensor):
+                    scalar_value = next(values)
+                self.writer.add_scalar(tag, scalar_value, global_step)
+            self.queue.task_done()
+
+    def wait(self):
+        """
+        写出所有攒下的标量并等待后台线程写完
+        """
+        self.flush()
+        self.queue.join()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+
+def _snapshot(obj, buffers, key=()):
+    # 递归地把 state dict 中的tensor拷贝到复用的host缓冲区, CUDA上的tensor异步拷贝到pinned memory
+    # buffers 以在 state dict 中的路径为键, 形状或类型变化时才重新分配
+    if isinstance(obj, torch.Tensor):
+        host = buffers.get(key)
+        if host is None or host.shape != obj.shape or host.dtype != obj.dtype:
+            host = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+            buffers[key] = host
+        return host.copy_(obj.detach(), non_blocking=obj.is_cuda)
+    if isinstance(obj, dict):
+        return type(obj)((k, _snapshot(v, buffers, key + (k,))) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v, buffers, key + (i,)) for i, v in enumerate(obj))
+    return obj
+
+
+class CheckpointManager(object):
+    """
+    异步保存checkpoint, 按指标保留最好的 k 个, 另外保留一个滚动更新的 last 用于恢复训练
+    ``save`` 只把 state dict 拷贝到复用的host缓冲区, 序列化和写文件都由后台线程完成, 先写临时文件再原子地重命名,
+    写入中途崩溃不会留下损坏的checkpoint; 被挤出 top-k 的文件在新文件写完之后才删除
+    同一次保存既进入 top-k 又是 last 时只序列化一次, last 用硬链接 (不支持时复制文件)
+    :param root: 保存的目录
+    :param k: 保留的checkpoint数
+    :param decreasing: 为 ``True`` 时指标越小越好, 如 loss
+    :param last_name: 滚动checkpoint的文件名, 为 ``None`` 时不保存
+    :param max_pending: 最多排队等待写入的checkpoint数, 队列满时 ``save`` 阻塞到前一个写完, 也决定了缓冲区的份数
+    """
+
+    def __init__(self, root, k=1, decreasing=False, last_name='last.pth', max_pending=1):
+        self.root = root
+        self.k = k
+        self.decreasing = decreasing
+        self.last_name = last_name
+        self.checkpoints = []  # (metric, path), 从好到差
+        self.error = None
+        os.makedirs(root, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max_pending)
+        # 空闲的缓冲区, 一份正在写入, 其余在队列中
+        self.free = queue.Queue()
+        for _ in range(max_pending + 1):
+            self.free.put({})
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def is_better(self, metric, other):
+        return metric < other if self.decreasing else metric > other
+
+    def save(self, state, name, metric):
+        """
+        :param state: 要保存的dict, 其中的tensor会被拷贝一份, 调用之后可以继续训练
+        :param name: top-k checkpoint的文件名
+        :param metric: 排序用的指标
+        :return: 进入 top-k 时返回保存的路径, 否则返回 ``None``
+        """
+        self._check()
+        path = None
+        if self.k > 0 and (len(self.checkpoints) < self.k or self.is_better(metric, self.checkpoints[-1][0])):
+            path = os.path.join(self.root, name)
+            self.checkpoints.append((metric, path))
+            # 指标相同时先保存的排在前面
+            self.checkpoints.sort(key=lambda x: x[0], reverse=not self.decreasing)
+        removed = [p for _, p in self.checkpoints[self.k:] if p != path]
+        self.checkpoints = self.checkpoints[:self.k]
+        if path is None and self.last_name is None:
+            return None
+
+        buffers = self.free.get()
+        snapshot = _snapshot(state, buffers)
+        event = None
+        if torch.cuda.is_available():
+            event = torch.cuda.Event()
+            event.record()
+        paths = ([path] if path is not None else []) + \
+                ([os.path.join(self.root, self.last_name)] if self.last_name is not None else [])
+        self.queue.put((snapshot, buffers, event, paths, removed))
+        return path
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            snapshot, buffers, event, paths, removed = item
+            try:
+                if event is not None:
+                    event.synchronize()
+                tmp = paths[0] + '.tmp'
+                with open(tmp, 'wb') as f:
+                    torch.save(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                for path in paths[1:]:
+                    link = path + '.tmp'
+                    if os.path.exists(link):
+                        os.remove(link)
+                    try:
+                        os.link(tmp, link)
+                    except OSError:
+                        shutil.copyfile(tmp, link)
+                    os.replace(link, path)
+                os.replace(tmp, paths[0])
+                for path in removed:
+                    if os.path.exists(path):
+                        os.remove(path)
+            except Exception as e:
+                self.error = e
+            del snapshot
+            self.free.put(buffers)
+            self.queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        """
+        等待所有checkpoint写完
+        """
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self._check()
+
+
+def rng_state():
+    """
+    python, numpy, torch (CPU 和所有GPU) 的随机数状态, numpy 的状态存为tensor, 保存后可以直接 ``torch.load``
+    """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': random.getstate(),
+            'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if len(state['cuda']) > 0 and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def get_resume_state(epoch, batch_idx, **objects):
+    """
+    训练到某个batch时的完整状态, 用于从epoch中间继续训练
+    应在一个batch的最后调用, 这样保存的随机数状态正好是下一个batch开始时的状态
+    :param epoch: 当前epoch
+    :param batch_idx: 已经完成的最后一个batch, -1 表示从 epoch 的开头继续
+    :param objects: model, optimizer, lr_scheduler, loss_scaler 等有 ``state_dict`` 的对象, 为 ``None`` 的跳过
+    :return: dict
+    """
+    state = {'epoch': epoch, 'batch_idx': batch_idx, 'rng': rng_state()}
+    for name, obj in objects.items():
+        if obj is not None:
+            state[name] = obj.state_dict()
+    return state
+
+
+def load_resume_state(state, **objects):
+    """
+    恢复 ``get_resume_state`` 保存的对象, 随机数状态需要在下一个batch开始之前用 ``set_rng_state`` 恢复
+    :return: 继续训练的 epoch 和 batch
+    """
+    for name, obj in objects.items():
+        if obj is not None and name in state:
+            obj.load_state_dict(state[name])
+    return state['epoch'], state['batch_idx'] + 1